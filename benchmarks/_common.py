@@ -0,0 +1,76 @@
+"""
+Helpers shared by the benchmarks: the --output argument, percentiles, and recording results
+Results are appended as JSON lines to benchmarks/results.jsonl by default, which is ignored by git so runs can be compared locally without ending up in commits
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import time
+from typing import List
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_OUTPUT = os.path.join(BENCHMARKS_DIR, "results.jsonl")
+
+
+def add_output_argument(argparser: argparse.ArgumentParser):
+    argparser.add_argument(
+        "--output",
+        default=DEFAULT_OUTPUT,
+        help="The file to append the results to (- for stdout)",
+    )
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def git_commit() -> str:
+    """
+    Get the short hash of the checked out commit, or an empty string if it isn't a git checkout
+    """
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=BENCHMARKS_DIR,
+            check=False,
+        ).stdout.strip()
+    except OSError:
+        # git isn't installed
+        return ""
+
+
+def run_info(benchmark: str) -> dict:
+    """
+    Get what identifies a run: when it was, the commit, and the benchmark
+    """
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": git_commit(),
+        "benchmark": benchmark,
+    }
+
+
+def print_results(results: dict):
+    width = max(len(key) for key in results)
+    for key, value in results.items():
+        print(f"{key:>{width}}: {value}")
+
+
+def append_results(path: str, results: dict):
+    """
+    Append results as a JSON line to path (or print the line if path is -)
+    """
+    line = json.dumps(results)
+    if path == "-":
+        print(line)
+        return
+    with open(path, "a") as f:
+        f.write(line + "\n")
+    print(f"Appended results to {path}")
@@ -0,0 +1,257 @@
+"""
+Check of splitting the scrapers between two processes sharing one database with leases
+Run with `pdm run python benchmarks/leases_bench.py --scrapers 200`
+A local HTTP server serves a page per scraper and counts how often each is fetched
+A coordinator is started and takes every scraper, then a worker joins and the two should split them evenly, with each page fetched about once per interval (not twice)
+The worker is then stopped with SIGTERM and the coordinator should take its scrapers back, with every scraper's state written to the database
+Exits with 1 if any of that doesn't happen within --timeout seconds, so it can be run as a check
+Results are printed and appended as a JSON line to --output so runs can be compared
+"""
+
+import argparse
+import math
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import toml
+from _common import add_output_argument, append_results, print_results, run_info
+
+argparser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+argparser.add_argument("--scrapers", type=int, default=200)
+argparser.add_argument("--interval", type=int, default=2)
+argparser.add_argument("--lease-ttl", type=float, default=3)
+argparser.add_argument(
+    "--window",
+    type=float,
+    default=10,
+    help="The number of seconds fetches are counted for once the scrapers are split",
+)
+argparser.add_argument("--timeout", type=float, default=60)
+add_output_argument(argparser)
+bench_args = argparser.parse_args()
+
+# Map of page to the number of times it was fetched
+fetches = {}
+fetches_lock = threading.Lock()
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        page = int(self.path.rsplit("/", 1)[-1])
+        with fetches_lock:
+            fetches[page] = fetches.get(page, 0) + 1
+        body = f'<p class="value">{page}</p>'.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        # Notifications are discarded
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def write_config(path: str, base_url: str):
+    scrapers = [
+        {
+            "name": f"Scraper {i}",
+            "url": f"{base_url}/page/{i}",
+            "css_selector": ".value",
+            "interval": bench_args.interval,
+            "engine": "http",
+            # Every scrape fetches the page, so the fetches can be counted
+            "skip_unchanged": False,
+            "notifiers": [
+                {
+                    "type": "webhook",
+                    "config": {"url": f"{base_url}/webhook", "notify_on": ["error"]},
+                }
+            ],
+        }
+        for i in range(bench_args.scrapers)
+    ]
+    with open(path, "w") as f:
+        toml.dump({"scrapers": scrapers}, f)
+
+
+def start(directory: str, role: str, worker_id: str) -> subprocess.Popen:
+    return subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "scrape_and_ntfy",
+            "--db-url",
+            f"sqlite:///{directory}/bench.db",
+            "--path-to-toml",
+            f"{directory}/config.toml",
+            "--log-level",
+            "WARNING",
+            "--role",
+            role,
+            "--worker-id",
+            worker_id,
+            "--lease-ttl",
+            str(bench_args.lease_ttl),
+            "--flush-interval",
+            "1",
+            "--reload-interval",
+            "0",
+            # Enough threads to scrape every scraper once per interval
+            "--pool-size",
+            "8",
+        ],
+        # Run in the temporary directory so a .env in the current directory isn't loaded
+        cwd=directory,
+        stdout=subprocess.DEVNULL,
+        stderr=open(f"{directory}/{worker_id}.log", "w"),
+    )
+
+
+def held(directory: str) -> dict:
+    """
+    Get the number of unexpired leases each worker holds
+    """
+    try:
+        with sqlite3.connect(f"{directory}/bench.db", timeout=10) as connection:
+            rows = connection.execute(
+                "SELECT worker, COUNT(*) FROM leases WHERE expires >= ? GROUP BY worker",
+                (time.time(),),
+            ).fetchall()
+    except sqlite3.OperationalError:
+        # The tables haven't been created yet
+        return {}
+    return {worker: count for worker, count in rows if worker is not None}
+
+
+def wait_for(condition, timeout: float) -> float:
+    """
+    Poll condition until it is true and return how many seconds that took, or None if it timed out
+    """
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        if condition():
+            return time.perf_counter() - started
+        time.sleep(0.1)
+    return None
+
+
+def stop(process: subprocess.Popen):
+    process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def main():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    directory = tempfile.mkdtemp(prefix="scrape-and-ntfy-leases-")
+    write_config(f"{directory}/config.toml", base_url)
+    n = bench_args.scrapers
+    share = math.ceil(n / 2)
+    failures = []
+
+    coordinator = start(directory, "coordinator", "coordinator")
+    worker = None
+    try:
+        claim_seconds = wait_for(
+            lambda: held(directory).get("coordinator") == n, bench_args.timeout
+        )
+        if claim_seconds is None:
+            failures.append(f"The coordinator didn't claim all {n} scrapers")
+        worker = start(directory, "worker", "worker")
+        split_seconds = wait_for(
+            lambda: (
+                held(directory) == {"coordinator": share, "worker": n - share}
+                or held(directory) == {"coordinator": n - share, "worker": share}
+            ),
+            bench_args.timeout,
+        )
+        if split_seconds is None:
+            failures.append(
+                f"The scrapers weren't split between the workers: {held(directory)}"
+            )
+
+        # Count the fetches of each page once the split has settled
+        time.sleep(bench_args.interval)
+        with fetches_lock:
+            fetches.clear()
+        time.sleep(bench_args.window)
+        with fetches_lock:
+            counts = [fetches.get(page, 0) for page in range(n)]
+        expected = bench_args.window / bench_args.interval
+        unscraped = sum(1 for count in counts if count == 0)
+        # A page scraped by both workers would be fetched about twice as often
+        duplicated = sum(1 for count in counts if count > expected * 1.5 + 1)
+        if unscraped:
+            failures.append(f"{unscraped} scraper(s) weren't scraped by either worker")
+        if duplicated:
+            failures.append(f"{duplicated} scraper(s) were scraped by both workers")
+
+        stopped = time.time()
+        stop(worker)
+        takeover_seconds = wait_for(
+            lambda: held(directory).get("coordinator") == n, bench_args.timeout
+        )
+        if takeover_seconds is None:
+            failures.append(
+                f"The coordinator didn't take the worker's scrapers back: {held(directory)}"
+            )
+        # Everything the worker scraped should have been written when it stopped
+        try:
+            with sqlite3.connect(f"{directory}/bench.db", timeout=10) as connection:
+                stale = connection.execute(
+                    "SELECT COUNT(*) FROM scrapers WHERE last_scrape IS NULL OR last_scrape < ?",
+                    (stopped - bench_args.interval * 3,),
+                ).fetchone()[0]
+        except sqlite3.OperationalError:
+            stale = n
+        if stale:
+            failures.append(f"{stale} scraper(s) had stale state after the handover")
+    finally:
+        if worker is not None and worker.poll() is None:
+            stop(worker)
+        stop(coordinator)
+        server.shutdown()
+
+    results = {
+        **run_info("leases"),
+        "scrapers": n,
+        "lease_ttl": bench_args.lease_ttl,
+        "claim_seconds": round(claim_seconds, 2) if claim_seconds else None,
+        "split_seconds": round(split_seconds, 2) if split_seconds else None,
+        "takeover_seconds": round(takeover_seconds, 2) if takeover_seconds else None,
+        "fetches_per_scraper": round(sum(counts) / n, 2),
+        "expected_fetches_per_scraper": round(expected, 2),
+        "unscraped": unscraped,
+        "duplicated": duplicated,
+        "stale_after_handover": stale,
+    }
+    print_results(results)
+    append_results(bench_args.output, results)
+    for failure in failures:
+        print(failure)
+    if failures:
+        print(f"Logs are in {directory}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
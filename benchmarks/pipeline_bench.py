@@ -0,0 +1,358 @@
+"""
+End-to-end benchmark of scraping, storing, and notifying, without touching the internet
+Run with `pdm run python benchmarks/pipeline_bench.py --scrapers 1000`
+A local HTTP server serves fixture pages (like test.html) whose prices change every round, along with stub webhook and ntfy endpoints
+A TOML config with --scrapers scrapers is generated and loaded the same way as config.toml, then every scraper is scraped --rounds times
+--engine fake (the default) uses a fake browser that fetches and parses the page itself, so only the CPU cost of the pipeline is measured
+--parity first checks that the http engine extracts the same text as a real browser (--browser) from the fixture pages, and the benchmark exits with 1 if they differ
+Results are printed and appended as a JSON line to --output so runs can be compared
+"""
+
+import argparse
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import toml
+from _common import (
+    add_output_argument,
+    append_results,
+    percentile,
+    print_results,
+    run_info,
+)
+from selectolax.lexbor import LexborHTMLParser
+from selenium.common.exceptions import NoSuchElementException
+
+from scrape_and_ntfy.__main__ import load_scrapers, setup
+from scrape_and_ntfy.scraping import UrlScraper, http_engine
+from scrape_and_ntfy.scraping import scraper as scraper_module
+from scrape_and_ntfy.scraping.browser import DriverPool, create_driver
+from scrape_and_ntfy.scraping.dispatcher import NotificationDispatcher
+from scrape_and_ntfy.utils.db import connect_to_db, db
+
+argparser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+argparser.add_argument("--scrapers", type=int, default=500)
+argparser.add_argument(
+    "--pages", type=int, default=50, help="The number of distinct pages"
+)
+argparser.add_argument("--rounds", type=int, default=5)
+argparser.add_argument("--engine", choices=["fake", "http", "selenium"], default="fake")
+argparser.add_argument(
+    "--pool-size", type=int, default=4, help="The number of browser sessions"
+)
+argparser.add_argument(
+    "--parity",
+    action="store_true",
+    help="Check that the http engine and a browser extract the same text",
+)
+argparser.add_argument(
+    "--browser",
+    default="chrome",
+    help="The browser used by --engine selenium and --parity",
+)
+add_output_argument(argparser)
+bench_args = argparser.parse_args()
+
+directory = tempfile.mkdtemp(prefix="scrape-and-ntfy-bench-")
+setup(
+    [
+        "--db-url",
+        f"sqlite:///{directory}/bench.db",
+        "--log-level",
+        "ERROR",
+        "--path-to-toml",
+        f"{directory}/config.toml",
+    ]
+)
+connect_to_db(f"sqlite:///{directory}/bench.db")
+
+# Products on each page; a scraper watches the name or price of one of them
+PRODUCTS = 3
+# The round number, which the prices are derived from
+current_round = 0
+received = {"webhook": 0, "ntfy": 0}
+received_lock = threading.Lock()
+# Pages with the markup the http engine has to render like a browser would, and the selectors to compare on each
+# Styles aren't applied without a browser, so nothing here is hidden by CSS
+PARITY_PAGES = [
+    (
+        """<div id="a">  Hello   <b>world</b>
+        again </div>""",
+        ["#a", "#a b"],
+    ),
+    ("<ul id='b'><li>One</li><li> Two </li></ul>", ["#b", "#b li"]),
+    ("<p id='c'>Line<br>break<br><br>after</p>", ["#c"]),
+    ("<div id='d'>Shown<script>x = 1</script><style>p {}</style></div>", ["#d"]),
+    ("<p id='e'>a&nbsp;&nbsp;b &amp; c</p>", ["#e"]),
+    (
+        "<div id='f'><span>in</span><div>block</div><span>line</span><!-- comment --></div>",
+        ["#f"],
+    ),
+    (
+        "<table id='g'><tr><td>1</td><td>2</td></tr><tr><td>3</td></tr></table>",
+        ["#g", "#g td"],
+    ),
+    ("<p id='h'>Present</p>", ["#missing"]),
+]
+
+
+def render_page(page: int) -> str:
+    """
+    A product page like test.html where a third of the prices change every round
+    """
+    products = "".join(
+        f"""
+    <div class="product" id="product-{product}">
+        <h2 class="product-name">Product {product}</h2>
+        <p class="product-price">${100 * product + page + (current_round if (page + product) % 3 == 0 else 0)}</p>
+    </div>"""
+        for product in range(1, PRODUCTS + 1)
+    )
+    return f"""<!DOCTYPE html>
+<html>
+<head>
+    <title>Product Page {page}</title>
+</head>
+<body>
+    <h1>Our Products</h1>{products}
+</body>
+</html>"""
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        page = int(self.path.rsplit("/", 1)[-1])
+        if self.path.startswith("/parity/"):
+            body = f"<!DOCTYPE html><html><body>{PARITY_PAGES[page][0]}</body></html>".encode()
+        else:
+            body = render_page(page).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with received_lock:
+            received["webhook" if self.path == "/webhook" else "ntfy"] += 1
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeElement:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class FakeDriver:
+    """
+    Stands in for a browser by fetching the page over HTTP and parsing it, without running JavaScript
+    """
+
+    client = httpx.Client()
+
+    def __init__(self):
+        self.tree = None
+
+    def get(self, url: str):
+        self.tree = LexborHTMLParser(self.client.get(url).text)
+
+    def execute_script(self, script: str, *args):
+        if script == scraper_module.FIND_SCRIPT:
+            return [1000] + [self.tree.css_first(s) is not None for s in args[0]]
+        if script.startswith("return 1"):
+            return 1
+        return None
+
+    def find_element(self, by, selector: str):
+        node = self.tree.css_first(selector)
+        if node is None:
+            raise NoSuchElementException(selector)
+        return FakeElement(http_engine.visible_text(node))
+
+    def quit(self):
+        pass
+
+
+def write_config(path: str, base_url: str):
+    """
+    Generate a TOML config with a scraper per product name or price, spread over the pages
+    """
+    selectors = [
+        f"#product-{product} .product-{field}"
+        for product in range(1, PRODUCTS + 1)
+        for field in ("price", "name")
+    ]
+    scrapers = []
+    for i in range(bench_args.scrapers):
+        page = i % bench_args.pages
+        scrapers.append(
+            {
+                "name": f"Scraper {i}",
+                "url": f"{base_url}/page/{page}",
+                "css_selector": selectors[(i // bench_args.pages) % len(selectors)],
+                # Rounds are started by the benchmark instead
+                "interval": 86400,
+                "engine": "http" if bench_args.engine == "http" else "selenium",
+                "notifiers": [
+                    {
+                        "type": "webhook",
+                        "config": {
+                            "url": f"{base_url}/webhook",
+                            "notify_on": ["change", "error"],
+                        },
+                    },
+                    {
+                        "type": "ntfy",
+                        "config": {
+                            "url": f"{base_url}/ntfy/bench",
+                            "notify_on": ["numeric_up"],
+                        },
+                    },
+                ],
+            }
+        )
+    with open(path, "w") as f:
+        toml.dump({"scrapers": scrapers}, f)
+
+
+def check_parity(base_url: str) -> int:
+    """
+    Extract the same elements from the fixture pages and a few product pages with the http engine and a browser, printing where they differ
+    Returns the number of elements that differ
+    """
+    pages = [
+        (f"{base_url}/parity/{i}", selectors)
+        for i, (_, selectors) in enumerate(PARITY_PAGES)
+    ] + [
+        (
+            f"{base_url}/page/{page}",
+            [
+                f"#product-{product} .product-{field}"
+                for product in range(1, PRODUCTS + 1)
+                for field in ("price", "name")
+            ]
+            + ["#product-1"],
+        )
+        for page in range(min(3, bench_args.pages))
+    ]
+    driver = create_driver(bench_args.browser, headless=True)
+    mismatches = 0
+    try:
+        for url, selectors in pages:
+            scrapers = [
+                {
+                    "id": i,
+                    "url": url,
+                    "css_selector": selector,
+                    "pause_time": 0,
+                    "scroll_to_bottom": False,
+                }
+                for i, selector in enumerate(selectors)
+            ]
+            expected = UrlScraper.scrape_page(scrapers, driver)
+            actual = http_engine.extract(httpx.get(url).text, scrapers)
+            for selector, browser_text, http_text in zip(selectors, expected, actual):
+                if browser_text != http_text:
+                    mismatches += 1
+                    print(
+                        f"Parity mismatch for {selector} on {url}: browser {browser_text!r}, http {http_text!r}"
+                    )
+    finally:
+        driver.quit()
+    print(f"Parity: {mismatches} of {sum(len(s) for _, s in pages)} element(s) differ")
+    return mismatches
+
+
+def main():
+    global current_round
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    mismatches = check_parity(base_url) if bench_args.parity else None
+
+    if bench_args.engine == "selenium":
+        factory = lambda: create_driver(bench_args.browser, headless=True)  # noqa: E731
+    else:
+        factory = FakeDriver
+    scraper_module.driver_pool = DriverPool(factory, size=bench_args.pool_size)
+    scraper_module.dispatcher = NotificationDispatcher(max_queue_size=100_000)
+    scraper_module.dispatcher.start()
+
+    config_path = f"{directory}/config.toml"
+    write_config(config_path, base_url)
+    started = time.perf_counter()
+    load_scrapers(toml.load(config_path))
+    startup = time.perf_counter() - started
+    UrlScraper.history.ensure_table()
+    UrlScraper.state.start()
+
+    # Time each scrape from when its group starts to when its result is stored
+    latencies = []
+    scrape_scrapers = UrlScraper.scrape_scrapers
+
+    def timed_scrape_scrapers(ids, *args):
+        start = time.perf_counter()
+        scrape_scrapers(ids, *args)
+        latencies.extend([time.perf_counter() - start] * len(ids))
+
+    UrlScraper.scrape_scrapers = timed_scrape_scrapers
+
+    started = time.perf_counter()
+    for current_round in range(bench_args.rounds):
+        for id in UrlScraper.scraper_ids():
+            UrlScraper.scheduler.schedule(id, 0)
+        UrlScraper.scrape_all_urls()
+        # Wait for the round to finish (UrlScraper.shutdown() would cancel the scrapes that haven't started)
+        UrlScraper.executor.shutdown(wait=True)
+        UrlScraper.executor = None
+    elapsed = time.perf_counter() - started
+
+    UrlScraper.state.close()
+    scraper_module.dispatcher.shutdown(timeout=60)
+    scraper_module.driver_pool.quit()
+    http_engine.close_client()
+    server.shutdown()
+
+    scrapes = bench_args.rounds * bench_args.scrapers
+    results = {
+        **run_info("pipeline"),
+        "engine": bench_args.engine,
+        "scrapers": bench_args.scrapers,
+        "pages": bench_args.pages,
+        "rounds": bench_args.rounds,
+        "pool_size": bench_args.pool_size,
+        "startup_seconds": round(startup, 3),
+        "scrapes_per_second": round(scrapes / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 2) if latencies else 0,
+        "db_flushes": UrlScraper.state.flushes,
+        "db_rows_written": UrlScraper.state.rows_written,
+        "history_rows": db[UrlScraper.history.table_name].count(),
+        "notifications_sent": scraper_module.dispatcher.sent,
+        "notifications_failed": scraper_module.dispatcher.failed,
+        "notifications_received": dict(received),
+        "parity_mismatches": mismatches,
+    }
+    print_results(results)
+    append_results(bench_args.output, results)
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Microbenchmark for looking up scrapers and routing notifications as the number of scrapers grows
+Run with `pdm run python benchmarks/registry_bench.py`
+Both costs should stay flat from 10 to 10,000 scrapers
+"""
+
+import timeit
+
+from scrape_and_ntfy.__main__ import setup
+from scrape_and_ntfy.scraping import UrlScraper
+from scrape_and_ntfy.scraping import scraper as scraper_module
+from scrape_and_ntfy.scraping.notifier import Notifier
+from scrape_and_ntfy.scraping.registry import ScraperConfig
+
+# Dispatching logs every notification, which would be measured instead at the default level
+setup(["--db-url", "sqlite://", "--log-level", "ERROR"])
+
+
+class NullNotifier(Notifier):
+    """
+    A notifier that doesn't send anything
+    """
+
+    url = "null://"
+
+    def __init__(self, notify_on):
+        self.notify_on = notify_on
+
+    def notify(self, message, client=None):
+        pass
+
+
+def populate(n: int):
+    UrlScraper.scrapers.clear()
+    for id in range(n):
+        UrlScraper.scrapers[id] = ScraperConfig(
+            id=id,
+            url=f"https://example.com/{id % 100}",
+            css_selector="h1",
+            interval=60,
+            name=f"Scraper {id}",
+            notifiers=[
+                NullNotifier([Notifier.NotifyOn.CHANGE]),
+                NullNotifier([Notifier.NotifyOn.ERROR]),
+            ],
+        )
+
+
+def main():
+    # Send synchronously to NullNotifier
+    scraper_module.dispatcher = None
+    iterations = 20_000
+    print(f"{'scrapers':>10} {'lookup (ns)':>12} {'dispatch (ns)':>14}")
+    for n in (10, 100, 1_000, 10_000):
+        populate(n)
+        # Look up the last scraper, which was the worst case with a list
+        row = {"id": n - 1}
+        lookup = timeit.timeit(lambda: UrlScraper.scrapers[n - 1], number=iterations)
+        dispatch = timeit.timeit(
+            lambda: UrlScraper.send_to_all_notifiers(
+                row, "message", Notifier.NotifyOn.NUMERIC_UP
+            ),
+            number=iterations,
+        )
+        print(
+            f"{n:>10} {lookup / iterations * 1e9:>12.0f} {dispatch / iterations * 1e9:>14.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
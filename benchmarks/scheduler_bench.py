@@ -0,0 +1,130 @@
+"""
+Benchmark of the scheduler with thousands of scrapers: how late they fire and how much CPU the loop uses while waiting
+Run with `pdm run python benchmarks/scheduler_bench.py --scrapers 5000`
+--scrapers keys are scheduled with intervals spread between --min-interval and --max-interval seconds and run by the same loop as UrlScraper.run() for --duration seconds, each being scheduled again after its interval when it fires
+Then everything is scheduled an hour out and the loop is left idle for --idle seconds, which should use next to no CPU
+Exits with 1 if the 99th percentile lag is over --max-lag seconds or the idle loop used more than --max-idle-cpu of a core, so it can be run as a check
+Results are printed and appended as a JSON line to --output so runs can be compared
+"""
+
+import argparse
+import random
+import statistics
+import sys
+import threading
+import time
+
+from _common import (
+    add_output_argument,
+    append_results,
+    percentile,
+    print_results,
+    run_info,
+)
+
+from scrape_and_ntfy.scraping.scheduler import Scheduler
+
+argparser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+argparser.add_argument("--scrapers", type=int, default=5000)
+argparser.add_argument("--min-interval", type=float, default=1)
+argparser.add_argument("--max-interval", type=float, default=10)
+argparser.add_argument("--duration", type=float, default=15)
+argparser.add_argument("--idle", type=float, default=5)
+argparser.add_argument("--max-lag", type=float, default=0.05)
+argparser.add_argument("--max-idle-cpu", type=float, default=0.01)
+add_output_argument(argparser)
+bench_args = argparser.parse_args()
+
+
+def main():
+    scheduler = Scheduler()
+    intervals = {
+        id: random.uniform(bench_args.min_interval, bench_args.max_interval)
+        for id in range(bench_args.scrapers)
+    }
+    due_times = {}
+    now = time.time()
+    for id, interval in intervals.items():
+        # Spread the first runs over an interval like a restart would
+        due_times[id] = now + random.uniform(0, interval)
+        scheduler.schedule(id, due_times[id])
+
+    lags = []
+    # The times the loop woke up, whether or not anything was due
+    wakeups = 0
+    stopped = threading.Event()
+
+    def loop():
+        nonlocal wakeups
+        while not stopped.is_set():
+            # A timeout so the loop notices it was stopped while idle
+            due = scheduler.wait_until_due(timeout=1)
+            wakeups += 1
+            if not due:
+                continue
+            fired = time.time()
+            for id in scheduler.pop_due(fired):
+                lags.append(fired - due_times[id])
+                due_times[id] = fired + intervals[id]
+                scheduler.schedule(id, due_times[id])
+
+    thread = threading.Thread(target=loop, daemon=True)
+    started = time.perf_counter()
+    process_started = time.process_time()
+    thread.start()
+    time.sleep(bench_args.duration)
+    busy_cpu = time.process_time() - process_started
+    busy_elapsed = time.perf_counter() - started
+    fired = len(lags)
+    busy_wakeups = wakeups
+
+    # Nothing is due for an hour, so the loop should only wake up for its timeout
+    for id in intervals:
+        due_times[id] = time.time() + 3600
+        scheduler.schedule(id, due_times[id])
+    # Let the loop see the new schedule before measuring
+    time.sleep(0.1)
+    idle_started = wakeups
+    process_started = time.process_time()
+    time.sleep(bench_args.idle)
+    idle_cpu = (time.process_time() - process_started) / bench_args.idle
+    idle_wakeups = wakeups - idle_started
+    stopped.set()
+    thread.join()
+
+    results = {
+        **run_info("scheduler"),
+        "scrapers": bench_args.scrapers,
+        "fired": fired,
+        "fired_per_second": round(fired / busy_elapsed, 1),
+        "wakeups": busy_wakeups,
+        "p50_lag_ms": round(percentile(lags, 50) * 1000, 2),
+        "p99_lag_ms": round(percentile(lags, 99) * 1000, 2),
+        "max_lag_ms": round(max(lags, default=0) * 1000, 2),
+        "mean_lag_ms": round(statistics.fmean(lags) * 1000, 2) if lags else 0,
+        "busy_cpu_percent": round(busy_cpu / busy_elapsed * 100, 2),
+        "idle_cpu_percent": round(idle_cpu * 100, 3),
+        "idle_wakeups": idle_wakeups,
+    }
+    print_results(results)
+    append_results(bench_args.output, results)
+
+    failures = []
+    if results["p99_lag_ms"] > bench_args.max_lag * 1000:
+        failures.append(
+            f"99th percentile lag {results['p99_lag_ms']}ms is over {bench_args.max_lag * 1000:g}ms"
+        )
+    if idle_cpu > bench_args.max_idle_cpu:
+        failures.append(
+            f"Idle loop used {results['idle_cpu_percent']}% of a core (over {bench_args.max_idle_cpu * 100:g}%)"
+        )
+    # One wakeup per timeout while idle; busy-waiting would wake up thousands of times
+    if idle_wakeups > bench_args.idle + 1:
+        failures.append(f"Idle loop woke up {idle_wakeups} times")
+    for failure in failures:
+        print(failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
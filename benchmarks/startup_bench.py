@@ -0,0 +1,222 @@
+"""
+Benchmark of how long registering the scrapers takes at startup, by the number of scrapers in the config
+Run with `pdm run python benchmarks/startup_bench.py --sizes 100 1000 5000`
+For each size, a config is generated and loaded into a new SQLite database (a first start) and then loaded again (a restart, where every scraper is found in the database), followed by cleaning the database
+Each start runs in its own process, since the scrapers are registered in class attributes
+--one-at-a-time registers each scraper separately (like before scrapers were registered in bulk) for comparison
+The time from launching `python -m scrape_and_ntfy` to its first page fetch (from a local HTTP server, with the http engine) and the time taken by --check-config are also measured for each size
+Results are printed and appended as a JSON line to --output so runs can be compared
+"""
+
+import argparse
+import json
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import toml
+from _common import add_output_argument, append_results, run_info
+
+argparser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+argparser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 5000])
+argparser.add_argument("--one-at-a-time", action="store_true")
+add_output_argument(argparser)
+# Used internally to run a single start
+argparser.add_argument("--child", metavar="DIRECTORY", help=argparse.SUPPRESS)
+bench_args = argparser.parse_args()
+
+# Set by the HTTP server when the first page is fetched
+first_fetch = threading.Event()
+first_fetch_time = None
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        global first_fetch_time
+        if not first_fetch.is_set():
+            first_fetch_time = time.perf_counter()
+            first_fetch.set()
+        body = b'<p id="product-0"><span class="product-price">$100</span></p>'
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def write_config(
+    path: str,
+    size: int,
+    base_url: str = "http://127.0.0.1",
+    engine: str = "selenium",
+):
+    """
+    Generate a TOML config with size scrapers spread over 50 pages
+    """
+    scrapers = [
+        {
+            "name": f"Scraper {i}",
+            "url": f"{base_url}/page/{i % 50}",
+            "css_selector": f"#product-{i // 50} .product-price",
+            "interval": 60,
+            "engine": engine,
+            "notifiers": [
+                {
+                    "type": "webhook",
+                    "config": {
+                        "url": f"{base_url}/webhook",
+                        "notify_on": ["change", "error"],
+                    },
+                }
+            ],
+        }
+        for i in range(size)
+    ]
+    with open(path, "w") as f:
+        toml.dump({"scrapers": scrapers}, f)
+
+
+def child(directory: str):
+    """
+    Load the config in directory and print how long registering and cleaning took
+    """
+    from scrape_and_ntfy.__main__ import load_scrapers, scraper_kwargs, setup
+    from scrape_and_ntfy.scraping import UrlScraper
+    from scrape_and_ntfy.utils.db import connect_to_db
+
+    setup(
+        [
+            "--db-url",
+            f"sqlite:///{directory}/bench.db",
+            "--log-level",
+            "ERROR",
+            "--path-to-toml",
+            f"{directory}/config.toml",
+        ]
+    )
+    connect_to_db(f"sqlite:///{directory}/bench.db")
+
+    config = toml.load(f"{directory}/config.toml")
+    started = time.perf_counter()
+    if bench_args.one_at_a_time:
+        for s in config["scrapers"]:
+            UrlScraper(**scraper_kwargs(s))
+    else:
+        load_scrapers(config)
+    registered = time.perf_counter()
+    UrlScraper.clean_db()
+    cleaned = time.perf_counter()
+    print(
+        json.dumps(
+            {
+                "register_seconds": round(registered - started, 3),
+                "clean_seconds": round(cleaned - registered, 3),
+            }
+        )
+    )
+
+
+def start(directory: str) -> dict:
+    output = subprocess.run(
+        [sys.executable, __file__, "--child", directory]
+        + (["--one-at-a-time"] if bench_args.one_at_a_time else []),
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def cold_start(directory: str, size: int, base_url: str) -> dict:
+    """
+    Time --check-config and how long a new process takes to fetch its first page
+    """
+    write_config(f"{directory}/cold.toml", size, base_url, engine="http")
+    command = [
+        sys.executable,
+        "-m",
+        "scrape_and_ntfy",
+        "--db-url",
+        f"sqlite:///{directory}/cold.db",
+        "--log-level",
+        "ERROR",
+        "--path-to-toml",
+        f"{directory}/cold.toml",
+    ]
+    # Run in the temporary directory so a .env in the current directory isn't loaded
+    started = time.perf_counter()
+    subprocess.run(
+        command + ["--check-config"], cwd=directory, capture_output=True, check=True
+    )
+    check_config = time.perf_counter() - started
+
+    first_fetch.clear()
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        command,
+        cwd=directory,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        fetched = first_fetch.wait(120)
+    finally:
+        process.send_signal(signal.SIGINT)
+        try:
+            process.wait(30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+    return {
+        "check_config_seconds": round(check_config, 3),
+        "cold_start_seconds": round(first_fetch_time - started, 3) if fetched else None,
+    }
+
+
+def main():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    for size in bench_args.sizes:
+        directory = tempfile.mkdtemp(prefix="scrape-and-ntfy-startup-")
+        write_config(f"{directory}/config.toml", size)
+        first = start(directory)
+        restart = start(directory)
+        cold = cold_start(directory, size, base_url)
+        results = {
+            **run_info("startup"),
+            "mode": "one_at_a_time" if bench_args.one_at_a_time else "bulk",
+            "scrapers": size,
+            "first_start_seconds": first["register_seconds"],
+            "restart_seconds": restart["register_seconds"],
+            "clean_seconds": restart["clean_seconds"],
+            **cold,
+        }
+        print(
+            f"{size:>6} scrapers: first start {results['first_start_seconds']}s, restart {results['restart_seconds']}s, clean {results['clean_seconds']}s, "
+            f"check config {results['check_config_seconds']}s, cold start to first fetch {results['cold_start_seconds']}s"
+        )
+        append_results(bench_args.output, results)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    if bench_args.child:
+        child(bench_args.child)
+    else:
+        main()
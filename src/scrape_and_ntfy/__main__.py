@@ -1,105 +1,561 @@
-from scrape_and_ntfy.utils.logging import logger
-from scrape_and_ntfy.utils.cli_args import args
-from scrape_and_ntfy.scraping import scraper, UrlScraper
+from scrape_and_ntfy.utils.logging import logger, set_primary_logger
+from scrape_and_ntfy.utils import cli_args
+from scrape_and_ntfy.utils.db import db, connect_to_db
 from scrape_and_ntfy.scraping import notifier
-import selenium
+from scrape_and_ntfy.scraping.hosts import HostPolicy
+from scrape_and_ntfy.scraping.registry import (
+    WATCH_MAX_AGE,
+    Field,
+    check_scraper,
+    default_name,
+)
+from scrape_and_ntfy.scraping.values import ValueParser
+from scrape_and_ntfy.utils import metrics
+from typing import TYPE_CHECKING, Dict, List, Tuple
+import argparse
+import csv
+import json
+import os
+import signal
 import sys
+import threading
+import time
 import toml
 
+# The scraper (along with Selenium, httpx, and the database driver) is only imported once it's needed, so --check-config and --help start quickly
+if TYPE_CHECKING:
+    from scrape_and_ntfy.scraping.leases import LeaseManager
+
+# Set by setup()
+args: argparse.Namespace = None
+
+
+def setup(argv: List[str] = None) -> argparse.Namespace:
+    """
+    Parse the arguments and set up logging
+    Importing the package doesn't do either, so this has to be called first (main() does)
+    """
+    global args
+    args = cli_args.set_argparse(argv)
+    set_primary_logger(args.log_level)
+    return args
+
+
+def history_command():
+    """
+    List the scrapers with history or export the history of one scraper
+    """
+    from scrape_and_ntfy.scraping.scraper import UrlScraper
+
+    history = UrlScraper.history
+    history.ensure_table()
+    if args.scraper is None:
+        for row in db["scrapers"]:
+            count = db[history.table_name].count(scraper_id=row["id"])
+            print(f"{row['id']}\t{row['name']}\t{count} entries")
+        return 0
+    if args.scraper.isdigit():
+        row = db["scrapers"].find_one(id=int(args.scraper))
+    else:
+        row = db["scrapers"].find_one(name=args.scraper)
+    if row is None:
+        logger.critical(f"Scraper {args.scraper} not found")
+        return 1
+    output = sys.stdout if args.output == "-" else open(args.output, "w", newline="")
+    try:
+        count = history.export(
+            row["id"],
+            output,
+            format=args.format,
+            since=args.since.timestamp() if args.since else None,
+            until=args.until.timestamp() if args.until else None,
+            limit=args.limit,
+        )
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    logger.info(f"Exported {count} entries for {row['name']}")
+    return 0
+
+
+def replay_command():
+    """
+    Run the scrapers in the config against the stored snapshots of their pages and write what they found and would have notified
+    """
+    from scrape_and_ntfy.scraping.replay import ReplayScraper
+    from scrape_and_ntfy.scraping.snapshots import SnapshotStore
+
+    if not args.snapshot_dir:
+        logger.critical("Set --snapshot-dir to the directory the snapshots are in")
+        return 1
+    try:
+        config = toml.load(args.path_to_toml)
+    except (OSError, toml.TomlDecodeError) as e:
+        logger.critical(f"Couldn't load {args.path_to_toml}: {e}")
+        return 1
+    errors = config_errors(config)
+    for error in errors:
+        logger.critical(error)
+    if errors:
+        return 1
+    scrapers = [
+        s
+        for s in config["scrapers"]
+        if args.scraper is None or args.scraper in (scraper_key(s)[2], s["url"])
+    ]
+    if not scrapers:
+        logger.critical(f"Scraper {args.scraper} not found")
+        return 1
+    ReplayScraper.load(
+        [ReplayScraper(**scraper_kwargs(s), register=False) for s in scrapers]
+    )
+    started = time.perf_counter()
+    count = 0
+    writer = None
+    output = sys.stdout if args.output == "-" else open(args.output, "w", newline="")
+    try:
+        for entry in ReplayScraper.replay(
+            SnapshotStore(args.snapshot_dir),
+            since=args.since.timestamp() if args.since else None,
+            until=args.until.timestamp() if args.until else None,
+        ):
+            if args.changes_only and entry["event"] == "no_change":
+                continue
+            entry = {
+                "time": entry["time"],
+                "iso_time": time.strftime(
+                    "%Y-%m-%dT%H:%M:%S", time.localtime(entry["time"])
+                ),
+                **{k: v for k, v in entry.items() if k != "time"},
+            }
+            if args.format == "json":
+                output.write(json.dumps(entry) + "\n")
+            else:
+                if writer is None:
+                    writer = csv.DictWriter(output, fieldnames=list(entry.keys()))
+                    writer.writeheader()
+                writer.writerow(entry)
+            count += 1
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    logger.info(
+        f"Replayed {len(scrapers)} scraper(s) in {time.perf_counter() - started:.2f}s; {count} result(s)"
+    )
+    return 0
+
+
+# The scrapers table of the config last loaded, keyed by what identifies each scraper, for diffing when reloading
+loaded_scrapers: Dict[Tuple[str, str, str], dict] = {}
+
+
+def scraper_key(s: dict) -> Tuple[str, str, str]:
+    """
+    Get what identifies a scraper in the config: its URL, CSS selector, and name
+    """
+    css_selector = s.get("css_selector", "")
+    return (
+        s["url"],
+        css_selector,
+        s.get("name") or default_name(s["url"], css_selector),
+    )
+
+
+def scraper_kwargs(s: dict) -> dict:
+    """
+    Build the arguments to UrlScraper (including the notifiers) for a scraper in the config
+    """
+    notifiers = []
+    for n in s["notifiers"]:
+        # Check if the notify_on values are valid (check against Notifier.NotifyOn)
+        notify_on_list = []
+        # for notify_on in n["config"]["notify_on"]:
+        for notify_on in n["config"].get("notify_on", []):
+            if notify_on not in [no.value for no in list(notifier.Notifier.NotifyOn)]:
+                raise ValueError(f"Invalid notify_on value: {notify_on}")
+            else:
+                # Get the Enum object from the string value
+                notify_on_list.append(notifier.Notifier.NotifyOn(notify_on))
+        if n["type"] == "webhook":
+            notifiers.append(
+                notifier.Webhook(
+                    url=n["config"]["url"],
+                    content_field=n["config"].get("content_field", "content"),
+                    notify_on=notify_on_list,
+                    batch_window=n["config"].get("batch_window", 0),
+                    batch_max=n["config"].get("batch_max", 10),
+                )
+            )
+        elif n["type"] == "ntfy":
+            notifiers.append(
+                notifier.Ntfy(
+                    url=n["config"]["url"],
+                    notify_on=notify_on_list,
+                    on_click=n["config"].get("on_click", None),
+                    priority=n["config"].get("priority", None),
+                    tags=n["config"].get("tags", None),
+                    batch_window=n["config"].get("batch_window", 0),
+                    batch_max=n["config"].get("batch_max", 10),
+                )
+            )
+    return dict(
+        url=s["url"],
+        css_selector=s.get("css_selector", ""),
+        interval=s.get("interval", 60),
+        name=s.get("name", None),
+        pause_time=s.get("pause_time", 0),
+        notifiers=notifiers,
+        scroll_to_bottom=s.get("scroll_to_bottom", False),
+        engine=s.get("engine", "selenium"),
+        skip_unchanged=s.get("skip_unchanged", None),
+        max_scrolls=s.get("max_scrolls", 50),
+        lean=s.get("lean", args.lean),
+        backoff=s.get("backoff", False),
+        stretch=s.get("stretch", False),
+        jitter=s.get("jitter", 0),
+        min_interval=s.get("min_interval", None),
+        max_interval=s.get("max_interval", None),
+        decimal=s.get("decimal", None),
+        locale=s.get("locale", None),
+        pattern=s.get("pattern", None),
+        above=s.get("above", None),
+        below=s.get("below", None),
+        change_percent=s.get("change_percent", None),
+        watch=s.get("watch", False),
+        max_age=s.get("max_age", WATCH_MAX_AGE),
+        # Each field is either a CSS selector or a table with css_selector and optionally attribute, property, and all
+        fields=[
+            Field(name=name, css_selector=f)
+            if isinstance(f, str)
+            else Field(name=name, **f)
+            for name, f in s.get("fields", {}).items()
+        ],
+    )
+
+
+def config_errors(config: dict) -> List[str]:
+    """
+    Check everything in the parsed TOML config that would stop it from loading, without connecting to the database or starting a browser
+    """
+    if not config.get("scrapers"):
+        return ["No scrapers are configured"]
+    errors = []
+    keys = set()
+    for i, s in enumerate(config["scrapers"], 1):
+        label = f"Scraper {i} ({s.get('name') or s.get('url', 'no URL')})"
+        try:
+            kwargs = scraper_kwargs(s)
+            check_scraper(
+                kwargs["url"],
+                kwargs["css_selector"],
+                kwargs["engine"],
+                kwargs["fields"],
+                kwargs["watch"],
+            )
+            ValueParser(
+                decimal=kwargs["decimal"],
+                locale=kwargs["locale"],
+                pattern=kwargs["pattern"],
+            )
+        except KeyError as e:
+            errors.append(f"{label}: missing {e}")
+            continue
+        except (TypeError, ValueError) as e:
+            errors.append(f"{label}: {e}")
+            continue
+        key = scraper_key(s)
+        if key in keys:
+            errors.append(
+                f"{label}: has the same url, css_selector, and name as another scraper"
+            )
+        keys.add(key)
+    for host, policy in config.get("hosts", {}).items():
+        try:
+            HostPolicy(**policy)
+        except TypeError as e:
+            errors.append(f"Host {host}: {e}")
+    return errors
+
+
+def check_config() -> int:
+    """
+    Parse and validate the TOML config for --check-config
+    """
+    try:
+        config = toml.load(args.path_to_toml)
+    except (OSError, toml.TomlDecodeError) as e:
+        logger.critical(f"Couldn't load {args.path_to_toml}: {e}")
+        return 1
+    errors = config_errors(config)
+    for error in errors:
+        logger.error(error)
+    if errors:
+        return 1
+    logger.info(f"{args.path_to_toml} is valid ({len(config['scrapers'])} scrapers)")
+    return 0
+
+
+def load_scrapers(config: dict):
+    """
+    Create a UrlScraper (and its notifiers) for each scraper in the parsed TOML config
+    """
+    from scrape_and_ntfy.scraping.scraper import UrlScraper
+
+    UrlScraper.register(
+        [UrlScraper(**scraper_kwargs(s), register=False) for s in config["scrapers"]]
+    )
+    for s in config["scrapers"]:
+        loaded_scrapers[scraper_key(s)] = s
+
+
+def reload_config(leases: "LeaseManager" = None):
+    """
+    Load the TOML config again and only apply what changed: scrapers are added, removed, or updated in place, keeping the browser sessions and the state and schedule of every other scraper
+    If the config is invalid, the current one is kept
+    """
+    from scrape_and_ntfy.scraping.scraper import UrlScraper
+
+    try:
+        config = toml.load(args.path_to_toml)
+    except (OSError, toml.TomlDecodeError) as e:
+        logger.error(
+            f"Not reloading {args.path_to_toml}; keeping the current config: {e}"
+        )
+        return
+    # Check everything first so nothing is applied if any of it is invalid
+    errors = config_errors(config)
+    if errors:
+        logger.error(
+            f"Not reloading {args.path_to_toml}; keeping the current config: {'; '.join(errors)}"
+        )
+        return
+    scrapers = {scraper_key(s): s for s in config["scrapers"]}
+    added = [key for key in scrapers if key not in loaded_scrapers]
+    changed = [
+        key
+        for key in scrapers
+        if key in loaded_scrapers and scrapers[key] != loaded_scrapers[key]
+    ]
+    kwargs = {key: scraper_kwargs(scrapers[key]) for key in added + changed}
+    removed = [key for key in loaded_scrapers if key not in scrapers]
+    UrlScraper.register(
+        [UrlScraper(**kwargs[key], register=False) for key in added + changed]
+    )
+    for key in removed:
+        id = UrlScraper.find(*key)
+        if id is not None:
+            # Workers leave the database to the coordinator, like with clean_db()
+            UrlScraper.remove(id, delete=args.role != "worker" and not args.no_clean_db)
+    loaded_scrapers.clear()
+    loaded_scrapers.update(scrapers)
+    UrlScraper.hosts.configure(config.get("hosts", {}))
+    if leases is not None:
+        leases.register(UrlScraper.scraper_ids())
+    logger.info(
+        f"Reloaded {args.path_to_toml}: {len(added)} added, {len(changed)} changed, {len(removed)} removed"
+    )
+
+
+def watch_config(leases: "LeaseManager" = None, interval: float = 5):
+    """
+    Reload the config when the file changes (checked every interval seconds; 0 to only reload on SIGHUP) or the process gets SIGHUP
+    """
+    reload_requested = threading.Event()
+    if hasattr(signal, "SIGHUP"):
+        # Only set a flag; reloading in the signal handler could deadlock on locks held by the main thread
+        signal.signal(signal.SIGHUP, lambda signum, frame: reload_requested.set())
+
+    def watch():
+        try:
+            last_modified = os.path.getmtime(args.path_to_toml)
+        except OSError:
+            last_modified = None
+        while True:
+            requested = reload_requested.wait(interval or None)
+            reload_requested.clear()
+            try:
+                modified = os.path.getmtime(args.path_to_toml)
+            except OSError:
+                continue
+            if requested or modified != last_modified:
+                last_modified = modified
+                try:
+                    reload_config(leases)
+                except Exception:
+                    logger.exception(f"Failed to reload {args.path_to_toml}")
+
+    threading.Thread(target=watch, name="config-watcher", daemon=True).start()
+
+
+def collect_metrics(m: metrics.Metrics):
+    """
+    Set the gauges and counters that are read from the dispatcher, browser sessions, and scraper state
+    """
+    from scrape_and_ntfy.scraping import scraper
+    from scrape_and_ntfy.scraping.scraper import UrlScraper
+
+    if scraper.dispatcher is not None:
+        m.set("notification_queue_depth", scraper.dispatcher._queue.qsize())
+        m.set("notifications_dropped_total", scraper.dispatcher.dropped)
+    m.set(
+        "browser_restarts_total",
+        sum(p.restarts for p in scraper.driver_pools.values())
+        + sum(t.restarts for t in scraper.watched_tabs.values()),
+    )
+    m.set(
+        "browser_recycles_total", sum(p.recycles for p in scraper.driver_pools.values())
+    )
+    m.set("watched_tabs", sum(len(t) for t in scraper.watched_tabs.values()))
+    m.set("state_flushes_total", UrlScraper.state.flushes)
+    for host, depth in UrlScraper.hosts.depths().items():
+        m.set("host_queue_depth", depth, host=host)
+    for host, active in UrlScraper.hosts.active().items():
+        m.set("host_active_fetches", active, host=host)
+
 
 def main():
+    setup()
     logger.debug(f"Args: {args}")
+    if args.check_config:
+        sys.exit(check_config())
+    if args.command == "history":
+        connect_to_db(args.db_url)
+        sys.exit(history_command())
+    if args.command == "replay":
+        connect_to_db(args.db_url)
+        sys.exit(replay_command())
     try:
         config = toml.load(args.path_to_toml)
     except FileNotFoundError:
         logger.critical(f"File {args.path_to_toml} not found")
         sys.exit(1)
-    if args.browser == "chrome" or args.browser == "chromium":
-        options = selenium.webdriver.ChromeOptions()
-        if args.headless:
-            # If headless_path is set, use the binary at that path
-            logger.info("Using Chrome headless")
-            options.add_argument("--headless")
-        else:
-            logger.info("Not using headlessly")
-        options.binary_location = args.browser_path if args.browser_path else ""
-        scraper.driver = selenium.webdriver.Chrome(options=options)
-    elif args.browser == "firefox":
-        options = selenium.webdriver.FirefoxOptions()
-        if args.headless:
-            # If headless_path is set, use the binary at that path
-            logger.info("Using Firefox headless")
-            options.add_argument("--headless")
-        else:
-            logger.info("Not using headlessly")
-        options.binary_location = args.browser_path if args.browser_path else ""
-        scraper.driver = selenium.webdriver.Firefox(options=options)
-    elif args.browser == "edge":
-        options = selenium.webdriver.EdgeOptions()
-        logger.info("Using Edge")
-        options.binary_location = args.browser_path if args.browser_path else ""
-        scraper.driver = selenium.webdriver.Edge(options=options)
-    elif args.browser == "safari":
-        logger.info("Using Safari")
-        options = selenium.webdriver.SafariOptions()
-        # options.binary_location = args.browser_path if args.browser_path else ""
-        scraper.driver = selenium.webdriver.Safari(options=options)
-    else:
-        raise ValueError("Invalid browser")
+    errors = config_errors(config)
+    for error in errors:
+        logger.critical(error)
+    if errors:
+        sys.exit(1)
 
-    for s in config["scrapers"]:
-        notifiers = []
-        for n in s["notifiers"]:
-            # Check if the notify_on values are valid (check against Notifier.NotifyOn)
-            notify_on_list = []
-            # for notify_on in n["config"]["notify_on"]:
-            for notify_on in n["config"].get("notify_on", []):
-                if notify_on not in [
-                    no.value for no in list(notifier.Notifier.NotifyOn)
-                ]:
-                    raise ValueError(f"Invalid notify_on value: {notify_on}")
-                else:
-                    # Get the Enum object from the string value
-                    notify_on_list.append(notifier.Notifier.NotifyOn(notify_on))
-            if n["type"] == "webhook":
-                notifiers.append(
-                    notifier.Webhook(
-                        url=n["config"]["url"],
-                        content_field=n["config"].get("content_field", "content"),
-                        notify_on=notify_on_list,
-                    )
-                )
-            elif n["type"] == "ntfy":
-                notifiers.append(
-                    notifier.Ntfy(
-                        url=n["config"]["url"],
-                        notify_on=notify_on_list,
-                        on_click=n["config"].get("on_click", None),
-                        priority=n["config"].get("priority", None),
-                        tags=n["config"].get("tags", None),
-                    )
-                )
-        UrlScraper(
-            url=s["url"],
-            css_selector=s["css_selector"],
-            interval=s.get("interval", 60),
-            name=s.get("name", None),
-            pause_time=s.get("pause_time", 0),
-            notifiers=notifiers,
-            scroll_to_bottom=s.get("scroll_to_bottom", False),
+    from scrape_and_ntfy.scraping import http_engine, scraper
+    from scrape_and_ntfy.scraping.browser import (
+        DriverPool,
+        WatchedTabs,
+        blocked_urls,
+        create_driver,
+    )
+    from scrape_and_ntfy.scraping.dispatcher import NotificationDispatcher
+    from scrape_and_ntfy.scraping.leases import LeaseManager
+    from scrape_and_ntfy.scraping.scraper import UrlScraper
+
+    connect_to_db(args.db_url)
+    block_hosts = [host.strip() for host in args.block_hosts.split(",") if host.strip()]
+    # Lean and regular sessions share --pool-size, so scrapers overriding lean don't start more browsers
+    scraper.driver_pools = DriverPool.group(
+        {
+            lean: lambda lean=lean: create_driver(
+                args.browser,
+                args.browser_path,
+                args.headless,
+                lean=lean,
+                block_hosts=block_hosts,
+            )
+            for lean in (True, False)
+        },
+        size=args.pool_size,
+        max_loads=args.recycle_after,
+        # Megabytes to bytes
+        max_rss=int(args.max_browser_memory * 1024 * 1024),
+    )
+    scraper.driver_pool = scraper.driver_pools[args.lean]
+    # Scrapers with watch get a session of their own, with a tab per page, so their tabs aren't navigated away by other scrapers
+    scraper.watched_tabs = {
+        lean: WatchedTabs(
+            lambda lean=lean: create_driver(
+                args.browser,
+                args.browser_path,
+                args.headless,
+                lean=lean,
+                block_hosts=block_hosts,
+                background_tabs=True,
+            ),
+            blocked_urls=blocked_urls(args.browser, lean, block_hosts),
         )
-    if args.no_clean_db:
+        for lean in (True, False)
+    }
+    # Sessions are started when the first scraper that needs one is due, so configs with only http scrapers never start a browser
+    logger.info(
+        f"Using up to {args.pool_size} {'lean ' if args.lean else ''}browser session(s), started on demand"
+    )
+    scraper.dispatcher = NotificationDispatcher(
+        max_queue_size=args.notify_queue_size,
+        overflow=args.notify_overflow,
+        max_retries=args.notify_retries,
+    )
+    scraper.dispatcher.start()
+
+    load_scrapers(config)
+    UrlScraper.hosts.configure(config.get("hosts", {}))
+    leases = None
+    if args.role != "standalone":
+        leases = LeaseManager(args.worker_id, ttl=args.lease_ttl)
+        leases.ensure_tables()
+    if args.role == "worker":
+        # Other workers may be running with a different config while it's being rolled out
+        logger.info("Not cleaning the database (only the coordinator does)")
+    elif args.no_clean_db:
         logger.info("Not cleaning the database")
     else:
         logger.info("Cleaning the database")
         UrlScraper.clean_db()
+        if leases is not None:
+            leases.clean(UrlScraper.scraper_ids())
+    UrlScraper.state.flush_interval = args.flush_interval
+    UrlScraper.state.flush_threshold = args.flush_threshold
+    UrlScraper.state.write_through = args.write_through
+    UrlScraper.history.ensure_table()
+    if args.snapshot_dir:
+        logger.info(f"Saving snapshots of the scraped pages to {args.snapshot_dir}")
+        UrlScraper.snapshots.directory = args.snapshot_dir
+        UrlScraper.snapshots.ensure_table()
+        # Every process prunes, since each may have a snapshot directory of its own
+        UrlScraper.snapshots.start_pruning(retention=args.snapshot_retention * 86400)
+    UrlScraper.state.start()
+    if args.role != "worker":
+        # Days and hours to seconds
+        UrlScraper.history.start_compaction(
+            retention=args.history_retention * 86400,
+            downsample_after=args.history_downsample_after * 86400,
+            downsample_bucket=args.history_downsample_bucket * 3600,
+        )
+    if args.metrics_port:
+        metrics.metrics.add_collector(collect_metrics)
+        metrics.serve(args.metrics_host, args.metrics_port)
+    if leases is not None:
+        logger.info(f"Sharing scrapers with other processes as {args.worker_id}")
+        UrlScraper.use_leases(leases)
+        leases.start()
+    watch_config(leases, interval=args.reload_interval)
+    # docker stop (and most process managers) send SIGTERM, which should save the state like Ctrl+C does
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     logger.info("Starting to scrape")
     try:
-        while True:
-            UrlScraper.scrape_all_urls()
+        UrlScraper.run()
     except (KeyboardInterrupt, SystemExit):
+        # Don't let another SIGTERM cut the shutdown short
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
         logger.info("Interrupt detected; exiting")
-        scraper.driver.quit()
+        UrlScraper.shutdown()
+        logger.info("Saving scraper state")
+        UrlScraper.state.close()
+        if leases is not None:
+            # Let the other workers take over right away
+            leases.stop()
+        for pool in scraper.driver_pools.values():
+            pool.quit()
+        for tabs in scraper.watched_tabs.values():
+            tabs.quit()
+        http_engine.close_client()
+        logger.info("Sending queued notifications")
+        scraper.dispatcher.shutdown(timeout=args.notify_drain_timeout)
         exit(0)
 
 
@@ -1,2 +1,15 @@
-from scrape_and_ntfy.scraping.scraper import UrlScraper as UrlScraper, driver as driver
-from scrape_and_ntfy.scraping.notifier import Webhook as Webhook, Notifier as Notifier
+# Imported when first used so importing the package (e.g. for the config) doesn't load Selenium or the database
+_EXPORTS = {
+    "UrlScraper": "scrape_and_ntfy.scraping.scraper",
+    "driver_pool": "scrape_and_ntfy.scraping.scraper",
+    "Webhook": "scrape_and_ntfy.scraping.notifier",
+    "Notifier": "scrape_and_ntfy.scraping.notifier",
+}
+
+
+def __getattr__(name: str):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    import importlib
+
+    return getattr(importlib.import_module(_EXPORTS[name]), name)
@@ -0,0 +1,574 @@
+import os
+import queue
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Callable, Dict, Hashable, List, Optional
+
+# The browser-specific parts of selenium.webdriver are only imported when a session is started
+import selenium.webdriver
+from selenium.common.exceptions import NoSuchWindowException, WebDriverException
+
+if TYPE_CHECKING:
+    from selenium.webdriver.remote.webdriver import WebDriver
+
+from scrape_and_ntfy.utils.logging import logger
+
+
+# URL patterns of fonts and media, which aren't needed to read text
+LEAN_BLOCKED_URLS = [
+    f"*.{extension}*"
+    for extension in "woff woff2 ttf otf eot mp4 webm ogg ogv mp3 wav m4a m3u8".split()
+]
+# Command-line switches that turn off Chromium features a scraper doesn't need
+LEAN_CHROMIUM_ARGUMENTS = [
+    "--blink-settings=imagesEnabled=false",
+    "--disable-extensions",
+    "--disable-background-networking",
+    "--disable-component-update",
+    "--disable-default-apps",
+    "--disable-sync",
+    "--no-first-run",
+    "--mute-audio",
+    "--autoplay-policy=user-gesture-required",
+]
+# Preferences that do the same for Firefox
+LEAN_FIREFOX_PREFERENCES = {
+    # 2 blocks images
+    "permissions.default.image": 2,
+    # Don't download web fonts
+    "browser.display.use_document_fonts": 0,
+    "gfx.downloadable_fonts.enabled": False,
+    # 5 blocks audio and video autoplay
+    "media.autoplay.default": 5,
+    "media.autoplay.blocking_policy": 2,
+    "browser.shell.checkDefaultBrowser": False,
+    "app.update.enabled": False,
+    "extensions.update.enabled": False,
+    "datareporting.healthreport.uploadEnabled": False,
+    "toolkit.telemetry.enabled": False,
+}
+# Command-line switches that keep Chromium from throttling tabs in the background, so watched pages keep updating
+BACKGROUND_TAB_CHROMIUM_ARGUMENTS = [
+    "--disable-background-timer-throttling",
+    "--disable-backgrounding-occluded-windows",
+    "--disable-renderer-backgrounding",
+]
+# Preferences that do the same for Firefox
+BACKGROUND_TAB_FIREFOX_PREFERENCES = {
+    "dom.min_background_timeout_value": 4,
+    "dom.timeout.enable_budget_timer_throttling": False,
+}
+
+
+def host_patterns(hosts: List[str]) -> List[str]:
+    """
+    Turn host names (e.g. "doubleclick.net") into URL patterns matching the host and its subdomains
+    Anything that already looks like a pattern (contains "*" or "/") is used as-is
+    """
+    patterns = []
+    for host in hosts:
+        if "*" in host or "/" in host:
+            patterns.append(host)
+        else:
+            patterns += [f"*://{host}/*", f"*://*.{host}/*"]
+    return patterns
+
+
+def lean_chromium_options(options):
+    """
+    Add the lean settings to ChromeOptions or EdgeOptions
+    """
+    options.page_load_strategy = "eager"
+    for argument in LEAN_CHROMIUM_ARGUMENTS:
+        options.add_argument(argument)
+    options.add_experimental_option(
+        "prefs", {"profile.managed_default_content_settings.images": 2}
+    )
+    return options
+
+
+def block_urls(driver, patterns: List[str]):
+    """
+    Block requests to URLs matching patterns in the current tab of a Chromium session
+    """
+    driver.execute_cdp_cmd("Network.enable", {})
+    driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": patterns})
+
+
+def blocked_urls(browser: str, lean: bool, block_hosts: List[str] = []) -> List[str]:
+    """
+    Get the URL patterns that create_driver() blocks in a session, which is nothing unless it's lean and Chromium-based
+    """
+    if lean and browser in ("chrome", "chromium", "edge"):
+        return LEAN_BLOCKED_URLS + host_patterns(block_hosts)
+    return []
+
+
+def create_driver(
+    browser: str,
+    browser_path: str = "",
+    headless: bool = False,
+    lean: bool = False,
+    block_hosts: List[str] = [],
+    background_tabs: bool = False,
+):
+    """
+    Start a WebDriver session for the specified browser
+    If lean is True, images, fonts, and media aren't loaded, unneeded browser features are turned off, and pages are considered loaded once the DOM is ready (the "eager" page load strategy)
+    Requests to block_hosts are also blocked in lean sessions, though only Chromium-based browsers support this
+    If background_tabs is True, tabs that aren't in the foreground aren't throttled (for WatchedTabs); Safari has no setting for this
+    """
+    if browser == "chrome" or browser == "chromium":
+        options = selenium.webdriver.ChromeOptions()
+        if headless:
+            # If headless_path is set, use the binary at that path
+            logger.info("Using Chrome headless")
+            options.add_argument("--headless")
+        else:
+            logger.info("Not using headlessly")
+        options.binary_location = browser_path if browser_path else ""
+        if lean:
+            lean_chromium_options(options)
+        if background_tabs:
+            for argument in BACKGROUND_TAB_CHROMIUM_ARGUMENTS:
+                options.add_argument(argument)
+        driver = selenium.webdriver.Chrome(options=options)
+        if lean:
+            block_urls(driver, blocked_urls(browser, lean, block_hosts))
+        return driver
+    elif browser == "firefox":
+        options = selenium.webdriver.FirefoxOptions()
+        if headless:
+            # If headless_path is set, use the binary at that path
+            logger.info("Using Firefox headless")
+            options.add_argument("--headless")
+        else:
+            logger.info("Not using headlessly")
+        options.binary_location = browser_path if browser_path else ""
+        if lean:
+            options.page_load_strategy = "eager"
+            for name, value in LEAN_FIREFOX_PREFERENCES.items():
+                options.set_preference(name, value)
+            if block_hosts:
+                logger.warning("Blocking hosts is not supported in Firefox")
+        if background_tabs:
+            for name, value in BACKGROUND_TAB_FIREFOX_PREFERENCES.items():
+                options.set_preference(name, value)
+        return selenium.webdriver.Firefox(options=options)
+    elif browser == "edge":
+        options = selenium.webdriver.EdgeOptions()
+        logger.info("Using Edge")
+        options.binary_location = browser_path if browser_path else ""
+        if lean:
+            lean_chromium_options(options)
+        if background_tabs:
+            for argument in BACKGROUND_TAB_CHROMIUM_ARGUMENTS:
+                options.add_argument(argument)
+        driver = selenium.webdriver.Edge(options=options)
+        if lean:
+            block_urls(driver, blocked_urls(browser, lean, block_hosts))
+        return driver
+    elif browser == "safari":
+        logger.info("Using Safari")
+        options = selenium.webdriver.SafariOptions()
+        # options.binary_location = browser_path if browser_path else ""
+        if lean:
+            # Safari has no options for blocking content
+            options.page_load_strategy = "eager"
+        return selenium.webdriver.Safari(options=options)
+    else:
+        raise ValueError("Invalid browser")
+
+
+def process_tree_rss(pid: int) -> Optional[int]:
+    """
+    Get the resident memory in bytes of a process and all of its descendants (e.g. a WebDriver and the browser it started)
+    Returns None if it can't be read, which is always the case outside of Linux
+    """
+    children: Dict[int, List[int]] = {}
+    rss: Dict[int, int] = {}
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        return None
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                stat = f.read()
+        except OSError:
+            # The process exited
+            continue
+        # The command name is in parentheses and can contain spaces, so split after it
+        fields = stat[stat.rindex(")") + 2 :].split()
+        children.setdefault(int(fields[1]), []).append(int(entry))
+        rss[int(entry)] = int(fields[21]) * os.sysconf("SC_PAGE_SIZE")
+    if pid not in rss:
+        return None
+    total = 0
+    stack = [pid]
+    while stack:
+        current = stack.pop()
+        total += rss.get(current, 0)
+        stack += children.get(current, [])
+    return total
+
+
+def driver_rss(driver: "WebDriver") -> Optional[int]:
+    """
+    Get the resident memory in bytes of a session's WebDriver and browser processes, or None if it can't be read
+    """
+    try:
+        pid = driver.service.process.pid
+    except AttributeError:
+        return None
+    return process_tree_rss(pid)
+
+
+class DriverPool:
+    """
+    A fixed-size pool of WebDriver sessions shared by the scraping threads
+    Sessions are started by factory when needed (or up-front with fill()) and handed out one thread at a time
+    Browsers leak memory over time, so a session is replaced after max_loads uses or once its processes use more than max_rss bytes (0 for no limit)
+    Sessions are checked before being handed out, and a session that has crashed is quit and replaced the next time one is needed
+    Pools created together with group() share their size, so they don't run more than size sessions between them
+    """
+
+    def __init__(
+        self,
+        factory: Callable[[], "WebDriver"],
+        size: int = 1,
+        max_loads: int = 0,
+        max_rss: int = 0,
+        slots: threading.BoundedSemaphore = None,
+    ):
+        if size < 1:
+            raise ValueError("The pool size must be at least 1")
+        self.size = size
+        self.max_loads = max_loads
+        self.max_rss = max_rss
+        self._factory = factory
+        # LIFO so the most recently used (and probably warmest) session is reused first
+        self._idle = queue.LifoQueue()
+        self._slots = slots if slots is not None else threading.BoundedSemaphore(size)
+        # The pools sharing the slots (including this one)
+        self._group: List["DriverPool"] = [self]
+        self._drivers: List["WebDriver"] = []
+        # Map of id(driver) to the number of times the session has been used
+        self._loads: Dict[int, int] = {}
+        self._lock = threading.Lock()
+        self.restarts = 0
+        self.recycles = 0
+
+    @classmethod
+    def group(
+        cls,
+        factories: Dict[Hashable, Callable[[], "WebDriver"]],
+        size: int = 1,
+        max_loads: int = 0,
+        max_rss: int = 0,
+    ) -> Dict[Hashable, "DriverPool"]:
+        """
+        Create a pool for each factory (e.g. for lean and regular sessions) that together lend out and run at most size sessions
+        When a pool needs a new session and the group already has size, an idle session of another pool is quit to make room
+        """
+        slots = threading.BoundedSemaphore(size)
+        pools = {
+            key: cls(factory, size, max_loads=max_loads, max_rss=max_rss, slots=slots)
+            for key, factory in factories.items()
+        }
+        for pool in pools.values():
+            pool._group = list(pools.values())
+        return pools
+
+    def _make_room(self):
+        """
+        Quit an idle session of another pool in the group if the group is already running size sessions
+        """
+        if sum(len(pool._drivers) for pool in self._group) < self.size:
+            return
+        for pool in self._group:
+            if pool is self:
+                continue
+            try:
+                driver = pool._idle.get_nowait()
+            except queue.Empty:
+                continue
+            logger.debug("Quitting an idle browser session to make room for another")
+            pool._discard(driver)
+            return
+
+    def _start_driver(self) -> "WebDriver":
+        driver = self._factory()
+        with self._lock:
+            self._drivers.append(driver)
+            self._loads[id(driver)] = 0
+        logger.debug(f"Started browser session {len(self._drivers)}/{self.size}")
+        return driver
+
+    def _discard(self, driver: "WebDriver"):
+        """
+        Quit a session and forget about it so a new one is started in its place
+        """
+        with self._lock:
+            if driver in self._drivers:
+                self._drivers.remove(driver)
+            self._loads.pop(id(driver), None)
+        try:
+            driver.quit()
+        except Exception as e:
+            logger.debug(f"Failed to quit browser session: {e}")
+
+    @staticmethod
+    def is_alive(driver: "WebDriver") -> bool:
+        """
+        Check that a session still responds with a cheap round trip to the browser
+        """
+        try:
+            driver.execute_script("return 1;")
+            return True
+        except WebDriverException:
+            return False
+
+    def needs_recycling(self, driver: "WebDriver") -> bool:
+        """
+        Check if a session has been used too many times or is using too much memory
+        """
+        loads = self._loads.get(id(driver), 0)
+        if self.max_loads and loads >= self.max_loads:
+            logger.debug(f"Recycling browser session after {loads} page loads")
+            return True
+        if self.max_rss:
+            rss = driver_rss(driver)
+            if rss is not None and rss > self.max_rss:
+                logger.debug(
+                    f"Recycling browser session using {rss / 1024 / 1024:.0f} MB of memory"
+                )
+                return True
+        return False
+
+    def fill(self):
+        """
+        Start any sessions that haven't been started yet
+        """
+        while len(self._drivers) < self.size:
+            self._idle.put(self._start_driver())
+
+    def _checkout(self) -> "WebDriver":
+        """
+        Get an idle session that responds, or start a new one
+        """
+        while True:
+            try:
+                driver = self._idle.get_nowait()
+            except queue.Empty:
+                self._make_room()
+                return self._start_driver()
+            if self.is_alive(driver):
+                return driver
+            logger.warning("Browser session stopped responding; restarting it")
+            self.restarts += 1
+            self._discard(driver)
+
+    @contextmanager
+    def acquire(self):
+        """
+        Borrow a session, blocking until one is free
+        If a WebDriverException is raised while it is borrowed and the session no longer responds, it is replaced; the exception is re-raised either way
+        """
+        with self._slots:
+            driver = self._checkout()
+            try:
+                yield driver
+            except WebDriverException:
+                # Errors like a stale element don't mean the session is broken
+                if self.is_alive(driver):
+                    self._idle.put(driver)
+                else:
+                    logger.warning("Browser session failed; restarting it")
+                    self.restarts += 1
+                    self._discard(driver)
+                raise
+            except BaseException:
+                self._idle.put(driver)
+                raise
+            with self._lock:
+                self._loads[id(driver)] = self._loads.get(id(driver), 0) + 1
+            if self.needs_recycling(driver):
+                self.recycles += 1
+                self._discard(driver)
+            else:
+                self._idle.put(driver)
+
+    def quit(self):
+        """
+        Quit every session that was started
+        """
+        with self._lock:
+            drivers, self._drivers = self._drivers, []
+            self._loads = {}
+            self._idle = queue.LifoQueue()
+        for driver in drivers:
+            try:
+                driver.quit()
+            except Exception as e:
+                logger.warning(f"Failed to quit browser session: {e}")
+
+
+@dataclass(slots=True)
+class Tab:
+    """
+    A tab kept open by WatchedTabs
+    """
+
+    url: str
+    driver: "WebDriver"
+    handle: str
+    # When the page was last loaded (by time.monotonic()), or None if it hasn't been yet
+    loaded: float = None
+
+
+class WatchedTabs:
+    """
+    A browser session that keeps a tab open on each watched URL, so pages that update themselves don't have to be reloaded to be scraped
+    The session is started by factory when the first tab is needed and replaced (losing its tabs) if it fails
+    Only one thread uses the session at a time, since switching tabs applies to the whole session; each use is meant to be a single step (e.g. a script call) so other tabs can be used in between
+    blocked_urls are blocked in each tab that's opened, since the session only blocks them in its first tab
+    """
+
+    def __init__(
+        self, factory: Callable[[], "WebDriver"], blocked_urls: List[str] = []
+    ):
+        self._factory = factory
+        self.blocked_urls = blocked_urls
+        self._driver: "WebDriver" = None
+        # Map of URL to its tab
+        self._tabs: Dict[str, Tab] = {}
+        # A window that no tab is using, since a session always has at least one
+        self._spare: Optional[str] = None
+        # The handle of the tab the session is switched to, so using the same tab again doesn't switch
+        self._current: Optional[str] = None
+        self._lock = threading.Lock()
+        self.restarts = 0
+
+    def __len__(self) -> int:
+        return len(self._tabs)
+
+    def _discard(self):
+        """
+        Quit the session so a new one is started the next time a tab is needed
+        """
+        driver, self._driver = self._driver, None
+        self._tabs = {}
+        self._spare = None
+        self._current = None
+        try:
+            driver.quit()
+        except Exception as e:
+            logger.debug(f"Failed to quit browser session: {e}")
+
+    @contextmanager
+    def _replacing_failed_session(self):
+        """
+        Replace the session if a WebDriverException is raised and it no longer responds; the exception is re-raised either way
+        The lock must be held by the caller
+        """
+        try:
+            yield
+        except WebDriverException:
+            # Errors like a stale element don't mean the session is broken
+            if self._driver is not None and not DriverPool.is_alive(self._driver):
+                logger.warning(
+                    "Browser session for watched pages failed; restarting it"
+                )
+                self.restarts += 1
+                self._discard()
+            raise
+
+    def _switch(self, tab: Tab):
+        """
+        Switch the session to tab, forgetting it and raising NoSuchWindowException if it was closed by the page itself
+        The lock must be held by the caller
+        """
+        if self._current == tab.handle:
+            return
+        try:
+            self._driver.switch_to.window(tab.handle)
+        except NoSuchWindowException:
+            self._tabs.pop(tab.url, None)
+            self._current = None
+            raise
+        self._current = tab.handle
+
+    def open(self, url: str) -> Tab:
+        """
+        Get the tab for url, opening one (and starting the session) if there isn't one or it was closed
+        """
+        with self._lock, self._replacing_failed_session():
+            if self._driver is None:
+                self._driver = self._factory()
+                self._spare = self._current = self._driver.current_window_handle
+                logger.debug("Started browser session for watched pages")
+            tab = self._tabs.get(url)
+            if tab is not None:
+                try:
+                    self._switch(tab)
+                    return tab
+                except NoSuchWindowException:
+                    # Closed by the page itself
+                    pass
+            if self._spare is not None:
+                handle, self._spare = self._spare, None
+                self._driver.switch_to.window(handle)
+            else:
+                self._driver.switch_to.new_window("tab")
+                handle = self._driver.current_window_handle
+                if self.blocked_urls:
+                    block_urls(self._driver, self.blocked_urls)
+            self._current = handle
+            tab = self._tabs[url] = Tab(url, self._driver, handle)
+            return tab
+
+    @contextmanager
+    def use(self, tab: Tab):
+        """
+        Switch to tab and use its session, blocking while another thread is using the session
+        Raises NoSuchWindowException if the tab was closed (by close(), the page itself, or the session being replaced) since it was opened
+        """
+        with self._lock:
+            if self._tabs.get(tab.url) is not tab:
+                raise NoSuchWindowException(f"The tab for {tab.url} was closed")
+            self._switch(tab)
+            with self._replacing_failed_session():
+                yield tab.driver
+
+    def close(self, url: str):
+        """
+        Close the tab for url, if there is one
+        """
+        with self._lock:
+            tab = self._tabs.pop(url, None)
+            if tab is None or self._driver is None:
+                return
+            try:
+                self._driver.switch_to.window(tab.handle)
+                self._current = tab.handle
+                if self._tabs or self._spare is not None:
+                    self._driver.close()
+                    self._current = None
+                else:
+                    # Closing the last window would end the session
+                    self._driver.get("about:blank")
+                    self._spare = tab.handle
+            except WebDriverException as e:
+                logger.debug(f"Failed to close the tab for {url}: {e}")
+
+    def quit(self):
+        """
+        Quit the session, if it was started
+        """
+        with self._lock:
+            if self._driver is not None:
+                self._discard()
@@ -0,0 +1,73 @@
+import threading
+from typing import Callable, List
+
+from scrape_and_ntfy.utils.db import db
+from scrape_and_ntfy.utils.logging import logger
+
+
+class BufferedTable:
+    """
+    An append-only table whose new entries are buffered and written by ScraperState in the same transaction as the scraper rows
+    Subclasses create the table in ensure_table(), which should be called before scraping starts since changing the schema inside the flush's transaction isn't safe
+    """
+
+    def __init__(self, table_name: str):
+        self.table_name = table_name
+        self._pending: List[dict] = []
+        self._ensured = False
+        self._lock = threading.Lock()
+        self._thread: threading.Thread = None
+        self._stopped = threading.Event()
+
+    def ensure_table(self):
+        raise NotImplementedError
+
+    def _buffer(self, entry: dict):
+        with self._lock:
+            self._pending.append(entry)
+
+    def take_pending(self) -> List[dict]:
+        """
+        Remove and return the buffered entries
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+            return pending
+
+    def restore_pending(self, entries: List[dict]):
+        """
+        Put entries that failed to be written back in front of the buffer
+        """
+        with self._lock:
+            self._pending[:0] = entries
+
+    def write(self, entries: List[dict]):
+        """
+        Insert entries (should be called inside a transaction)
+        """
+        if entries:
+            if not self._ensured:
+                self.ensure_table()
+            # Table.insert_many() doesn't use the connection for this thread, so execute on it directly
+            table = db[self.table_name].table
+            db.executable.execute(table.insert(), entries)
+
+    def _start_periodically(self, task: Callable[[], None], every: float, name: str):
+        """
+        Run task now and then every `every` seconds in a background thread named name, logging (rather than raising) its errors
+        """
+
+        def run():
+            while not self._stopped.is_set():
+                try:
+                    task()
+                except Exception:
+                    logger.exception(f"Failed to run {name}")
+                self._stopped.wait(every)
+
+        self._stopped.clear()
+        self._thread = threading.Thread(target=run, name=name, daemon=True)
+        self._thread.start()
+
+    def _stop_periodically(self):
+        self._stopped.set()
@@ -0,0 +1,282 @@
+import heapq
+import itertools
+import queue
+import threading
+import time
+from typing import TYPE_CHECKING, Dict, List, Literal, Tuple
+from urllib.parse import urlsplit
+
+from scrape_and_ntfy.scraping.notifier import Notifier
+from scrape_and_ntfy.utils.logging import logger
+from scrape_and_ntfy.utils.metrics import metrics
+
+if TYPE_CHECKING:
+    import httpx
+
+# Put on the queue to tell a worker to stop
+_STOP = object()
+
+
+class NotificationDispatcher:
+    """
+    Send notifications from background worker threads so slow or unreachable endpoints don't hold up scraping
+    Each host gets its own keep-alive httpx.Client, failed sends are retried with exponential backoff, and the queue is bounded
+    Messages for notifiers with a batch_window are collected per endpoint and sent as one request, with duplicates dropped
+    """
+
+    # What to do when the queue is full:
+    # "drop_newest" discards the notification being submitted, "drop_oldest" discards the oldest queued notification, and "block" waits for space
+    OVERFLOW_POLICIES = ["drop_newest", "drop_oldest", "block"]
+
+    def __init__(
+        self,
+        max_queue_size: int = 1000,
+        overflow: Literal["drop_newest", "drop_oldest", "block"] = "drop_oldest",
+        max_retries: int = 3,
+        backoff: float = 1.0,
+        max_backoff: float = 60.0,
+        timeout: float = 10.0,
+        workers: int = 1,
+    ):
+        """
+        Set max_retries to the number of times a failed notification is retried; the nth retry waits backoff * 2^(n-1) seconds (up to max_backoff)
+        With more than one worker, notifications may be sent out of order
+        """
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError(f"Invalid overflow policy: {overflow}")
+        self.overflow = overflow
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.workers = workers
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        # Heap of (due, counter, notifier, message, attempt) for notifications waiting to be retried
+        self._retries: List[Tuple[float, int, Notifier, str, int]] = []
+        self._counter = itertools.count()
+        self._retries_lock = threading.Lock()
+        self._clients: Dict[Tuple[str, str, int], "httpx.Client"] = {}
+        self._clients_lock = threading.Lock()
+        # Map of batch key to the batch of messages waiting for its window to end
+        self._batches: Dict[tuple, dict] = {}
+        self._batches_lock = threading.Lock()
+        self._threads: List[threading.Thread] = []
+        self._closed = False
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.deduplicated = 0
+
+    def start(self):
+        """
+        Start the worker threads
+        """
+        for i in range(self.workers):
+            # Daemon threads so a hung endpoint can't keep the process alive after shutdown() times out
+            thread = threading.Thread(
+                target=self._work, name=f"notifier-{i}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def client_for(self, url: str) -> "httpx.Client":
+        """
+        Get the keep-alive client for the host of url, creating it if needed
+        """
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        with self._clients_lock:
+            client = self._clients.get(key)
+            if client is None:
+                import httpx
+
+                client = httpx.Client(timeout=self.timeout)
+                self._clients[key] = client
+            return client
+
+    def submit(self, notifier: Notifier, message: str) -> bool:
+        """
+        Queue a notification without waiting for it to be sent
+        Returns False if the notification was dropped
+        """
+        if self._closed:
+            logger.warning(f"Dispatcher is shut down; dropping notification: {message}")
+            self.dropped += 1
+            return False
+        if notifier.batch_window > 0:
+            return self._add_to_batch(notifier, message)
+        return self._enqueue(notifier, message)
+
+    def _add_to_batch(self, notifier: Notifier, message: str) -> bool:
+        """
+        Add a message to the batch for the notifier's endpoint, starting the batch window if this is the first message
+        The batch is sent when the window ends or it reaches batch_max messages
+        """
+        key = notifier.batch_key()
+        with self._batches_lock:
+            batch = self._batches.get(key)
+            if batch is None:
+                # The first notifier in a batch decides its window and size
+                batch = {"notifier": notifier, "messages": []}
+                batch["timer"] = threading.Timer(
+                    notifier.batch_window, self._flush_batch, args=(key, batch)
+                )
+                batch["timer"].daemon = True
+                batch["timer"].start()
+                self._batches[key] = batch
+            if message in batch["messages"]:
+                logger.debug(f"Dropping duplicate notification: {message}")
+                self.deduplicated += 1
+                return True
+            batch["messages"].append(message)
+            full = len(batch["messages"]) >= batch["notifier"].batch_max
+        if full:
+            self._flush_batch(key, batch)
+        return True
+
+    def _flush_batch(self, key: tuple, batch: dict):
+        """
+        Queue the messages in a batch as one notification
+        """
+        with self._batches_lock:
+            # The batch may have already been sent because it filled up before its window ended
+            if self._batches.get(key) is not batch:
+                return
+            del self._batches[key]
+        batch["timer"].cancel()
+        messages = batch["messages"]
+        if len(messages) > 1:
+            logger.debug(f"Sending {len(messages)} notifications as one")
+        self._enqueue(batch["notifier"], "\n".join(messages))
+
+    def _enqueue(self, notifier: Notifier, message: str) -> bool:
+        """
+        Put a notification on the queue, applying the overflow policy if it is full
+        """
+        job = (notifier, message, 0)
+        if self.overflow == "block":
+            self._queue.put(job)
+            return True
+        try:
+            self._queue.put_nowait(job)
+            return True
+        except queue.Full:
+            pass
+        if self.overflow == "drop_newest":
+            logger.warning(f"Notification queue full; dropping notification: {message}")
+            self.dropped += 1
+            return False
+        # drop_oldest
+        while True:
+            try:
+                dropped = self._queue.get_nowait()
+            except queue.Empty:
+                pass
+            else:
+                self._queue.task_done()
+                if dropped is _STOP:
+                    # Never drop a stop signal
+                    self._queue.put(dropped)
+                    continue
+                logger.warning(
+                    f"Notification queue full; dropping oldest notification: {dropped[1]}"
+                )
+                self.dropped += 1
+            try:
+                self._queue.put_nowait(job)
+                return True
+            except queue.Full:
+                continue
+
+    def _next_retry(self) -> Tuple[float, tuple]:
+        """
+        Pop the next retry if it is due, otherwise return how long until it is (or None if there are no retries)
+        """
+        with self._retries_lock:
+            if not self._retries:
+                return None, None
+            delay = self._retries[0][0] - time.monotonic()
+            if delay > 0:
+                return delay, None
+            _, _, notifier, message, attempt = heapq.heappop(self._retries)
+            return 0, (notifier, message, attempt)
+
+    def _work(self):
+        stopping = False
+        while True:
+            delay, job = self._next_retry()
+            if job is None:
+                if stopping:
+                    if delay is None:
+                        return
+                    time.sleep(delay)
+                    continue
+                try:
+                    job = self._queue.get(timeout=delay)
+                except queue.Empty:
+                    continue
+                self._queue.task_done()
+                if job is _STOP:
+                    stopping = True
+                    continue
+            self._send(*job)
+
+    def _send(self, notifier: Notifier, message: str, attempt: int):
+        host = urlsplit(notifier.url).hostname
+        try:
+            with metrics.time("notify_seconds", host=host):
+                notifier.notify(message, client=self.client_for(notifier.url))
+        except Exception as e:
+            metrics.inc("notification_failures_total", host=host)
+            if attempt >= self.max_retries:
+                logger.error(
+                    f"Giving up on notifying {notifier.url} after {attempt + 1} attempt(s): {e}"
+                )
+                self.failed += 1
+                return
+            delay = min(self.backoff * 2**attempt, self.max_backoff)
+            logger.warning(
+                f"Failed to notify {notifier.url} ({e}); retrying in {delay} seconds"
+            )
+            with self._retries_lock:
+                heapq.heappush(
+                    self._retries,
+                    (
+                        time.monotonic() + delay,
+                        next(self._counter),
+                        notifier,
+                        message,
+                        attempt + 1,
+                    ),
+                )
+        else:
+            self.sent += 1
+
+    def shutdown(self, timeout: float = None):
+        """
+        Stop accepting notifications and wait (up to timeout seconds) for the queued notifications and retries to be sent
+        """
+        self._closed = True
+        # Send any batches that are still waiting for their window to end
+        with self._batches_lock:
+            batches = list(self._batches.items())
+        for key, batch in batches:
+            self._flush_batch(key, batch)
+        for _ in self._threads:
+            self._queue.put(_STOP)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(
+                None if deadline is None else max(0, deadline - time.monotonic())
+            )
+        if any(thread.is_alive() for thread in self._threads):
+            logger.warning("Timed out waiting for notifications to be sent")
+        else:
+            logger.debug(
+                f"Notifications drained ({self.sent} sent, {self.failed} failed, {self.dropped} dropped, {self.deduplicated} deduplicated)"
+            )
+        self._threads = []
+        with self._clients_lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients = {}
@@ -0,0 +1,179 @@
+import csv
+import json
+import time
+from typing import Iterator, List, Optional, TextIO
+
+from sqlalchemy import Integer, cast, func, select
+
+from scrape_and_ntfy.scraping.buffered import BufferedTable
+from scrape_and_ntfy.utils.db import db, delete_ids
+from scrape_and_ntfy.utils.logging import logger
+
+
+class HistoryStore(BufferedTable):
+    """
+    Append-only history of the values each scraper has seen
+    Only changes are recorded, along with the value parsed as a number (if it is one), and lookups by (scraper_id, time) are indexed
+    New entries are buffered and written by ScraperState in the same transaction as the scraper rows
+    """
+
+    def __init__(self, table_name: str = "history"):
+        super().__init__(table_name)
+
+    def ensure_table(self):
+        """
+        Create the history table and its index if they don't exist
+        """
+        table = db.create_table(self.table_name, primary_id="id")
+        table.create_column("scraper_id", db.types.integer)
+        table.create_column("time", db.types.float)
+        table.create_column("data", db.types.text)
+        table.create_column("value", db.types.float)
+        table.create_index(["scraper_id", "time"])
+        self._ensured = True
+        return table
+
+    def record(self, scraper_id: int, timestamp: float, data: str, value: float = None):
+        """
+        Buffer a new value until ScraperState writes it
+        """
+        self._buffer(
+            {
+                "scraper_id": scraper_id,
+                "time": timestamp,
+                "data": data,
+                "value": value,
+            }
+        )
+
+    def query(
+        self,
+        scraper_id: int,
+        since: float = None,
+        until: float = None,
+        limit: int = None,
+    ) -> Iterator[dict]:
+        """
+        Yield the history of a scraper in chronological order, optionally limited to a time range
+        Rows are streamed rather than loaded into memory all at once
+        """
+        table = db[self.table_name].table
+        stmt = select(table).where(table.c.scraper_id == scraper_id)
+        if since is not None:
+            stmt = stmt.where(table.c.time >= since)
+        if until is not None:
+            stmt = stmt.where(table.c.time < until)
+        stmt = stmt.order_by(table.c.time)
+        if limit is not None:
+            stmt = stmt.limit(limit)
+        for row in db.query(stmt, _step=1000):
+            yield row
+
+    def export(
+        self,
+        scraper_id: int,
+        output: TextIO,
+        format: str = "csv",
+        since: float = None,
+        until: float = None,
+        limit: int = None,
+    ) -> int:
+        """
+        Write the history of a scraper to output as CSV or JSON lines and return the number of entries written
+        """
+        count = 0
+        writer = None
+        for row in self.query(scraper_id, since=since, until=until, limit=limit):
+            entry = {
+                "time": row["time"],
+                "iso_time": time.strftime(
+                    "%Y-%m-%dT%H:%M:%S", time.localtime(row["time"])
+                ),
+                "data": row["data"],
+                "value": row["value"],
+            }
+            if format == "json":
+                output.write(json.dumps(entry) + "\n")
+            else:
+                if writer is None:
+                    writer = csv.DictWriter(output, fieldnames=list(entry.keys()))
+                    writer.writeheader()
+                writer.writerow(entry)
+            count += 1
+        return count
+
+    def delete_scraper(self, scraper_id: int):
+        """
+        Delete the history of a scraper
+        """
+        if self.table_name in db:
+            db[self.table_name].delete(scraper_id=scraper_id)
+
+    def delete_scrapers(self, scraper_ids: List[int]):
+        """
+        Delete the history of several scrapers with one statement
+        """
+        if self.table_name in db:
+            table = db[self.table_name].table
+            db.executable.execute(
+                table.delete().where(table.c.scraper_id.in_(scraper_ids))
+            )
+
+    def compact(
+        self,
+        retention: Optional[float] = None,
+        downsample_after: Optional[float] = None,
+        downsample_bucket: float = 3600,
+        now: float = None,
+    ):
+        """
+        Delete entries older than retention seconds, and for entries older than downsample_after seconds only keep the latest entry per downsample_bucket seconds
+        """
+        if now is None:
+            now = time.time()
+        table = db[self.table_name].table
+        deleted = 0
+        with db:
+            if retention:
+                result = db.executable.execute(
+                    table.delete().where(table.c.time < now - retention)
+                )
+                deleted += result.rowcount
+            if downsample_after:
+                cutoff = now - downsample_after
+                keep = (
+                    select(func.max(table.c.id))
+                    .where(table.c.time < cutoff)
+                    .group_by(
+                        table.c.scraper_id,
+                        cast(table.c.time / downsample_bucket, Integer),
+                    )
+                )
+                # Selected first since MySQL can't delete from a table it's selecting from
+                stale = [
+                    row["id"]
+                    for row in db.query(
+                        select(table.c.id).where(
+                            table.c.time < cutoff, table.c.id.not_in(keep)
+                        )
+                    )
+                ]
+                deleted += delete_ids(table, stale)
+        if deleted:
+            logger.info(f"Compacted history; deleted {deleted} entries")
+
+    def start_compaction(self, every: float = 3600, **kwargs):
+        """
+        Run compact() (with kwargs) now and then every `every` seconds in the background
+        """
+        if not (kwargs.get("retention") or kwargs.get("downsample_after")):
+            return
+        self._start_periodically(
+            lambda: self.compact(**kwargs), every, "history-compaction"
+        )
+
+    def stop_compaction(self):
+        """
+        Stop compacting in the background
+        """
+        self._stop_periodically()
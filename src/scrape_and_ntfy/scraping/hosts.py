@@ -0,0 +1,191 @@
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+
+from scrape_and_ntfy.utils.metrics import metrics
+
+# Policy name that applies to hosts without a policy of their own
+DEFAULT_POLICY = "*"
+
+
+@dataclass(slots=True)
+class HostPolicy:
+    """
+    Limits on fetching pages from a host (and its subdomains)
+    0 means no limit
+    """
+
+    # The maximum number of pages fetched at once
+    max_concurrent: int = 0
+    # The minimum number of seconds between the start of two fetches
+    min_spacing: float = 0
+    # The average number of fetches per second, allowing bursts of up to burst fetches
+    rate: float = 0
+    burst: int = 1
+
+
+@dataclass(slots=True)
+class _HostState:
+    active: int = 0
+    last_start: float = None
+    tokens: float = None
+    last_refill: float = None
+    # Map of scraper ID to when it was first held back
+    deferred: Dict[int, float] = field(default_factory=dict)
+    # Whether any of the deferred scrapers are waiting for a fetch to finish rather than for a time
+    waiting_for_release: bool = False
+
+
+class HostLimiter:
+    """
+    Enforces a HostPolicy for each host without blocking
+    try_acquire() either takes a slot for a fetch or says how long until one might be free, so the caller can run other hosts' scrapers in the meantime
+    Subdomains share the limits of the closest parent domain with a policy (e.g. a policy for example.com covers www.example.com), while hosts covered by the default policy are limited separately
+    """
+
+    def __init__(
+        self,
+        policies: Dict[str, HostPolicy] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.policies: Dict[str, HostPolicy] = policies or {}
+        self._clock = clock
+        self._states: Dict[str, _HostState] = {}
+        # Map of host to the keys its fetches in progress took their slots under, so each slot is given back to the same key even if the policies change in the meantime
+        self._acquired: Dict[str, List[str]] = {}
+        self._lock = threading.Lock()
+
+    def configure(self, hosts: dict):
+        """
+        Set the policies from the hosts table of the TOML config, which maps each host (or "*") to its policy
+        Hosts that are no longer limited the same way are forgotten once their fetches in progress are done
+        """
+        policies = {
+            host.lower(): HostPolicy(**policy) for host, policy in hosts.items()
+        }
+        with self._lock:
+            self.policies = policies
+            for key in [key for key in self._states if self._stale(key)]:
+                if not self._states[key].active:
+                    del self._states[key]
+
+    def key_for(self, host: str) -> Optional[str]:
+        """
+        Get the name limits are tracked under for host, or None if it has no policy
+        """
+        host = (host or "").lower()
+        parts = host.split(".")
+        for i in range(len(parts)):
+            domain = ".".join(parts[i:])
+            if domain in self.policies:
+                return domain
+        if DEFAULT_POLICY in self.policies:
+            return host
+        return None
+
+    def _stale(self, key: str) -> bool:
+        """
+        Check if limits are no longer tracked under key (e.g. its policy was removed)
+        """
+        return self.key_for(key) != key
+
+    def _policy(self, key: str) -> HostPolicy:
+        return self.policies.get(key) or self.policies[DEFAULT_POLICY]
+
+    def try_acquire(self, host: str, ids: List[int]) -> Optional[float]:
+        """
+        Take a slot to fetch a page from host for the scrapers with IDs ids
+        Returns 0 if the slot was taken (release() must be called once the fetch is done)
+        Otherwise the scrapers are recorded as held back, and this returns the number of seconds until they should be tried again,
+        or None if they have to wait for another fetch to finish (they are returned by the release() for it)
+        """
+        key = self.key_for(host)
+        if key is None:
+            return 0
+        policy = self._policy(key)
+        now = self._clock()
+        with self._lock:
+            state = self._states.setdefault(key, _HostState())
+            if policy.rate:
+                if state.tokens is None:
+                    state.tokens = policy.burst
+                else:
+                    state.tokens = min(
+                        policy.burst,
+                        state.tokens + (now - state.last_refill) * policy.rate,
+                    )
+                state.last_refill = now
+            delay = 0
+            if policy.max_concurrent and state.active >= policy.max_concurrent:
+                delay = None
+            else:
+                if policy.min_spacing and state.last_start is not None:
+                    delay = max(delay, state.last_start + policy.min_spacing - now)
+                if policy.rate and state.tokens < 1:
+                    delay = max(delay, (1 - state.tokens) / policy.rate)
+            if delay is None or delay > 0:
+                for id in ids:
+                    state.deferred.setdefault(id, now)
+                if delay is None:
+                    state.waiting_for_release = True
+                metrics.inc("host_throttled_total", host=key)
+                return delay
+            state.active += 1
+            self._acquired.setdefault(host, []).append(key)
+            state.last_start = now
+            if policy.rate:
+                state.tokens -= 1
+            waited = [
+                now - state.deferred.pop(id) for id in ids if id in state.deferred
+            ]
+        for seconds in waited:
+            metrics.observe("host_wait_seconds", seconds, host=key)
+        return 0
+
+    def release(self, host: str) -> List[int]:
+        """
+        Give back the slot taken by try_acquire()
+        Returns the IDs of scrapers that were waiting for it, which should be scheduled again
+        """
+        with self._lock:
+            keys = self._acquired.get(host)
+            if not keys:
+                # The host had no policy when the slot was taken
+                return []
+            key = keys.pop()
+            if not keys:
+                del self._acquired[host]
+            state = self._states.get(key)
+            if state is None:
+                return []
+            state.active = max(0, state.active - 1)
+            waiting = list(state.deferred) if state.waiting_for_release else []
+            state.waiting_for_release = False
+            if self._stale(key) and not state.active:
+                # Its policy was removed or changed; the scrapers held back by it are limited by the current policies from now on
+                del self._states[key]
+            return waiting
+
+    def forget(self, ids: List[int]):
+        """
+        Stop counting scrapers as held back (e.g. they were removed or another worker took them over)
+        """
+        with self._lock:
+            for state in self._states.values():
+                for id in ids:
+                    state.deferred.pop(id, None)
+
+    def depths(self) -> Dict[str, int]:
+        """
+        Get the number of scrapers held back for each host
+        """
+        with self._lock:
+            return {key: len(state.deferred) for key, state in self._states.items()}
+
+    def active(self) -> Dict[str, int]:
+        """
+        Get the number of fetches in progress for each host
+        """
+        with self._lock:
+            return {key: state.active for key, state in self._states.items()}
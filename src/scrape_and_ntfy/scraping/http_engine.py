@@ -0,0 +1,216 @@
+from typing import TYPE_CHECKING, Dict, List, Optional, OrderedDict, Tuple
+import hashlib
+import re
+import threading
+
+from selectolax.lexbor import LexborHTMLParser, LexborNode
+
+from scrape_and_ntfy.scraping.registry import Field, encode_fields
+from scrape_and_ntfy.utils.logging import logger
+from scrape_and_ntfy.utils.metrics import metrics
+
+# httpx is only imported once a page is fetched
+if TYPE_CHECKING:
+    import httpx
+
+# Shared between the scraping threads so connections are kept alive and reused
+client: "httpx.Client" = None
+_client_lock = threading.Lock()
+
+# Elements that start on a new line when rendered
+# https://developer.mozilla.org/en-US/docs/Glossary/Block-level_content
+BLOCK_TAGS = set(
+    "address article aside blockquote body dd details dialog div dl dt fieldset "
+    "figcaption figure footer form h1 h2 h3 h4 h5 h6 header hgroup hr html li main "
+    "nav ol p pre section summary table tr ul".split()
+)
+# Table cells, which are separated from the cell before them by a space
+CELL_TAGS = {"td", "th"}
+# Elements whose contents are never rendered
+HIDDEN_TAGS = set("head script style template noscript title meta link".split())
+
+_WHITESPACE = re.compile(r"[ \t\r\n\f]+")
+
+
+def get_client() -> "httpx.Client":
+    """
+    Get the shared HTTP client, creating it if needed
+    """
+    import httpx
+
+    global client
+    with _client_lock:
+        if client is None:
+            client = httpx.Client(
+                follow_redirects=True,
+                timeout=30,
+                headers={"User-Agent": "scrape-and-ntfy"},
+                limits=httpx.Limits(max_keepalive_connections=20),
+            )
+        return client
+
+
+def close_client():
+    """
+    Close the shared HTTP client, if one was created
+    """
+    global client
+    with _client_lock:
+        if client is not None:
+            client.close()
+            client = None
+
+
+def visible_text(node: LexborNode) -> str:
+    """
+    Approximate Selenium's WebElement.text for a parsed element
+    Whitespace is collapsed, block-level elements (including table rows) and <br> start new lines, table cells are separated by a space, hidden elements are skipped, and each line is trimmed
+    """
+    lines = [""]
+
+    def walk(n: LexborNode):
+        for child in n.iter(include_text=True):
+            if child.tag == "-text":
+                lines[-1] += child.text(deep=False)
+            elif child.tag == "br":
+                lines.append("")
+            elif child.tag in HIDDEN_TAGS or child.tag == "-comment":
+                continue
+            elif child.tag in CELL_TAGS:
+                if lines[-1] and not lines[-1][-1].isspace():
+                    lines[-1] += " "
+                walk(child)
+            elif child.tag in BLOCK_TAGS:
+                lines.append("")
+                walk(child)
+                lines.append("")
+            else:
+                walk(child)
+
+    walk(node)
+    # Non-breaking spaces are rendered as regular spaces but aren't collapsed
+    lines = [_WHITESPACE.sub(" ", line).replace("\xa0", " ").strip() for line in lines]
+    return "\n".join(line for line in lines if line)
+
+
+def select_text(tree: LexborHTMLParser, css_selector: str) -> Optional[str]:
+    """
+    Get the text of the first element matching css_selector, or None if nothing matches
+    """
+    element = tree.css_first(css_selector)
+    if element is None:
+        return None
+    return visible_text(element)
+
+
+def read_property(node: LexborNode, name: str) -> Optional[str]:
+    """
+    Approximate reading a DOM property of a parsed element
+    Properties that reflect an attribute (e.g. value, href) are read from the attribute since there's no DOM
+    """
+    if name == "innerText":
+        return visible_text(node)
+    if name == "textContent":
+        return node.text(deep=True)
+    if name == "innerHTML":
+        return node.inner_html
+    if name == "outerHTML":
+        return node.html
+    return node.attributes.get(name)
+
+
+def read_node(node: LexborNode, field: Field) -> Optional[str]:
+    """
+    Read the attribute, property, or (by default) text of an element for a field
+    """
+    if field.attribute:
+        return node.attributes.get(field.attribute)
+    if field.property:
+        return read_property(node, field.property)
+    return visible_text(node)
+
+
+def select_fields(tree: LexborHTMLParser, fields: List[Field]) -> Optional[str]:
+    """
+    Extract every field and encode them for storage, or return None if none of them were found
+    A field with all set is a list of the values of every matching element
+    """
+    values: Dict[str, object] = {}
+    for field in fields:
+        if field.all:
+            values[field.name] = [
+                read_node(node, field) for node in tree.css(field.css_selector)
+            ] or None
+        else:
+            node = tree.css_first(field.css_selector)
+            values[field.name] = None if node is None else read_node(node, field)
+    return encode_fields(values)
+
+
+def fetch(url: str) -> Optional["httpx.Response"]:
+    """
+    Get a page, or None (after logging a warning) if it couldn't be fetched
+    """
+    import httpx
+
+    try:
+        with metrics.time("stage_seconds", stage="fetch"):
+            resp = get_client().get(url)
+        resp.raise_for_status()
+    except httpx.HTTPError as e:
+        logger.warning(f"Failed to fetch {url}: {e}")
+        return None
+    return resp
+
+
+def extract(
+    html: str, scrapers: List[OrderedDict], fields: List[List[Field]] = None
+) -> List[Optional[str]]:
+    """
+    Parse html once and find each scraper's element on it
+    If fields is set, it has the fields of each scraper (in the same order as scrapers); scrapers with fields get their encoded values instead of the text of their element
+    """
+    if fields is None:
+        fields = [None] * len(scrapers)
+    with metrics.time("stage_seconds", stage="parse"):
+        tree = LexborHTMLParser(html)
+        return [
+            select_fields(tree, scraper_fields)
+            if scraper_fields
+            else select_text(tree, scraper["css_selector"])
+            for scraper, scraper_fields in zip(scrapers, fields)
+        ]
+
+
+def fingerprint(content: bytes) -> str:
+    """
+    Hash the body of a page so an unchanged page can be recognized even if the server doesn't send validators
+    """
+    return hashlib.sha256(content).hexdigest()
+
+
+def conditional_get(url: str, validators: dict) -> Tuple["httpx.Response", bool, dict]:
+    """
+    Fetch url, sending the stored ETag and Last-Modified (if any) so the server can reply with 304 Not Modified
+    validators is a dict of etag, last_modified, and content_hash from the last fetch
+    Returns the response, whether the page is unchanged (a 304 or the same content hash), and the validators to store
+    """
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    resp = get_client().get(url, headers=headers)
+    if resp.status_code == 304:
+        return resp, True, validators
+    resp.raise_for_status()
+    new_validators = {
+        "etag": resp.headers.get("ETag"),
+        "last_modified": resp.headers.get("Last-Modified"),
+        "content_hash": fingerprint(resp.content),
+    }
+    unchanged = (
+        validators.get("content_hash") is not None
+        and new_validators["content_hash"] == validators["content_hash"]
+    )
+    return resp, unchanged, new_validators
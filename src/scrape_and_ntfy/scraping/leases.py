@@ -0,0 +1,262 @@
+import math
+import threading
+import time
+from typing import Callable, Iterable, List, Set
+
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
+
+from scrape_and_ntfy.utils.db import db, delete_ids
+from scrape_and_ntfy.utils.logging import logger
+
+
+class LeaseManager:
+    """
+    Split the scrapers between several processes sharing one database
+    Each worker records a heartbeat in the workers table and holds time-limited leases on its share of the scrapers in the leases table, renewing them while it's alive.
+    A worker only claims up to its fair share (the number of scrapers divided by the number of live workers, rounded up) and releases any extra when another worker joins.
+    The leases of a worker that stops renewing them expire after ttl seconds and are taken over by the others.
+    """
+
+    def __init__(
+        self,
+        worker_id: str,
+        ttl: float = 30,
+        table_name: str = "leases",
+        workers_table_name: str = "workers",
+    ):
+        self.worker_id = worker_id
+        self.ttl = ttl
+        self.table_name = table_name
+        self.workers_table_name = workers_table_name
+        # Called with the ID of each scraper this worker claims, e.g. to load its latest state
+        self.on_claim: Callable[[int], None] = None
+        # Called with the IDs of scrapers before this worker releases them (or once it finds it lost them), e.g. to write their state
+        self.on_release: Callable[[List[int]], None] = None
+        self._scraper_ids: Set[int] = set()
+        self._owned: Set[int] = set()
+        self._lock = threading.Lock()
+        self._thread: threading.Thread = None
+        self._stopped = threading.Event()
+
+    def ensure_tables(self):
+        """
+        Create the leases and workers tables if they don't exist
+        """
+        leases = db.create_table(self.table_name, primary_id="id")
+        leases.create_column("scraper_id", db.types.integer)
+        leases.create_column("worker", db.types.text)
+        leases.create_column("expires", db.types.float)
+        # Only one lease per scraper, even if several workers create them at once
+        leases.create_index(["scraper_id"], unique=True)
+        workers = db.create_table(self.workers_table_name, primary_id="id")
+        workers.create_column("worker", db.types.text)
+        workers.create_column("heartbeat", db.types.float)
+        workers.create_index(["worker"], unique=True)
+
+    def register(self, scraper_ids: Iterable[int]):
+        """
+        Set the scrapers to share and create an (expired) lease for any that don't have one
+        """
+        self._scraper_ids = set(scraper_ids)
+        table = db[self.table_name].table
+        existing = {row["scraper_id"] for row in db.query(select(table.c.scraper_id))}
+        missing = [
+            {"scraper_id": id, "worker": None, "expires": 0}
+            for id in self._scraper_ids - existing
+        ]
+        if not missing:
+            return
+        try:
+            with db:
+                db.executable.execute(table.insert(), missing)
+        except IntegrityError:
+            # Another worker created some of them first, so only create the rest
+            for lease in missing:
+                try:
+                    db.executable.execute(table.insert(), lease)
+                except IntegrityError:
+                    pass
+
+    def holds(self, scraper_id: int) -> bool:
+        """
+        Check if this worker holds the lease on a scraper
+        """
+        return scraper_id in self._owned
+
+    @property
+    def owned(self) -> Set[int]:
+        """
+        The IDs of the scrapers this worker holds leases on
+        """
+        with self._lock:
+            return set(self._owned)
+
+    def heartbeat(self, now: float):
+        """
+        Record that this worker is alive
+        """
+        table = db[self.workers_table_name].table
+        result = db.executable.execute(
+            table.update().where(table.c.worker == self.worker_id).values(heartbeat=now)
+        )
+        if result.rowcount == 0:
+            db.executable.execute(
+                table.insert(), {"worker": self.worker_id, "heartbeat": now}
+            )
+
+    def live_workers(self, now: float) -> int:
+        """
+        Count the workers (including this one) whose heartbeat hasn't expired
+        """
+        table = db[self.workers_table_name].table
+        count = db.executable.execute(
+            select(func.count()).where(table.c.heartbeat >= now - self.ttl)
+        ).scalar()
+        return max(count, 1)
+
+    def renew(self, now: float):
+        """
+        Extend the leases held by this worker, and forget about any that were taken over (e.g. because this worker stalled for longer than ttl)
+        """
+        table = db[self.table_name].table
+        db.executable.execute(
+            table.update()
+            .where(table.c.worker == self.worker_id, table.c.expires >= now)
+            .values(expires=now + self.ttl)
+        )
+        held = {
+            row["scraper_id"]
+            for row in db.query(
+                select(table.c.scraper_id).where(
+                    table.c.worker == self.worker_id, table.c.expires >= now
+                )
+            )
+        }
+        with self._lock:
+            lost = self._owned - held
+        if lost:
+            logger.warning(f"Lost the leases on scrapers with IDs {sorted(lost)}")
+            # Write what this worker has before forgetting them, so it isn't discarded when they're claimed again
+            if self.on_release is not None:
+                self.on_release(sorted(lost))
+            with self._lock:
+                self._owned -= lost
+
+    def rebalance(self, now: float = None):
+        """
+        Heartbeat, renew the leases held by this worker, and claim or release leases until this worker holds its fair share
+        """
+        if now is None:
+            now = time.time()
+        self.heartbeat(now)
+        self.renew(now)
+        share = math.ceil(len(self._scraper_ids) / self.live_workers(now))
+        table = db[self.table_name].table
+        owned = self.owned
+        if len(owned) > share:
+            release = sorted(owned)[share:]
+            if self.on_release is not None:
+                self.on_release(release)
+            db.executable.execute(
+                table.update()
+                .where(
+                    table.c.worker == self.worker_id,
+                    table.c.scraper_id.in_(release),
+                )
+                .values(expires=0)
+            )
+            with self._lock:
+                self._owned -= set(release)
+            logger.info(
+                f"Released {len(release)} scraper(s) to other workers; holding {share}"
+            )
+        elif len(owned) < share:
+            candidates = [
+                row["scraper_id"]
+                for row in db.query(
+                    select(table.c.scraper_id).where(table.c.expires < now)
+                )
+                if row["scraper_id"] in self._scraper_ids
+            ]
+            claimed = []
+            for scraper_id in candidates[: share - len(owned)]:
+                # Only claim the lease if no other worker has claimed it since it was read
+                result = db.executable.execute(
+                    table.update()
+                    .where(table.c.scraper_id == scraper_id, table.c.expires < now)
+                    .values(worker=self.worker_id, expires=now + self.ttl)
+                )
+                if result.rowcount:
+                    claimed.append(scraper_id)
+            with self._lock:
+                self._owned |= set(claimed)
+            if claimed:
+                logger.info(
+                    f"Claimed {len(claimed)} scraper(s); holding {len(owned) + len(claimed)}"
+                )
+            if self.on_claim is not None:
+                for scraper_id in claimed:
+                    self.on_claim(scraper_id)
+
+    def _rebalance_periodically(self):
+        # Renew well before the leases expire
+        while not self._stopped.wait(self.ttl / 3):
+            try:
+                self.rebalance()
+            except Exception:
+                logger.exception("Failed to renew scraper leases")
+
+    def start(self):
+        """
+        Claim this worker's share of the scrapers now and keep renewing and rebalancing in the background
+        """
+        self.ensure_tables()
+        self.rebalance()
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._rebalance_periodically, name="leases", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop renewing and release every lease so other workers can take over immediately
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        table = db[self.table_name].table
+        workers = db[self.workers_table_name].table
+        with db:
+            db.executable.execute(
+                table.update().where(table.c.worker == self.worker_id).values(expires=0)
+            )
+            db.executable.execute(
+                workers.delete().where(workers.c.worker == self.worker_id)
+            )
+        with self._lock:
+            self._owned = set()
+
+    def clean(self, scraper_ids: Iterable[int], now: float = None):
+        """
+        Delete the leases of scrapers not in scraper_ids and workers that have been dead for a while
+        Should only be run by the coordinator
+        """
+        if now is None:
+            now = time.time()
+        table = db[self.table_name].table
+        workers = db[self.workers_table_name].table
+        scraper_ids = set(scraper_ids)
+        stale = [
+            row["id"]
+            for row in db.query(select(table.c.id, table.c.scraper_id))
+            if row["scraper_id"] not in scraper_ids
+        ]
+        with db:
+            # By ID in batches rather than NOT IN every configured scraper, which can go over the database's limit on parameters
+            delete_ids(table, stale)
+            db.executable.execute(
+                workers.delete().where(workers.c.heartbeat < now - 10 * self.ttl)
+            )
@@ -1,13 +1,20 @@
-import httpx
-from typing import List, Literal, Dict
+from typing import TYPE_CHECKING, List, Literal, Dict
 from enum import Enum
 from scrape_and_ntfy.utils.logging import logger
 import json
 # from scrape_and_ntfy.utils.db import db
 
+if TYPE_CHECKING:
+    import httpx
+
 
 class Notifier:
     # notifiers = []
+    # Seconds to collect messages for before sending them as one request (0 disables batching)
+    batch_window: float = 0
+    # The maximum number of messages in one batch
+    batch_max: int = 10
+
     class NotifyOn(Enum):
         """
         Enum to specify when to notify
@@ -20,11 +27,23 @@ class Notifier:
         # That can be used for prices or other numeric values
         NUMERIC_UP = "numeric_up"
         NUMERIC_DOWN = "numeric_down"
+        # When the value crosses the above or below threshold of a scraper
+        THRESHOLD = "threshold"
 
     @staticmethod
-    def notify(*args, **kwargs):
+    def notify(message: str, client: "httpx.Client" = None):
+        """
+        Send the message, raising an exception if it couldn't be sent
+        If client is set, it is used instead of opening a new connection
+        """
         raise NotImplementedError("Subclasses must implement this method")
 
+    def batch_key(self):
+        """
+        Notifiers with the same batch key send to the same endpoint in the same way, so their messages can be merged
+        """
+        return (type(self).__name__, self.url)
+
     SUB_NOTIFICATION_EVENTS = {
         NotifyOn.CHANGE: [NotifyOn.NUMERIC_UP, NotifyOn.NUMERIC_DOWN],
     }
@@ -64,24 +83,37 @@ class Webhook(Notifier):
         notify_on: List[Notifier.NotifyOn] = [
             no.name for no in list(Notifier.NotifyOn)
         ],
+        batch_window: float = 0,
+        batch_max: int = 10,
     ):
         """
         Instantiate a webhook and ~~add the webhook to the database~~
+        If batch_window is set, messages to the same URL within batch_window seconds are sent together (up to batch_max messages per request)
         """
         self.url = url
         self.notify_on = notify_on
         self.content_field = content_field
+        self.batch_window = batch_window
+        self.batch_max = batch_max
+
+    def batch_key(self):
+        return (*super().batch_key(), self.content_field)
 
     # @property
     # def id(self):
     #     return self._id
     # @staticmethod
     # def notify(url: str, message: str):
-    def notify(self, message: str):
+    def notify(self, message: str, client: "httpx.Client" = None):
         """
         Notify the webhook
         """
-        resp = httpx.post(
+        if client is None:
+            # Only imported once something is sent
+            import httpx
+
+            client = httpx
+        resp = client.post(
             self.url,
             headers={"Content-Type": "application/json"},
             data=json.dumps({self.content_field: message}),
@@ -89,6 +121,7 @@ class Webhook(Notifier):
         logger.debug(
             f"Webhook text response: {resp.text} | status code: {resp.status_code}"
         )
+        resp.raise_for_status()
 
 
 class Ntfy(Notifier):
@@ -101,10 +134,13 @@ class Ntfy(Notifier):
         on_click: str = None,
         priority: Literal[1, 2, 3, 4, 5] = "default",
         tags: str = None,
+        batch_window: float = 0,
+        batch_max: int = 10,
     ):
         """
         Instantiate a Ntfy notifier
         For information on the parameters, see https://docs.ntfy.sh/publish/
+        If batch_window is set, messages to the same topic within batch_window seconds are sent together (up to batch_max messages per request)
         """
         # Not sure if I should handle checking for None here or in notify()
         self.url = url
@@ -112,8 +148,13 @@ class Ntfy(Notifier):
         self.on_click = on_click
         self.priority = priority
         self.tags = tags
+        self.batch_window = batch_window
+        self.batch_max = batch_max
 
-    def notify(self, message: str):
+    def batch_key(self):
+        return (*super().batch_key(), self.on_click, self.priority, self.tags)
+
+    def notify(self, message: str, client: "httpx.Client" = None):
         """
         Notify the Ntfy endpoint
         """
@@ -128,4 +169,10 @@ class Ntfy(Notifier):
         if self.tags:
             headers["Tags"] = self.tags
         # Send the request
-        httpx.post(self.url, data=message.encode("utf-8"), headers=headers)
+        if client is None:
+            # Only imported once something is sent
+            import httpx
+
+            client = httpx
+        resp = client.post(self.url, data=message.encode("utf-8"), headers=headers)
+        resp.raise_for_status()
@@ -0,0 +1,214 @@
+import hashlib
+import json
+import random
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from scrape_and_ntfy.scraping.notifier import Notifier
+from scrape_and_ntfy.scraping.values import ValueParser
+
+# "selenium" loads the page in a browser session, "http" fetches and parses the HTML without a browser
+ENGINES = ["selenium", "http"]
+# How much the interval grows with each consecutive unchanged scrape when stretching
+STRETCH_FACTOR = 1.5
+# The default max_interval, as a multiple of the interval
+MAX_INTERVAL_FACTOR = 16
+# The default number of seconds a watched page is kept open before it is reloaded
+WATCH_MAX_AGE = 3600
+
+
+def default_name(url: str, css_selector: str = "") -> str:
+    """
+    Get the name of a scraper that wasn't given one
+    """
+    return f"{url} ({css_selector})" if css_selector else url
+
+
+def check_scraper(
+    url: str, css_selector: str, engine: str, fields: list, watch: bool = False
+):
+    """
+    Raise a ValueError if the settings of a scraper can't work
+    """
+    if engine not in ENGINES:
+        raise ValueError(f"Invalid engine: {engine}")
+    if not css_selector and not fields:
+        raise ValueError(f"Scraper for {url} needs a css_selector or fields")
+    if watch and engine != "selenium":
+        raise ValueError(f"Scraper for {url} can only watch with the selenium engine")
+
+
+def extraction_signature(
+    css_selector: str, engine: str, fields: list, parser: ValueParser
+) -> str:
+    """
+    Summarize everything that decides what is extracted from a page and how its number is parsed
+    Stored with each scraper so the validators and value from before a change aren't trusted
+    """
+    settings = [
+        css_selector,
+        engine,
+        [[field.name] + field.spec() for field in fields],
+        parser.decimal,
+        parser.pattern,
+    ]
+    return hashlib.sha256(
+        json.dumps(settings, separators=(",", ":")).encode()
+    ).hexdigest()[:16]
+
+
+def route_notifiers(
+    notifiers: List[Notifier],
+) -> Dict[Notifier.NotifyOn, Tuple[Notifier, ...]]:
+    """
+    Build a map of each event to the notifiers that should be notified of it
+    notify_on already includes the sub-events (e.g. NUMERIC_UP for CHANGE), so they are resolved here once instead of on every notification
+    """
+    routes = {}
+    for event in Notifier.NotifyOn:
+        routed = tuple(
+            notifier for notifier in notifiers if event in set(notifier.notify_on)
+        )
+        if routed:
+            routes[event] = routed
+    return routes
+
+
+@dataclass(slots=True)
+class Field:
+    """
+    A named value to extract from the page of a scraper with several fields
+    """
+
+    name: str
+    css_selector: str
+    # The attribute (e.g. "href") to read instead of the element's text
+    attribute: str = None
+    # The DOM property (e.g. "value") to read instead of the element's text
+    property: str = None
+    # Whether to read every matching element (as a list) instead of the first
+    all: bool = False
+
+    def __post_init__(self):
+        if self.attribute and self.property:
+            raise ValueError(
+                f"Field {self.name} can't have both an attribute and a property"
+            )
+
+    def spec(self) -> list:
+        """
+        The arguments for each field to the in-page extraction script
+        """
+        return [self.css_selector, self.attribute, self.property, self.all]
+
+
+def encode_fields(values: Dict[str, object]) -> Optional[str]:
+    """
+    Store the values of a scraper's fields in its data column as compact JSON
+    Returns None if none of the fields were found, the same as a missing element
+    """
+    if all(value is None for value in values.values()):
+        return None
+    return json.dumps(values, ensure_ascii=False, separators=(",", ":"))
+
+
+def decode_fields(data: Optional[str]) -> Dict[str, object]:
+    """
+    Read the values stored by encode_fields(); data from before a scraper had fields is ignored
+    """
+    if not data:
+        return {}
+    try:
+        values = json.loads(data)
+    except ValueError:
+        return {}
+    return values if isinstance(values, dict) else {}
+
+
+def field_text(value: object) -> Optional[str]:
+    """
+    Format the value of a field for notifications and comparing as a number
+    """
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value, ensure_ascii=False)
+
+
+@dataclass(slots=True)
+class ScraperConfig:
+    """
+    The in-memory configuration of a scraper, as opposed to its state (last_scrape, data) which is stored in the database
+    """
+
+    id: int
+    url: str
+    css_selector: str
+    interval: int
+    name: str
+    engine: str = "selenium"
+    skip_unchanged: bool = False
+    max_scrolls: int = 50
+    lean: bool = False
+    backoff: bool = False
+    stretch: bool = False
+    jitter: float = 0
+    min_interval: float = None
+    max_interval: float = None
+    # If set, these are extracted instead of the text of css_selector
+    fields: List[Field] = field(default_factory=list)
+    # Parses the number out of each new value
+    parser: ValueParser = field(default_factory=ValueParser)
+    # Thresholds the value is checked against (THRESHOLD is notified when it crosses one)
+    above: float = None
+    below: float = None
+    # Numeric changes smaller than this percentage of the old value are treated as unchanged
+    change_percent: float = None
+    # Whether the page is kept open in a tab and polled instead of loaded for every scrape, and how many seconds until it is reloaded anyway
+    watch: bool = False
+    max_age: float = WATCH_MAX_AGE
+    notifiers: List[Notifier] = field(default_factory=list)
+    routes: Dict[Notifier.NotifyOn, Tuple[Notifier, ...]] = field(init=False)
+
+    def __post_init__(self):
+        self.routes = route_notifiers(self.notifiers)
+        if self.min_interval is None:
+            self.min_interval = self.interval
+        if self.max_interval is None:
+            self.max_interval = self.interval * MAX_INTERVAL_FACTOR
+
+    def next_interval(self, errors: int = 0, unchanged: int = 0) -> float:
+        """
+        Get the number of seconds until the next scrape, given the number of consecutive errors and unchanged scrapes
+        """
+        interval = self.interval
+        if self.backoff and errors:
+            # The exponent is capped so it can't overflow; max_interval is hit long before
+            interval = self.interval * 2 ** min(errors, 32)
+        elif self.stretch and unchanged:
+            interval = self.interval * STRETCH_FACTOR ** min(unchanged, 32)
+        if self.backoff or self.stretch:
+            interval = max(self.min_interval, min(self.max_interval, interval))
+        if self.jitter:
+            interval *= 1 + random.uniform(-self.jitter, self.jitter)
+        return interval
+
+    def crossed(self, old: Optional[float], new: float) -> Optional[str]:
+        """
+        Check if a value went above or below a threshold, returning a description of it (or None if it didn't)
+        A value that is already past a threshold on the first scrape counts as crossing it
+        """
+        if self.above is not None and new > self.above:
+            if old is None or old <= self.above:
+                return f"rose above {self.above:g}"
+        if self.below is not None and new < self.below:
+            if old is None or old >= self.below:
+                return f"fell below {self.below:g}"
+        return None
+
+    def significant(self, old: float, new: float) -> bool:
+        """
+        Check if a numeric change is at least change_percent (if set) of the old value
+        """
+        if not self.change_percent or old == 0:
+            return True
+        return abs(new - old) / abs(old) * 100 >= self.change_percent
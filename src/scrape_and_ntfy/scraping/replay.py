@@ -0,0 +1,98 @@
+from typing import Dict, Iterator, List, Tuple
+
+from scrape_and_ntfy.scraping import http_engine
+from scrape_and_ntfy.scraping.history import HistoryStore
+from scrape_and_ntfy.scraping.notifier import Notifier
+from scrape_and_ntfy.scraping.scheduler import Scheduler
+from scrape_and_ntfy.scraping.scraper import UrlScraper
+from scrape_and_ntfy.scraping.snapshots import SnapshotStore
+from scrape_and_ntfy.scraping.state import ScraperState
+from scrape_and_ntfy.utils.logging import logger
+
+
+class ReplayScraper(UrlScraper):
+    """
+    Runs scrapers against stored snapshots instead of live pages, with the same change detection as UrlScraper
+    Pages are parsed like the "http" engine (no browser or network), notifications are collected instead of sent, and nothing is written to the database
+    """
+
+    scrapers = {}
+    _ids_by_key = {}
+    scheduler = Scheduler()
+    # Never written; entries are dropped after each result
+    history = HistoryStore()
+    state = ScraperState()
+    # The notifications of the result being processed, as (event, message)
+    events: List[Tuple[Notifier.NotifyOn, str]] = []
+
+    @classmethod
+    def load(cls, scrapers: List["ReplayScraper"]):
+        """
+        Add scrapers (created with register=False) as if they had never been scraped
+        """
+        rows = {}
+        for id, scraper in enumerate(scrapers, len(cls.scrapers) + 1):
+            key = (scraper.url, scraper.css_selector, scraper.name)
+            rows[key] = {
+                "id": id,
+                "url": scraper.url,
+                "css_selector": scraper.css_selector,
+                "name": scraper.name,
+                "interval": scraper.interval,
+                "pause_time": scraper.pause_time,
+                "scroll_to_bottom": scraper.scroll_to_bottom,
+                "last_scrape": None,
+                "data": None,
+            }
+        for scraper in scrapers:
+            scraper._register(rows)
+        # Replays are run by URL, not by schedule
+        for id in list(cls.scrapers):
+            cls.scheduler.unschedule(id)
+
+    @classmethod
+    def send_to_all_notifiers(
+        cls,
+        scraper,
+        message: str,
+        notification_type: Notifier.NotifyOn = Notifier.NotifyOn.CHANGE,
+    ):
+        cls.events.append((notification_type, message))
+
+    @classmethod
+    def replay(
+        cls, snapshots: SnapshotStore, since: float = None, until: float = None
+    ) -> Iterator[dict]:
+        """
+        Run the loaded scrapers against every snapshot of their URL in chronological order (optionally limited to a time range)
+        Yields what each scraper found and the notifications it would have sent for every snapshot
+        """
+        by_url: Dict[str, List[int]] = {}
+        for id, config in cls.scrapers.items():
+            by_url.setdefault(config.url, []).append(id)
+        for url, ids in by_url.items():
+            fields = [cls.scrapers[id].fields for id in ids]
+            for snapshot in snapshots.query(url, since=since, until=until):
+                try:
+                    html = snapshots.load(snapshot["hash"])
+                except OSError as e:
+                    logger.warning(
+                        f"Skipping the snapshot of {url} from {snapshot['time']}: {e}"
+                    )
+                    continue
+                rows = [cls.state.get(id) for id in ids]
+                for row, data in zip(rows, http_engine.extract(html, rows, fields)):
+                    cls.events = []
+                    cls.process_result(row, data)
+                    cls.history.take_pending()
+                    # process_result() uses the current time
+                    cls.state.update(row["id"], last_scrape=snapshot["time"])
+                    for event, message in cls.events:
+                        yield {
+                            "time": snapshot["time"],
+                            "scraper": row["name"],
+                            "hash": snapshot["hash"],
+                            "data": data,
+                            "event": event.value,
+                            "message": message,
+                        }
@@ -0,0 +1,117 @@
+import heapq
+import itertools
+import threading
+import time
+from typing import Callable, Hashable, List, Optional
+
+# Placeholder for heap entries that have been rescheduled or removed
+# https://docs.python.org/3/library/heapq.html#priority-queue-implementation-notes
+_REMOVED = object()
+
+
+class Scheduler:
+    """
+    Priority queue of next-due times
+    Each key (e.g. a scraper ID) is scheduled with the timestamp at which it should next run.
+    wait_until_due() sleeps until the earliest deadline (or until something is scheduled earlier) instead of polling.
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.time):
+        self._clock = clock
+        self._heap = []
+        # Map of key to its live heap entry so that rescheduling doesn't require searching the heap
+        self._entries = {}
+        # Used as a tie-breaker so keys never have to be compared
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+
+    def schedule(self, key: Hashable, due: float):
+        """
+        Schedule key to be due at the timestamp due
+        If key is already scheduled, it is rescheduled
+        """
+        with self._lock:
+            self._invalidate(key)
+            entry = [due, next(self._counter), key]
+            self._entries[key] = entry
+            heapq.heappush(self._heap, entry)
+            # Wake up wait_until_due() if this is now the earliest deadline
+            if self._heap[0] is entry:
+                self._wakeup.set()
+
+    def unschedule(self, key: Hashable):
+        """
+        Remove key from the schedule, if it is scheduled
+        """
+        with self._lock:
+            self._invalidate(key)
+
+    def _invalidate(self, key: Hashable):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            entry[-1] = _REMOVED
+
+    def _peek(self) -> Optional[list]:
+        """
+        Return the earliest live entry, discarding any removed entries at the top of the heap
+        The lock must be held by the caller
+        """
+        while self._heap and self._heap[0][-1] is _REMOVED:
+            heapq.heappop(self._heap)
+        return self._heap[0] if self._heap else None
+
+    def next_due(self) -> Optional[float]:
+        """
+        Get the earliest due time, or None if nothing is scheduled
+        """
+        with self._lock:
+            entry = self._peek()
+            return entry[0] if entry else None
+
+    def pop_due(self, now: float = None) -> List[Hashable]:
+        """
+        Remove and return every key that is due, earliest first
+        Popped keys are no longer scheduled; schedule() them again once they've run
+        """
+        if now is None:
+            now = self._clock()
+        due = []
+        with self._lock:
+            while (entry := self._peek()) is not None and entry[0] <= now:
+                heapq.heappop(self._heap)
+                del self._entries[entry[-1]]
+                due.append(entry[-1])
+        return due
+
+    def wait_until_due(self, timeout: float = None) -> bool:
+        """
+        Block until the earliest key is due
+        Returns True if something is due and False if timeout (in seconds) elapsed first
+        """
+        deadline = None if timeout is None else self._clock() + timeout
+        while True:
+            with self._lock:
+                entry = self._peek()
+                now = self._clock()
+                if entry is not None and entry[0] <= now:
+                    return True
+                if deadline is not None and deadline <= now:
+                    return False
+                # Cleared while holding the lock so a schedule() between here and wait() isn't missed
+                self._wakeup.clear()
+                delays = [
+                    d
+                    for d in (
+                        entry[0] - now if entry else None,
+                        deadline - now if deadline is not None else None,
+                    )
+                    if d is not None
+                ]
+            self._wakeup.wait(min(delays) if delays else None)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable):
+        return key in self._entries
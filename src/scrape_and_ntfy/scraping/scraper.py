@@ -1,92 +1,474 @@
-from typing import OrderedDict, List
-from selenium import webdriver
-from selenium.common.exceptions import NoSuchElementException
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    ContextManager,
+    Dict,
+    OrderedDict,
+    List,
+    Literal,
+    Optional,
+    Tuple,
+)
 from datetime import datetime
 from scrape_and_ntfy.utils.logging import logger
-from scrape_and_ntfy.utils.db import db
+from scrape_and_ntfy.utils.db import BATCH_SIZE, db
 from scrape_and_ntfy.scraping.notifier import Notifier
-from scrape_and_ntfy.utils import convert_to_float
+from scrape_and_ntfy.scraping.scheduler import Scheduler
+from scrape_and_ntfy.scraping.state import ScraperState
+from scrape_and_ntfy.scraping.history import HistoryStore
+from scrape_and_ntfy.scraping.snapshots import SnapshotStore
+from scrape_and_ntfy.scraping.leases import LeaseManager
+from scrape_and_ntfy.scraping.hosts import HostLimiter
+from scrape_and_ntfy.scraping.registry import (
+    ENGINES,
+    Field,
+    WATCH_MAX_AGE,
+    ScraperConfig,
+    check_scraper,
+    decode_fields,
+    default_name,
+    encode_fields,
+    extraction_signature,
+    field_text,
+)
+from scrape_and_ntfy.scraping.dispatcher import NotificationDispatcher
+from scrape_and_ntfy.scraping import http_engine
+from scrape_and_ntfy.scraping.values import ValueParser
+from scrape_and_ntfy.utils.metrics import metrics
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+import json
+import random
+import threading
 import time
+from urllib.parse import urlsplit
 
-driver: webdriver.Chrome = None
+# Selenium and the browser sessions are only imported once scraping starts, so the history and replay commands don't load them
+if TYPE_CHECKING:
+    from selenium import webdriver
+    from scrape_and_ntfy.scraping.browser import DriverPool, Tab, WatchedTabs
+
+driver_pool: "DriverPool" = None
+# Browser sessions keyed by whether they are lean, for scrapers that override the default
+# Falls back to driver_pool for any setting that isn't in here
+driver_pools: Dict[bool, "DriverPool"] = {}
+# Sessions keeping the pages of scrapers with watch open, keyed by whether they are lean
+watched_tabs: Dict[bool, "WatchedTabs"] = {}
+# Returns the page height followed by whether each selector in arguments[0] matches an element
+FIND_SCRIPT = "return [document.body.scrollHeight].concat(arguments[0].map(s => document.querySelector(s) !== null));"
+# Returns the page height followed by the values of each scraper's fields (as given by Field.spec()) in arguments[0]
+# A field is null if nothing matches (or, with all, a list of the values of every match)
+FIELDS_SCRIPT = """
+const read = (e, f) => f[1] ? e.getAttribute(f[1]) : f[2] ? e[f[2]] : e.innerText;
+return [document.body.scrollHeight].concat(arguments[0].map(fields => fields.map(f => {
+    if (f[3]) {
+        const values = Array.from(document.querySelectorAll(f[0]), e => read(e, f));
+        return values.length ? values : null;
+    }
+    const e = document.querySelector(f[0]);
+    return e === null ? null : read(e, f);
+})));
+"""
+# Keeps the values of each scraper watching the page (by ID) up to date with a MutationObserver, installing it if arguments[2] is true
+# arguments[0] has the IDs to return the values of and arguments[1] the spec of each one's fields (as given by Field.spec())
+# Returns the number of times the values changed since the last call followed by each one's values as JSON, or null if the observer isn't installed (e.g. the page navigated)
+WATCH_SCRIPT = """
+const [ids, specs, install] = arguments;
+let w = window.__scrapeAndNtfyWatch;
+if (!w) {
+    if (!install) return null;
+    const read = (e, f) => f[1] ? e.getAttribute(f[1]) : f[2] ? e[f[2]] : e.innerText;
+    const value = f => {
+        if (f[3]) {
+            const values = Array.from(document.querySelectorAll(f[0]), e => read(e, f));
+            return values.length ? values : null;
+        }
+        const e = document.querySelector(f[0]);
+        return e === null ? null : read(e, f);
+    };
+    w = window.__scrapeAndNtfyWatch = {specs: {}, values: {}, changes: 0};
+    w.check = () => {
+        for (const id in w.specs) {
+            const values = JSON.stringify(w.specs[id].map(value));
+            if (values !== w.values[id]) {
+                w.values[id] = values;
+                w.changes++;
+            }
+        }
+    };
+    new MutationObserver(w.check).observe(document, {subtree: true, childList: true, characterData: true, attributes: true});
+}
+let added = false;
+ids.forEach((id, i) => {
+    if (JSON.stringify(w.specs[id]) !== JSON.stringify(specs[i])) {
+        w.specs[id] = specs[i];
+        added = true;
+    }
+});
+if (added) w.check();
+const changes = w.changes;
+w.changes = 0;
+return [changes].concat(ids.map(id => w.values[id]));
+"""
+# How often to check the page when waiting for elements
+POLL_INTERVAL = 0.1
+
+
+def wait_until(condition, timeout: float) -> bool:
+    """
+    Poll condition until it is true or timeout seconds have passed (it is always checked at least once)
+    Returns whether condition became true
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        if condition():
+            return True
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        time.sleep(min(POLL_INTERVAL, remaining))
+
+
+# Columns storing what the page looked like when it was last fetched
+VALIDATORS = ["etag", "last_modified", "content_hash"]
+# The columns of the scrapers table and their types (attributes of db.types, which needs a connection)
+COLUMNS = {
+    "url": "text",
+    "css_selector": "text",
+    "interval": "integer",
+    "name": "text",
+    "pause_time": "integer",
+    "scroll_to_bottom": "boolean",
+    "last_scrape": "float",
+    "data": "text",
+    "etag": "text",
+    "last_modified": "text",
+    "content_hash": "text",
+    "errors": "integer",
+    "unchanged": "integer",
+    "next_scrape": "float",
+    # The number parsed from data, so the old value never has to be parsed again
+    "value": "float",
+    # The same for each field of a scraper with fields, as JSON
+    "field_values": "text",
+    # What the extraction settings were when data was scraped (see extraction_signature())
+    "extraction": "text",
+}
+# If set, notifications are sent in the background instead of while holding up scraping
+dispatcher: NotificationDispatcher = None
 
 # https://docs.sqlalchemy.org/en/20/core/type_basics.html
 
 
 class UrlScraper:
-    scrapers = []
+    ENGINES = ENGINES
+    # Map of ID to the in-memory configuration of each scraper
+    scrapers: Dict[int, ScraperConfig] = {}
+    # Map of (URL, CSS selector, name), which identifies a scraper, to its ID
+    _ids_by_key: Dict[Tuple[str, str, str], int] = {}
+    # Next-due times of the scrapers, keyed by ID
+    scheduler = Scheduler()
+    # Every value the scrapers have seen
+    history = HistoryStore()
+    # The pages the scrapers have seen, if enabled by setting its directory
+    snapshots = SnapshotStore()
+    # The rows of the scrapers table; read and written in-memory and flushed to the database in batches (along with the history and snapshots)
+    state = ScraperState(history=history, snapshots=snapshots)
+    # Set by use_leases() when sharing the scrapers with other processes; only the scrapers this process holds leases on are scraped
+    leases: LeaseManager = None
+    # Per-host limits on fetching pages, configured by the hosts table of the TOML config
+    hosts = HostLimiter()
+    # Created on the first scrape_all_urls() with one worker per browser session
+    executor: ThreadPoolExecutor = None
+    # The level each type of notification is logged at
+    LOG_LEVELS = {
+        Notifier.NotifyOn.ERROR: "WARNING",
+        Notifier.NotifyOn.CHANGE: "INFO",
+        Notifier.NotifyOn.FIRST_SCRAPE: "INFO",
+        Notifier.NotifyOn.NUMERIC_UP: "INFO",
+        Notifier.NotifyOn.NUMERIC_DOWN: "INFO",
+        Notifier.NotifyOn.THRESHOLD: "INFO",
+        Notifier.NotifyOn.NO_CHANGE: "DEBUG",
+    }
+    # Whether ensure_table() has already run
+    _table_ensured = False
+    # Held while processing results and notifying so results from different threads don't interleave
+    _lock = threading.Lock()
+    # IDs of scrapers that were re-queued after their browser session failed, so they're only retried once
+    _requeued = set()
 
     def __init__(
         self,
         url: str,
-        css_selector: str,
+        css_selector: str = "",
         interval: int = 60,
         name: str = None,
         pause_time: int = 0,
         notifiers: List[Notifier] = [],
         scroll_to_bottom: bool = False,
+        engine: Literal["selenium", "http"] = "selenium",
+        skip_unchanged: bool = None,
+        max_scrolls: int = 50,
+        lean: bool = False,
+        backoff: bool = False,
+        stretch: bool = False,
+        jitter: float = 0,
+        min_interval: int = None,
+        max_interval: int = None,
+        fields: List[Field] = [],
+        decimal: str = None,
+        locale: str = None,
+        pattern: str = None,
+        above: float = None,
+        below: float = None,
+        change_percent: float = None,
+        watch: bool = False,
+        max_age: float = WATCH_MAX_AGE,
+        register: bool = True,
     ):
         """
         Add a scraper to the database and the list of scrapers
-        If a name is not provided, the name will be f"{url} ({css_selector})"
+        If a name is not provided, the name will be f"{url} ({css_selector})" (or just the URL if there's no css_selector)
         A duplicate scraper will not be created if the URL, CSS selector, and name are the same. Thus, you can use name to differentiate between scrapers if you need multiple scrapers with the same URL, CSS selector.
         If you rename a scraper and then run the script, a new scraper will be created with an empty last_scrape and data. When the database is cleaned, the old scraper will be deleted.
-        You can set pause_time to the number of seconds to wait between scrolling (if scroll_to_bottom is True) or, if scroll_to_bottom is False, the number of seconds to wait before attempting to find element.
+        You can set pause_time to the maximum number of seconds to wait for the element after each scroll (if scroll_to_bottom is True) or, if scroll_to_bottom is False, after the page loads. The page is checked continuously, so it rarely takes this long.
+        Set engine to "http" to fetch the page without a browser. This is much faster but only works for pages that don't need JavaScript to render the element.
+        If skip_unchanged is True, the page is first fetched with a conditional request and, if the server says it's unchanged (or its content hash matches), it isn't loaded and the data is treated as unchanged.
+        If scroll_to_bottom is True, at most max_scrolls scrolls are done (0 for no limit), which matters for pages that keep loading more content.
+        If backoff is True, the interval doubles with each consecutive error (i.e. the element not being found). If stretch is True, it grows by half with each consecutive scrape where the data didn't change. Either way, it is kept between min_interval (defaults to interval) and max_interval (defaults to 16 times interval) and goes back to interval once the element is found or the data changes.
+        jitter randomly lengthens or shortens each interval by up to that fraction of it (e.g. 0.1 for 10%) so scrapers with the same interval don't all run at once.
+        If lean is True, the page is loaded in a browser session that doesn't load images, fonts, media, or blocked hosts. Turn it off for pages that need them to render the element.
+        skip_unchanged defaults to True for the "http" engine (it costs nothing extra) and False for "selenium" (it costs an extra request and JavaScript can change the page even if the HTML hasn't changed).
+        Set fields to extract several named values (each with its own selector, and optionally an attribute or property to read or all matches) from the page instead of the text of css_selector. They are extracted with one script call, stored together as compact JSON in data, and changes are notified for each field. css_selector is then only used to tell scrapers apart.
+        Numbers are parsed out of the data once per scrape (and stored in the value column) with "." as the decimal separator unless decimal or locale (e.g. "de_DE") says otherwise. If pattern (a regular expression) is set, the number is taken from its first match (or first group).
+        If above or below is set, a THRESHOLD notification is sent when the number crosses it. Numeric changes smaller than change_percent of the old number are treated as unchanged.
+        If watch is True, the page is kept open in a tab with an observer that records changes to the element (or fields) as they happen, and each scrape only collects them. The page is only loaded again if the element is missing, the tab was lost, or it has been open for max_age seconds. This is for pages that update themselves (e.g. dashboards), and only works with the "selenium" engine.
+        If register is False, the scraper isn't added until it is passed to UrlScraper.register(), which adds many scrapers much faster than adding them one at a time.
         """
+        check_scraper(url, css_selector, engine, fields, watch)
+        self.watch = watch
+        self.max_age = max_age
+        self.fields = fields
+        self.parser = ValueParser(decimal=decimal, locale=locale, pattern=pattern)
+        self.above = above
+        self.below = below
+        self.change_percent = change_percent
+        self.engine = engine
+        self.skip_unchanged = (
+            engine == "http" if skip_unchanged is None else skip_unchanged
+        )
+        self.max_scrolls = max_scrolls
+        self.lean = lean
+        self.backoff = backoff
+        self.stretch = stretch
+        self.jitter = jitter
+        self.min_interval = min_interval
+        self.max_interval = max_interval
         self.notifiers = notifiers
         self.url = url
         self.css_selector = css_selector
         self.interval = interval
         # Set name to the URL and CSS selector if not provided
-        self.name = name if name else f"{url} ({css_selector})"
+        self.name = name if name else default_name(url, css_selector)
         self.pause_time = pause_time
         self.scroll_to_bottom = scroll_to_bottom
-        self._last_scrape = None
-        # By default, an auto-incrementing primary key (id) is created
-        table = db["scrapers"]
-        id = table.insert_ignore(
-            row={
-                "url": self.url,
-                "css_selector": self.css_selector,
-                "interval": self.interval,
-                "name": self.name,
-                "pause_time": self.pause_time,
-                "scroll_to_bottom": self.scroll_to_bottom,
-                "last_scrape": self._last_scrape,
-                "data": None,
-            },
-            keys=["url", "css_selector", "name"],
-            # `ensure`, by default, is set to True so setting it to True is redundant
-            # When set to True, it will create the columns if they don't exist, which is what we want
-            ensure=True,
-            types={
-                "url": db.types.text,
-                "css_selector": db.types.text,
-                "interval": db.types.integer,
-                "name": db.types.text,
-                "pause_time": db.types.integer,
-                "scroll_to_bottom": db.types.boolean,
-                "last_scrape": db.types.float,
-                "data": db.types.text,
-            },
+        self.extraction = extraction_signature(
+            css_selector, engine, fields, self.parser
         )
-        if id is False:
-            id = table.find_one(
-                url=self.url, css_selector=self.css_selector, name=self.name
-            )["id"]
-            logger.info(f"Found existing scraper for {self.url} with ID {id}")
+        self._last_scrape = None
+        self._id = None
+        if register:
+            self.register([self])
+
+    @classmethod
+    def ensure_table(cls):
+        """
+        Create the scrapers table, its columns, and a unique index on what identifies a scraper if they don't exist
+        Only checked once per process
+        """
+        if cls._table_ensured:
+            return
+        table = db.create_table("scrapers", primary_id="id")
+        for column, type in COLUMNS.items():
+            table.create_column(column, getattr(db.types, type))
+        # MySQL only indexes a prefix of text columns, so different scrapers could collide
+        if db.engine.dialect.name != "mysql":
+            try:
+                table.create_index(["url", "css_selector", "name"], unique=True)
+            except SQLAlchemyError as e:
+                logger.warning(
+                    f"Couldn't create a unique index on the scrapers table, likely because it has duplicate scrapers: {e}"
+                )
+        cls._table_ensured = True
+
+    @classmethod
+    def _find_rows(cls, keys) -> Dict[Tuple[str, str, str], dict]:
+        """
+        Get the rows of the scrapers identified by keys (tuples of URL, CSS selector, and name) that are in the database
+        """
+        table = db["scrapers"].table
+        urls = sorted({url for url, _, _ in keys})
+        rows = {}
+        for i in range(0, len(urls), BATCH_SIZE):
+            for row in db.query(
+                select(table)
+                .where(table.c.url.in_(urls[i : i + BATCH_SIZE]))
+                .order_by(table.c.id)
+            ):
+                key = (row["url"], row["css_selector"], row["name"])
+                # If there are duplicates (from before the unique index), use the oldest like find_one() did
+                if key in keys:
+                    rows.setdefault(key, row)
+        return rows
+
+    @classmethod
+    def _insert_rows(
+        cls, new_rows: Dict[Tuple[str, str, str], dict], one_at_a_time: bool = False
+    ) -> Tuple[Dict[Tuple[str, str, str], dict], int]:
+        """
+        Insert the rows in new_rows (keyed by what identifies each scraper) that aren't in the database
+        Returns the rows of every scraper in new_rows as they are in the database and the number inserted
+        """
+        table = db["scrapers"].table
+        rows = cls._find_rows(new_rows)
+        missing = [key for key in new_rows if key not in rows]
+        if missing:
+            if one_at_a_time:
+                for key in missing:
+                    try:
+                        db.executable.execute(table.insert(), new_rows[key])
+                    except IntegrityError:
+                        pass
+            else:
+                db.executable.execute(
+                    table.insert(), [new_rows[key] for key in missing]
+                )
+            rows.update(cls._find_rows(missing))
+        return rows, len(missing)
+
+    @classmethod
+    def register(cls, scrapers: List["UrlScraper"]):
+        """
+        Add scrapers to the database (or find their existing rows) and start scraping them
+        New scrapers are looked up and inserted in one transaction with a statement per batch rather than per scraper, so this should be called with every scraper at once when there are many
+        Scrapers that were already registered (i.e. the config was reloaded) are updated in place, keeping their state and their place in the schedule
+        """
+        new_rows = {}
+        for scraper in scrapers:
+            key = (scraper.url, scraper.css_selector, scraper.name)
+            if key not in cls._ids_by_key:
+                new_rows[key] = {
+                    "url": scraper.url,
+                    "css_selector": scraper.css_selector,
+                    "interval": scraper.interval,
+                    "name": scraper.name,
+                    "pause_time": scraper.pause_time,
+                    "scroll_to_bottom": scraper.scroll_to_bottom,
+                    "last_scrape": None,
+                    "data": None,
+                    "etag": None,
+                    "last_modified": None,
+                    "content_hash": None,
+                    "errors": 0,
+                    "unchanged": 0,
+                    "next_scrape": None,
+                    "value": None,
+                    "field_values": None,
+                    "extraction": scraper.extraction,
+                }
+        rows = {}
+        # Existing rows may need columns added since they were created
+        cls.ensure_table()
+        if new_rows:
+            try:
+                with db:
+                    rows, inserted = cls._insert_rows(new_rows)
+            except IntegrityError:
+                # Another process (e.g. a worker starting at the same time) added some of them first, so add the rest one at a time
+                rows, inserted = cls._insert_rows(new_rows, one_at_a_time=True)
+            logger.info(
+                f"Registered {len(rows)} scraper(s): {inserted} created, {len(rows) - inserted} found in the database"
+            )
+        for scraper in scrapers:
+            scraper._register(rows)
+
+    def _register(self, rows: Dict[Tuple[str, str, str], dict]):
+        """
+        Add the in-memory configuration and state of this scraper and schedule it, given the rows of new scrapers from register()
+        """
+        key = (self.url, self.css_selector, self.name)
+        id = self._ids_by_key.get(key)
+        if id is not None:
+            # The config was reloaded; keep the scraper's state and its place in the schedule
+            row = self.state.get(id)
+            self.state.update(
+                id,
+                interval=self.interval,
+                pause_time=self.pause_time,
+                scroll_to_bottom=self.scroll_to_bottom,
+            )
+            logger.info(f"Updated scraper for {self.url} with ID {id}")
         else:
-            logger.info(f"Created scraper for {self.url} with ID {id}")
-        self.scrapers.append(
-            {
-                "id": id,
-                "url": self.url,
-                "css_selector": self.css_selector,
-                "interval": self.interval,
-                "last_scrape": self._last_scrape,
-                "notifiers": self.notifiers,
-            }
+            row = rows[key]
+            id = row["id"]
+            logger.debug(f"Registered scraper for {self.url} with ID {id}")
+            self.state.add(row)
+        if row.get("extraction") != self.extraction:
+            # What is extracted (or how it is parsed) changed, so an unchanged page no longer means unchanged data and the stored number may be wrong
+            # Clearing the validators makes the next probe fetch and extract the page instead of reusing the stored data
+            logger.debug(
+                f"Extraction settings of scraper with ID {id} changed; not trusting its validators"
+            )
+            self.state.update(
+                id,
+                **dict.fromkeys(VALIDATORS),
+                value=None,
+                field_values=None,
+                extraction=self.extraction,
+            )
+        self._last_scrape = row["last_scrape"]
+        old = self.scrapers.get(id)
+        self.scrapers[id] = ScraperConfig(
+            id=id,
+            url=self.url,
+            css_selector=self.css_selector,
+            interval=self.interval,
+            name=self.name,
+            engine=self.engine,
+            skip_unchanged=self.skip_unchanged,
+            max_scrolls=self.max_scrolls,
+            lean=self.lean,
+            backoff=self.backoff,
+            stretch=self.stretch,
+            jitter=self.jitter,
+            min_interval=self.min_interval,
+            max_interval=self.max_interval,
+            fields=self.fields,
+            parser=self.parser,
+            above=self.above,
+            below=self.below,
+            change_percent=self.change_percent,
+            watch=self.watch,
+            max_age=self.max_age,
+            notifiers=self.notifiers,
         )
+        if old is not None and old.watch and (not self.watch or old.lean != self.lean):
+            self.unwatch(old.url, old.lean)
+        if key not in self._ids_by_key:
+            self._ids_by_key[key] = id
+            # Pick up where the last run left off instead of scraping everything immediately
+            self.schedule_from_row(row)
+        elif row["interval"] != self.interval and id in self.scheduler:
+            # Scrapers that are being scraped right now are rescheduled with the new interval when they finish
+            # Ones that have never been scraped are still due now rather than after the new interval
+            self.scheduler.schedule(
+                id,
+                datetime.now().timestamp()
+                if row["last_scrape"] is None
+                else row["last_scrape"] + self.interval,
+            )
         self._id = id
 
     @property
@@ -97,140 +479,746 @@ class UrlScraper:
     @classmethod
     def clean_db(cls):
         """
-        Remove all scrapers from the database that aren't in the list of scrapers
+        Remove all scrapers from the database that aren't in the list of scrapers (along with their history)
         """
-        for scraper in db["scrapers"]:
-            if scraper["id"] not in cls.scraper_ids():
-                db["scrapers"].delete(id=scraper["id"])
-                logger.info(
-                    f"Deleted scraper for {scraper['url']} with ID {scraper['id']}"
-                )
+        cls.ensure_table()
+        table = db["scrapers"].table
+        stale = [
+            row
+            for row in db.query(select(table.c.id, table.c.url))
+            if row["id"] not in cls.scrapers
+        ]
+        if not stale:
+            return
+        ids = [row["id"] for row in stale]
+        with db:
+            for i in range(0, len(ids), BATCH_SIZE):
+                batch = ids[i : i + BATCH_SIZE]
+                db.executable.execute(table.delete().where(table.c.id.in_(batch)))
+                cls.history.delete_scrapers(batch)
+        for row in stale:
+            logger.debug(f"Deleted scraper for {row['url']} with ID {row['id']}")
+        logger.info(f"Deleted {len(stale)} scraper(s) that are no longer configured")
+
+    @classmethod
+    def find(cls, url: str, css_selector: str, name: str = None):
+        """
+        Get the ID of a scraper by what identifies it (the same as in the config), or None if there is no such scraper
+        """
+        return cls._ids_by_key.get(
+            (url, css_selector, name or default_name(url, css_selector))
+        )
+
+    @classmethod
+    def remove(cls, id: int, delete: bool = True):
+        """
+        Stop scraping a scraper and, if delete is True, delete it and its history from the database
+        A scrape of it that is already running finishes, but its result is discarded
+        """
+        with cls._lock:
+            config = cls.scrapers.pop(id, None)
+            if config is None:
+                return
+            cls._ids_by_key.pop((config.url, config.css_selector, config.name), None)
+            cls.scheduler.unschedule(id)
+            cls.state.remove(id)
+            # Names aren't unique on their own, so keep the metrics of another scraper with the same name
+            shared = any(c.name == config.name for c in cls.scrapers.values())
+        cls.hosts.forget([id])
+        if not shared:
+            metrics.remove(scraper=config.name)
+        if config.watch:
+            cls.unwatch(config.url, config.lean)
+        if delete:
+            db["scrapers"].delete(id=id)
+            cls.history.delete_scraper(id)
+        logger.info(f"Removed scraper for {config.url} with ID {id}")
+
+    @classmethod
+    def unwatch(cls, url: str, lean: bool):
+        """
+        Close the tab kept open on url unless another scraper is still watching it
+        """
+        tabs = watched_tabs.get(lean)
+        if tabs is None:
+            return
+        if not any(
+            config.watch and config.url == url and config.lean == lean
+            for config in list(cls.scrapers.values())
+        ):
+            tabs.close(url)
+
+    @classmethod
+    def use_leases(cls, leases: LeaseManager):
+        """
+        Share the scrapers with other processes using the same database, only scraping the ones leases holds
+        """
+        cls.leases = leases
+        leases.on_claim = cls._claimed
+        leases.on_release = cls._released
+        leases.register(cls.scrapers.keys())
+
+    @classmethod
+    def _released(cls, ids: List[int]):
+        """
+        Write the latest state of scrapers before another worker takes over
+        """
+        cls.hosts.forget(ids)
+        cls.state.flush()
+
+    @classmethod
+    def _claimed(cls, id: int):
+        """
+        Load the state another worker may have left for a scraper and schedule it
+        """
+        row = db["scrapers"].find_one(id=id)
+        if row is None:
+            return
+        cls.state.remove(id)
+        cls.state.add(row)
+        cls.schedule_from_row(row)
+
+    @classmethod
+    def schedule_from_row(cls, row: dict):
+        """
+        Schedule a scraper at the next run time stored in its row or, for rows from before it was stored, after its interval
+        Scrapers that have never been scraped are due now, spread out by their jitter so they don't all start at once
+        """
+        config = cls.scrapers[row["id"]]
+        if row.get("next_scrape") is not None:
+            due = row["next_scrape"]
+        elif row["last_scrape"] is not None:
+            due = row["last_scrape"] + row["interval"]
+        else:
+            due = datetime.now().timestamp() + random.uniform(
+                0, config.jitter * config.interval
+            )
+        cls.scheduler.schedule(row["id"], due)
 
     @classmethod
     def scraper_ids(cls):
         """
         Get the IDs of the scrapers
         """
-        return [scraper["id"] for scraper in cls.scrapers]
+        return list(cls.scrapers.keys())
 
     @staticmethod
     # As of Python 3.7 dicts are ordered by default
     # But technically it seems that dataset uses OrderedDicts (probably for backwards compatibility)
-    def scrape_url(scraper: OrderedDict):
+    def scrape_page(
+        scrapers: List[OrderedDict],
+        driver: "webdriver.Remote",
+        max_scrolls: int = None,
+        fields: List[List[Field]] = None,
+        use: Callable[[], ContextManager] = nullcontext,
+    ):
         """
-        Scrape the website
+        Load the URL shared by scrapers once and find each scraper's element on it
+        Instead of sleeping, the page is polled and this returns as soon as every element is found; pause_time is only an upper bound on how long to wait
+        If scrolling, each scroll waits (up to pause_time) for the elements to appear or the page to grow, stopping once the page height settles or after max_scrolls scrolls (None for no limit)
+        The strictest settings win: the longest pause_time is used and the page is scrolled if any scraper has scroll_to_bottom
+        Returns the text of each element (or None if it wasn't found) in the same order as scrapers
+        fields has the fields of each scraper, if any; those scrapers get their encoded values instead (None if none of them were found), and are waited on until every field is found
+        Fields are read by a single script call per check rather than a round trip per element, with innerText standing in for the element's text
+        Each step that uses the browser (loading the page, each check, and each scroll) is done inside use(), so a session shared with other threads (like WatchedTabs) is only held for the step and not while waiting in between
         """
-        driver.get(scraper["url"])
-        if scraper["scroll_to_bottom"]:
+        from selenium.common.exceptions import NoSuchElementException
+        from selenium.webdriver.common.by import By
+
+        pause_time = max(scraper["pause_time"] or 0 for scraper in scrapers)
+        if fields is None:
+            fields = [None] * len(scrapers)
+        # Scrapers with a single element, which is found the same way as always, and scrapers with fields
+        single = [i for i, scraper_fields in enumerate(fields) if not scraper_fields]
+        multiple = [i for i, scraper_fields in enumerate(fields) if scraper_fields]
+        selectors = [scrapers[i]["css_selector"] for i in single]
+        specs = [[field.spec() for field in fields[i]] for i in multiple]
+        results = [None] * len(scrapers)
+        done = [False] * len(scrapers)
+        height = None
+
+        def find_missing():
+            """
+            Try to find the elements that haven't been found yet and return True if all of them have been found
+            The page height is checked in the same round trip
+            """
+            nonlocal height
+            with use(), metrics.time("stage_seconds", stage="find"):
+                if single:
+                    height, *found = driver.execute_script(FIND_SCRIPT, selectors)
+                    for i, was_found in zip(single, found):
+                        if done[i] or not was_found:
+                            continue
+                        try:
+                            element = driver.find_element(
+                                By.CSS_SELECTOR,
+                                scrapers[i]["css_selector"],
+                            )
+                        except NoSuchElementException:
+                            # Removed between the check and now; the warning is logged after the return, not here
+                            pass
+                        else:
+                            results[i] = element.text
+                            done[i] = True
+                if multiple:
+                    height, *values = driver.execute_script(FIELDS_SCRIPT, specs)
+                    for i, scraper_values in zip(multiple, values):
+                        # Keep what was found so far in case the rest never shows up
+                        results[i] = encode_fields(
+                            {
+                                field.name: value
+                                for field, value in zip(fields[i], scraper_values)
+                            }
+                        )
+                        done[i] = all(value is not None for value in scraper_values)
+            return all(done)
+
+        with use(), metrics.time("stage_seconds", stage="load"):
+            driver.get(scrapers[0]["url"])
+        wait_started = time.perf_counter()
+        if any(scraper["scroll_to_bottom"] for scraper in scrapers):
             # https://stackoverflow.com/a/27760083/
-            last_height = driver.execute_script("return document.body.scrollHeight")
-            while True:
-                # Scroll down to bottom
-                driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
-
-                # Wait to load page
-                logger.debug(f"Waiting {scraper['pause_time']} seconds")
-                time.sleep(scraper["pause_time"])
-                logger.debug("Done waiting")
-
-                # Calculate new scroll height and compare with last scroll height
-                new_height = driver.execute_script("return document.body.scrollHeight")
-                try:
-                    element = driver.find_element(
-                        webdriver.common.by.By.CSS_SELECTOR, scraper["css_selector"]
-                    )
-                except NoSuchElementException:
-                    pass
+            scrolls = 0
+            # The elements might not need any scrolling at all
+            if not find_missing():
+                while max_scrolls is None or scrolls < max_scrolls:
+                    last_height = height
+                    # Scroll down to bottom
+                    with use():
+                        driver.execute_script(
+                            "window.scrollTo(0, document.body.scrollHeight);"
+                        )
+                    scrolls += 1
+                    # Wait for the elements or for more of the page to load
+                    if wait_until(
+                        lambda: find_missing() or height != last_height, pause_time
+                    ):
+                        if all(done):
+                            break
+                    else:
+                        logger.debug("Reached bottom of page")
+                        break
                 else:
-                    # If the element is found, return the text
-                    return element.text
-                if new_height == last_height:
-                    logger.debug("Reached bottom of page")
-                    break
-                last_height = new_height
+                    logger.debug(f"Stopped scrolling after {scrolls} scrolls")
         else:
-            logger.debug(f"Waiting {scraper['pause_time']} seconds")
-            time.sleep(scraper["pause_time"])
+            logger.debug(f"Waiting up to {pause_time} seconds")
+            wait_until(find_missing, pause_time)
             logger.debug("Done waiting")
-            try:
-                element = driver.find_element(
-                    webdriver.common.by.By.CSS_SELECTOR, scraper["css_selector"]
+        # Includes the time spent finding the elements and scrolling
+        metrics.observe(
+            "stage_seconds", time.perf_counter() - wait_started, stage="wait"
+        )
+        return results
+
+    @staticmethod
+    def watch_page(
+        scrapers: List[OrderedDict],
+        tabs: "WatchedTabs",
+        tab: "Tab",
+        max_age: float,
+        max_scrolls: int = None,
+        fields: List[List[Field]] = None,
+    ):
+        """
+        Scrape scrapers from a tab (from tabs) kept open on their URL, returning the same as scrape_page()
+        The page is only loaded (with scrape_page()) if it hasn't been yet, it was loaded more than max_age seconds ago, the observer was lost (e.g. the page navigated), or an element is missing
+        Otherwise this is a single script call that collects the values the observer kept up to date as the page changed
+        The session is only held for each step of loading the page, so the other watched pages can still be polled while it loads
+        Like fields, elements are read with innerText
+        """
+        url = scrapers[0]["url"]
+        if fields is None:
+            fields = [None] * len(scrapers)
+        ids = [scraper["id"] for scraper in scrapers]
+        specs = [
+            [field.spec() for field in scraper_fields]
+            if scraper_fields
+            else [[scraper["css_selector"], None, None, False]]
+            for scraper, scraper_fields in zip(scrapers, fields)
+        ]
+        values = None
+        if tab.loaded is not None and time.monotonic() - tab.loaded < max_age:
+            with tabs.use(tab) as driver, metrics.time("stage_seconds", stage="poll"):
+                values = driver.execute_script(WATCH_SCRIPT, ids, specs, False)
+            if values is None:
+                logger.debug(f"Lost the observer on {url}; reloading it")
+            elif any(None in json.loads(v) for v in values[1:]):
+                logger.debug(f"Missing an element on {url}; reloading it")
+                values = None
+            elif values[0]:
+                logger.debug(f"{url} changed {values[0]} time(s) since the last poll")
+        if values is None:
+            UrlScraper.scrape_page(
+                scrapers,
+                tab.driver,
+                max_scrolls=max_scrolls,
+                fields=fields,
+                use=lambda: tabs.use(tab),
+            )
+            with tabs.use(tab) as driver:
+                tab.loaded = time.monotonic()
+                values = driver.execute_script(WATCH_SCRIPT, ids, specs, True)
+        results = []
+        for scraper_fields, scraper_values in zip(fields, values[1:]):
+            scraper_values = json.loads(scraper_values)
+            if scraper_fields:
+                results.append(
+                    encode_fields(
+                        {
+                            field.name: value
+                            for field, value in zip(scraper_fields, scraper_values)
+                        }
+                    )
                 )
-            except NoSuchElementException:
-                # The warning is logged after the return, not here
-                return None
             else:
-                return element.text
-        return None
+                results.append(scraper_values[0])
+        return results
 
     @classmethod
     def scrape_all_urls(cls):
         """
-        Scrape all URLs that have their interval met/exceeded (or have never been scraped and have a null last scrape)
-        """
-        # Not doing `for scraper in cls.scrapers` because we want to update the database and compare the data and last scrape time
-        for scraper in db["scrapers"]:
-            if scraper["id"] in cls.scraper_ids():
-                if scraper["last_scrape"] is None or (
-                    scraper["last_scrape"] + scraper["interval"]
-                    <= datetime.now().timestamp()
-                ):
-                    data = UrlScraper.scrape_url(scraper)
-                    # Add the data to the scraper in the DB
-                    # If the new data is different from the old data, log it
-                    if data is None:
-                        if scraper["data"] is None and scraper["last_scrape"] is None:
-                            message = f"{scraper["name"]} not found on first scrape"
-                        else:
-                            message = f"{scraper["name"]} not found"
-                        cls.send_to_all_notifiers(
-                            scraper, message, Notifier.NotifyOn.ERROR
+        Scrape all URLs that are due according to the scheduler (their interval has been met/exceeded or they have never been scraped)
+        Due scrapers that share a URL (and engine and browser profile) are grouped so the page is only loaded once
+        Each group is handed to the thread pool, where it borrows a free browser session from driver_pool
+        Each scraper is rescheduled for last_scrape + interval once it has been scraped
+        When sharing the scrapers with other processes, scrapers this process doesn't hold a lease on are dropped from the schedule
+        Groups whose host is being rate limited are put back in the schedule for when the host is free, without holding up other hosts
+        Scrapers with watch are grouped separately and aren't rate limited, since polling their tab doesn't fetch anything
+        """
+        started = time.perf_counter()
+        if cls.executor is None:
+            cls.executor = ThreadPoolExecutor(
+                max_workers=driver_pool.size, thread_name_prefix="scraper"
+            )
+        groups = {}
+        not_held = []
+        for id in cls.scheduler.pop_due():
+            if cls.leases is not None and not cls.leases.holds(id):
+                # Another worker is scraping it; it's scheduled again if this worker claims it
+                not_held.append(id)
+                continue
+            # The URL and engine are stored in-memory along with the notifiers
+            config = cls.scrapers.get(id)
+            if config is None:
+                # Removed by a config reload
+                continue
+            groups.setdefault(
+                (config.url, config.engine, config.lean, config.watch), []
+            ).append(id)
+        if not_held:
+            cls.hosts.forget(not_held)
+        for (url, engine, _, watch), ids in groups.items():
+            if watch:
+                cls.executor.submit(cls.scrape_scrapers, ids, engine, url, True)
+                continue
+            delay = cls.hosts.try_acquire(urlsplit(url).hostname, ids)
+            if delay is None:
+                # Scheduled again once a fetch from the host finishes
+                logger.debug(f"Too many fetches from the host of {url}; waiting")
+                continue
+            if delay > 0:
+                logger.debug(
+                    f"Rate limited fetching {url}; trying again in {delay:.2f}s"
+                )
+                for id in ids:
+                    cls.scheduler.schedule(id, datetime.now().timestamp() + delay)
+                continue
+            if len(ids) > 1:
+                logger.debug(
+                    f"Sharing one page load of {url} between {len(ids)} scrapers"
+                )
+            cls.executor.submit(cls.scrape_scrapers, ids, engine, url)
+        metrics.observe(
+            "stage_seconds", time.perf_counter() - started, stage="schedule"
+        )
+
+    @classmethod
+    def scrape_scrapers(
+        cls,
+        ids: List[int],
+        engine: str = "selenium",
+        url: str = None,
+        watch: bool = False,
+    ):
+        """
+        Scrape scrapers that share a URL with a single page load, store the results, and notify
+        If watch is True, the scrapers are watching the page and it is polled in its tab instead (and the host limits weren't applied)
+        Runs in a worker thread; the scrapers are not in the scheduler while this runs so they can't be picked up twice
+        """
+        from selenium.common.exceptions import WebDriverException
+
+        # Taken now, since a config reload can remove scrapers while they are being scraped
+        configs = {id: cls.scrapers.get(id) for id in ids}
+        if url is None:
+            url = configs[ids[0]].url
+        scrapers = []
+        resp = None
+        started = time.perf_counter()
+        try:
+            # Copy the rows since we want to compare the data and last scrape time after scraping
+            for id in ids:
+                if configs[id] is None:
+                    logger.debug(
+                        f"Scraper with ID {id} was removed by a config reload; skipping"
+                    )
+                    continue
+                scraper = cls.state.get(id)
+                if scraper is None:
+                    logger.debug(
+                        f"Scraper with ID {id} in list of scrapers but not in database; skipping"
+                    )
+                else:
+                    scrapers.append(scraper)
+                    if scraper.get("next_scrape") is not None:
+                        metrics.observe(
+                            "schedule_lag_seconds",
+                            max(0, datetime.now().timestamp() - scraper["next_scrape"]),
+                            scraper=scraper["name"],
                         )
-                    elif scraper["data"] != data:
-                        if scraper["data"] is None and scraper["last_scrape"] is None:
-                            message = f"First scrape for {scraper["name"]} with data \"{data}\""
-                            cls.send_to_all_notifiers(
-                                scraper, message, Notifier.NotifyOn.FIRST_SCRAPE
-                            )
-                        else:
-                            notification_event = Notifier.NotifyOn.CHANGE
-                            # If the last data was a number and the new data is a number, compare them as numbers
-                            # convert_to_float is used since it checks if the string is still a number after removing non-numeric characters
-                            if isinstance(
-                                convert_to_float(scraper["data"]), float
-                            ) and isinstance(convert_to_float(data), float):
-                                if convert_to_float(scraper["data"]) < convert_to_float(
-                                    data
-                                ):
-                                    message = f"Value increased for {scraper["name"]} from \"{scraper["data"]}\" to \"{data}\""
-                                    notification_event = Notifier.NotifyOn.NUMERIC_UP
-                                elif convert_to_float(
-                                    scraper["data"]
-                                ) > convert_to_float(data):
-                                    message = f"Value decreased for {scraper["name"]} from \"{scraper["data"]}\" to \"{data}\""
-                                    notification_event = Notifier.NotifyOn.NUMERIC_DOWN
-                                else:
-                                    message = f"Value unchanged but data changed for {scraper["name"]} from \"{scraper["data"]}\" to \"{data}\""
-                                    notification_event = Notifier.NotifyOn.NO_CHANGE
-                            else:
-                                message = f"Data changed for {scraper["name"]} from \"{scraper["data"]}\" to \"{data}\""
-                            cls.send_to_all_notifiers(
-                                scraper, message, notification_event
-                            )
+            if not scrapers:
+                return
+            fields = [configs[scraper["id"]].fields for scraper in scrapers]
+            results = None
+            # What the probe found the page to look like, stored once the page has been scraped
+            validators = None
+            # The page as it was scraped, for the snapshot
+            html = None
+            if not watch and all(
+                configs[scraper["id"]].skip_unchanged for scraper in scrapers
+            ):
+                with metrics.time("stage_seconds", stage="probe"):
+                    results, resp, validators = cls.probe(scrapers)
+            if results is None:
+                if engine == "http":
+                    # Unless the probe already fetched the page
+                    if resp is None:
+                        resp = http_engine.fetch(url)
+                    if resp is not None:
+                        html = resp.text
+                        results = http_engine.extract(html, scrapers, fields)
                     else:
-                        message = (
-                            f"Data unchanged for {scraper["name"]} with data \"{data}\""
+                        # Treated the same as the element not being found
+                        results = [None] * len(scrapers)
+                else:
+                    # The scraper with the largest scroll budget wins (0 is no limit)
+                    budgets = [
+                        configs[scraper["id"]].max_scrolls for scraper in scrapers
+                    ]
+                    max_scrolls = None if 0 in budgets else max(budgets)
+                    lean = configs[scrapers[0]["id"]].lean
+                    if watch:
+                        # The tab is shared, so the soonest reload wins
+                        max_age = min(
+                            configs[scraper["id"]].max_age for scraper in scrapers
+                        )
+                        tabs = watched_tabs[lean]
+                        tab = tabs.open(url)
+                        loaded = tab.loaded
+                        results = UrlScraper.watch_page(
+                            scrapers,
+                            tabs,
+                            tab,
+                            max_age,
+                            max_scrolls=max_scrolls,
+                            fields=fields,
                         )
-                        cls.send_to_all_notifiers(
-                            scraper, message, Notifier.NotifyOn.NO_CHANGE
+                        # Only when the page was loaded or changed, since polls are meant to be cheap
+                        if cls.snapshots.enabled and (
+                            tab.loaded != loaded
+                            or results != [scraper["data"] for scraper in scrapers]
+                        ):
+                            with tabs.use(tab) as driver:
+                                html = driver.page_source
+                    else:
+                        pool = driver_pools.get(lean, driver_pool)
+                        acquiring = time.perf_counter()
+                        with pool.acquire() as driver:
+                            metrics.observe(
+                                "stage_seconds",
+                                time.perf_counter() - acquiring,
+                                stage="acquire",
+                            )
+                            results = UrlScraper.scrape_page(
+                                scrapers, driver, max_scrolls=max_scrolls, fields=fields
+                            )
+                            if cls.snapshots.enabled:
+                                html = driver.page_source
+            duration = time.perf_counter() - started
+            if html is not None and cls.snapshots.enabled:
+                with metrics.time("stage_seconds", stage="snapshot"):
+                    try:
+                        cls.snapshots.save(url, html)
+                    except OSError as e:
+                        logger.warning(f"Failed to save a snapshot of {url}: {e}")
+            with cls._lock, metrics.time("stage_seconds", stage="process"):
+                for scraper, data in zip(scrapers, results):
+                    if scraper["id"] not in cls.scrapers:
+                        # Removed by a config reload while it was being scraped
+                        continue
+                    if cls.leases is not None and not cls.leases.holds(scraper["id"]):
+                        # Released while it was being scraped; the worker that took it over stores and notifies its results now
+                        # Its state is dropped too so it isn't flushed over the other worker's, and is loaded again if this worker claims it back
+                        logger.debug(
+                            f"Lost the lease on {scraper['name']} while scraping it; discarding the result"
                         )
-                    scraper["last_scrape"] = datetime.now().timestamp()
-                    scraper["data"] = data
-                    db["scrapers"].update(scraper, ["id"])
+                        cls.state.remove(scraper["id"])
+                        continue
+                    metrics.observe("scrape_seconds", duration, scraper=scraper["name"])
+                    cls.process_result(scraper, data)
+                    if validators is not None:
+                        cls.state.update(scraper["id"], **validators)
+            cls._requeued.difference_update(ids)
+        except WebDriverException as e:
+            for scraper in scrapers:
+                metrics.inc("scrape_errors_total", scraper=scraper["name"])
+            # The pool has already replaced the session, so try again right away with a new one (but only once)
+            retry = [
+                scraper["id"]
+                for scraper in scrapers
+                if scraper["id"] not in cls._requeued and scraper["id"] in cls.scrapers
+            ]
+            if retry:
+                logger.warning(
+                    f"Browser session failed while scraping scrapers with IDs {retry}; re-queuing them: {e.msg}"
+                )
+                cls._requeued.update(retry)
+                for id in retry:
+                    cls.scheduler.schedule(id, datetime.now().timestamp())
+            for scraper in scrapers:
+                if scraper["id"] not in cls.scheduler and scraper["id"] in cls.scrapers:
+                    logger.error(
+                        f"Browser session failed again while scraping {scraper['name']}; trying again after the interval"
+                    )
+                    cls._requeued.discard(scraper["id"])
+                    cls.scheduler.schedule(
+                        scraper["id"], datetime.now().timestamp() + scraper["interval"]
+                    )
+        except Exception:
+            logger.exception(f"Unexpected error while scraping scrapers with IDs {ids}")
+            for scraper in scrapers:
+                metrics.inc("scrape_errors_total", scraper=scraper["name"])
+            # Try again after the interval rather than dropping the scrapers from the schedule
+            for scraper in scrapers:
+                if scraper["id"] not in cls.scheduler and scraper["id"] in cls.scrapers:
+                    cls.scheduler.schedule(
+                        scraper["id"], datetime.now().timestamp() + scraper["interval"]
+                    )
+        finally:
+            # Let the scrapers that were waiting for this fetch to finish try again (polling a watched page didn't take a slot)
+            if not watch:
+                for id in cls.hosts.release(urlsplit(url).hostname):
+                    cls.scheduler.schedule(id, datetime.now().timestamp())
+
+    @classmethod
+    def probe(cls, scrapers: List[OrderedDict]):
+        """
+        Check if the page shared by scrapers has changed since it was last fetched with a conditional GET and a content hash
+        If it hasn't, returns the stored data of each scraper (and the response) so the page doesn't have to be loaded (or parsed) again
+        Otherwise returns None, the response (None if the fetch failed), and the new validators (None if the fetch failed)
+        The validators aren't stored here, since they should only be trusted once the page has been scraped
+        """
+        import httpx
+
+        url = scrapers[0]["url"]
+        # Only use validators that every scraper agrees on (e.g. a new scraper won't have any)
+        validators = {
+            key: scrapers[0][key]
+            if all(scraper[key] == scrapers[0][key] for scraper in scrapers)
+            else None
+            for key in VALIDATORS
+        }
+        try:
+            resp, unchanged, validators = http_engine.conditional_get(url, validators)
+        except httpx.HTTPError as e:
+            logger.debug(f"Failed to check if {url} changed ({e}); loading it anyway")
+            return None, None, None
+        if unchanged:
+            logger.debug(f"{url} is unchanged; skipping {len(scrapers)} scraper(s)")
+            return [scraper["data"] for scraper in scrapers], resp, None
+        return None, resp, validators
+
+    @classmethod
+    def notify_fields(cls, scraper: OrderedDict, data: Optional[str]) -> Optional[str]:
+        """
+        Notify of the changes to each field of a scraper with fields, as if each field were its own scraper
+        The first scrape and none of the fields being found are notified once for the whole scraper
+        Like the value of a single element, each field's number is only parsed when its text changes; returns them as JSON to store in field_values
+        """
+        config = cls.scrapers[scraper["id"]]
+        values = decode_fields(data)
+        old_values = decode_fields(scraper["data"])
+        old_numbers = decode_fields(scraper.get("field_values"))
+        numbers = {}
+        for field in config.fields:
+            old = old_values.get(field.name)
+            if field.name not in old_numbers and isinstance(old, str):
+                # Stored before field_values existed
+                old_numbers[field.name] = config.parser.parse(old)
+            new = values.get(field.name)
+            # Lists of values aren't numbers
+            if isinstance(new, str):
+                numbers[field.name] = (
+                    old_numbers.get(field.name)
+                    if new == old
+                    else config.parser.parse(new)
+                )
+        first = scraper["data"] is None and scraper["last_scrape"] is None
+        if data is None or first:
+            summary = (
+                ", ".join(
+                    f"{name}: {field_text(value)}" for name, value in values.items()
+                )
+                if data is not None
+                else None
+            )
+            cls.notify_change(scraper, scraper["name"], None, summary, first=first)
+        else:
+            for field in config.fields:
+                cls.notify_change(
+                    scraper,
+                    f"{scraper['name']} {field.name}",
+                    field_text(old_values.get(field.name)),
+                    field_text(values.get(field.name)),
+                    old_value=old_numbers.get(field.name),
+                    new_value=numbers.get(field.name),
+                )
+        return json.dumps(numbers, separators=(",", ":")) if numbers else None
+
+    @classmethod
+    def notify_change(
+        cls,
+        scraper: OrderedDict,
+        label: str,
+        old: Optional[str],
+        new: Optional[str],
+        first: bool = False,
+        old_value: float = None,
+        new_value: float = None,
+    ):
+        """
+        Notify of how a value changed (or that it wasn't found), using label to refer to it
+        old_value and new_value are the numbers parsed from old and new (if they are numbers), which are compared instead of the text
+        The thresholds and the minimum change are checked on the numbers before any message is built
+        """
+        config = cls.scrapers[scraper["id"]]
+        if new is None:
+            if first:
+                message = f"{label} not found on first scrape"
             else:
-                logger.debug(
-                    f"Scraper with ID {scraper['id']} not in list of scrapers but in database; skipping"
+                message = f"{label} not found"
+            cls.send_to_all_notifiers(scraper, message, Notifier.NotifyOn.ERROR)
+            return
+        if new_value is not None:
+            crossed = config.crossed(old_value, new_value)
+            if crossed is not None:
+                cls.send_to_all_notifiers(
+                    scraper,
+                    f'{label} {crossed} with "{new}"',
+                    Notifier.NotifyOn.THRESHOLD,
                 )
+        if old != new:
+            if first:
+                message = f'First scrape for {label} with data "{new}"'
+                cls.send_to_all_notifiers(
+                    scraper, message, Notifier.NotifyOn.FIRST_SCRAPE
+                )
+            else:
+                notification_event = Notifier.NotifyOn.CHANGE
+                # If the old value was a number and the new value is a number, compare them as numbers
+                if old_value is not None and new_value is not None:
+                    if not config.significant(old_value, new_value):
+                        message = f'Value changed by less than {config.change_percent:g}% for {label} from "{old}" to "{new}"'
+                        notification_event = Notifier.NotifyOn.NO_CHANGE
+                    elif old_value < new_value:
+                        message = f'Value increased for {label} from "{old}" to "{new}"'
+                        notification_event = Notifier.NotifyOn.NUMERIC_UP
+                    elif old_value > new_value:
+                        message = f'Value decreased for {label} from "{old}" to "{new}"'
+                        notification_event = Notifier.NotifyOn.NUMERIC_DOWN
+                    else:
+                        message = f'Value unchanged but data changed for {label} from "{old}" to "{new}"'
+                        notification_event = Notifier.NotifyOn.NO_CHANGE
+                else:
+                    message = f'Data changed for {label} from "{old}" to "{new}"'
+                cls.send_to_all_notifiers(scraper, message, notification_event)
+        else:
+            message = f'Data unchanged for {label} with data "{new}"'
+            cls.send_to_all_notifiers(scraper, message, Notifier.NotifyOn.NO_CHANGE)
+
+    @classmethod
+    def process_result(cls, scraper: OrderedDict, data: str):
+        """
+        Compare the scraped data to the stored data, notify, store it, and reschedule the scraper
+        The number in the data is parsed once and stored alongside it, so the old number is read from the row rather than parsed again
+        """
+        config = cls.scrapers[scraper["id"]]
+        # Add the data to the scraper in the DB
+        # If the new data is different from the old data, log it
+        if data is None:
+            result = "not_found"
+        elif scraper["data"] is None and scraper["last_scrape"] is None:
+            result = "first"
+        else:
+            result = "unchanged" if scraper["data"] == data else "changed"
+        metrics.inc("scrapes_total", scraper=scraper["name"], result=result)
+        field_values = None
+        if config.fields:
+            # The values of scrapers with fields are stored together, so they aren't a number (each field's is in field_values)
+            value = None
+            field_values = cls.notify_fields(scraper, data)
+        else:
+            old_value = scraper.get("value")
+            if old_value is None and scraper["data"] is not None:
+                # Stored before the value column existed (or not a number)
+                old_value = config.parser.parse(scraper["data"])
+            value = old_value if data == scraper["data"] else config.parser.parse(data)
+            cls.notify_change(
+                scraper,
+                scraper["name"],
+                scraper["data"],
+                data,
+                first=scraper["data"] is None and scraper["last_scrape"] is None,
+                old_value=old_value,
+                new_value=value,
+            )
+        scraper["last_scrape"] = datetime.now().timestamp()
+        if data is not None and data != scraper["data"]:
+            cls.history.record(scraper["id"], scraper["last_scrape"], data, value)
+        # Count consecutive errors and unchanged scrapes for adaptive intervals
+        errors = (scraper.get("errors") or 0) + 1 if data is None else 0
+        unchanged = (scraper.get("unchanged") or 0) + 1 if result == "unchanged" else 0
+        next_scrape = scraper["last_scrape"] + config.next_interval(errors, unchanged)
+        scraper["data"] = data
+        # Only written to the database on the next flush (if the data is unchanged, only last_scrape and next_scrape are written)
+        cls.state.update(
+            scraper["id"],
+            last_scrape=scraper["last_scrape"],
+            data=scraper["data"],
+            value=value,
+            field_values=field_values,
+            errors=errors,
+            unchanged=unchanged,
+            next_scrape=next_scrape,
+        )
+        cls.scheduler.schedule(scraper["id"], next_scrape)
+
+    @classmethod
+    def run(cls):
+        """
+        Scrape forever, sleeping until the next scraper is due instead of polling the database
+        """
+        while True:
+            cls.scheduler.wait_until_due()
+            cls.scrape_all_urls()
+
+    @classmethod
+    def shutdown(cls):
+        """
+        Stop the worker threads, dropping any scrapes that haven't started and waiting for the ones that have
+        """
+        if cls.executor is not None:
+            cls.executor.shutdown(wait=True, cancel_futures=True)
+            cls.executor = None
 
     @classmethod
     def send_to_all_notifiers(
@@ -242,30 +1230,33 @@ class UrlScraper:
         """
         Send the message to all notifiers
         """
-        # Find the scraper from the database in the list of scrapers since the notifiers are stored in-memory
-        for s in cls.scrapers:
-            if s["id"] == scraper["id"]:
-                scraper = s
-                for notifier in scraper["notifiers"]:
-                    if notification_type in notifier.notify_on:
+        # The notifiers are stored in-memory, with the notifiers for each event worked out ahead of time
+        config = cls.scrapers.get(scraper["id"])
+        if config is None:
+            return
+        metrics.inc("notifications_total", event=notification_type.value)
+        with metrics.time("stage_seconds", stage="notify"):
+            for notifier in config.routes.get(notification_type, ()):
+                if dispatcher is not None:
+                    dispatcher.submit(notifier, message)
+                else:
+                    try:
                         notifier.notify(message)
+                    except Exception as e:
+                        logger.error(f"Failed to notify {notifier.url}: {e}")
+                        metrics.inc(
+                            "notification_failures_total",
+                            host=urlsplit(notifier.url).hostname,
+                        )
 
-                # Depending on the type, log the message with a different level
-                if notification_type == Notifier.NotifyOn.ERROR:
-                    logger.warning(message)
-                elif (
-                    notification_type == Notifier.NotifyOn.CHANGE
-                    or notification_type == Notifier.NotifyOn.FIRST_SCRAPE
-                    or notification_type == Notifier.NotifyOn.NUMERIC_UP
-                    or notification_type == Notifier.NotifyOn.NUMERIC_DOWN
-                ):
-                    logger.info(message)
-                elif notification_type == Notifier.NotifyOn.NO_CHANGE:
-                    logger.debug(message)
-                # If the type is in the enum but not implemented, log a error
-                elif notification_type not in list(Notifier.NotifyOn):
-                    logger.error(
-                        f"Notifier notification_type {notification_type} not implemented"
-                    )
-                else:
-                    logger.error(f"Unknown notifier type {notification_type}")
+        # Depending on the type, log the message with a different level
+        level = cls.LOG_LEVELS.get(notification_type)
+        if level is not None:
+            logger.log(level, message)
+        # If the type is in the enum but not implemented, log a error
+        elif isinstance(notification_type, Notifier.NotifyOn):
+            logger.error(
+                f"Notifier notification_type {notification_type} not implemented"
+            )
+        else:
+            logger.error(f"Unknown notifier type {notification_type}")
@@ -0,0 +1,177 @@
+import gzip
+import os
+import threading
+import time
+from typing import Dict, Iterator, Optional
+
+from sqlalchemy import func, select
+
+from scrape_and_ntfy.scraping.buffered import BufferedTable
+from scrape_and_ntfy.scraping.http_engine import fingerprint
+from scrape_and_ntfy.utils.db import db, delete_ids
+from scrape_and_ntfy.utils.logging import logger
+
+# Pages are mostly repeated markup, so a low level compresses almost as well for much less CPU
+COMPRESS_LEVEL = 5
+
+
+class SnapshotStore(BufferedTable):
+    """
+    Archive of the pages the scrapers saw, for looking at what a page was like when a scrape went wrong and for replaying the scrapers offline
+    Each distinct page is compressed and stored once in directory under its SHA-256, and the snapshots table records which page each URL had when
+    A snapshot is only recorded when the page of a URL changed since its last one, so unchanged pages cost nothing
+    Disabled (save() does nothing) until directory is set
+    """
+
+    def __init__(self, directory: str = None, table_name: str = "snapshots"):
+        super().__init__(table_name)
+        self.directory = directory
+        # Map of URL to the hash of its last snapshot
+        self._last: Dict[str, str] = {}
+        # Pages written to disk and pages that were already there
+        self.stored = 0
+        self.deduplicated = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory)
+
+    def path(self, hash: str) -> str:
+        """
+        Get the file a page is stored in (split into subdirectories so none of them gets too big)
+        """
+        return os.path.join(self.directory, hash[:2], f"{hash}.html.gz")
+
+    def ensure_table(self):
+        """
+        Create the snapshots table and its index if they don't exist
+        """
+        table = db.create_table(self.table_name, primary_id="id")
+        table.create_column("url", db.types.text)
+        table.create_column("time", db.types.float)
+        table.create_column("hash", db.types.text)
+        table.create_index(["url", "time"])
+        self._ensured = True
+        return table
+
+    def save(self, url: str, html: str, timestamp: float = None) -> Optional[str]:
+        """
+        Store html as the page url had at timestamp (now by default) and return its hash
+        Nothing is stored if snapshots are disabled (None is returned) or the page is the same as the last snapshot of url
+        """
+        if not self.enabled:
+            return None
+        content = html.encode()
+        hash = fingerprint(content)
+        with self._lock:
+            if self._last.get(url) == hash:
+                return hash
+        path = self.path(hash)
+        if os.path.exists(path):
+            # Another URL (or an earlier version of this one) had the same page; mark it as used so it isn't pruned
+            os.utime(path)
+            self.deduplicated += 1
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Written under another name first so a crash can't leave a partial file behind
+            temporary = f"{path}.{threading.get_ident()}.tmp"
+            with gzip.open(temporary, "wb", compresslevel=COMPRESS_LEVEL) as f:
+                f.write(content)
+            os.replace(temporary, path)
+            self.stored += 1
+        self._buffer(
+            {
+                "url": url,
+                "time": time.time() if timestamp is None else timestamp,
+                "hash": hash,
+            }
+        )
+        # Only once the page is on disk, so a failed write is tried again on the next scrape (a failed insert stays buffered until it succeeds)
+        with self._lock:
+            self._last[url] = hash
+        return hash
+
+    def load(self, hash: str) -> str:
+        """
+        Read a stored page
+        """
+        with gzip.open(self.path(hash), "rb") as f:
+            return f.read().decode()
+
+    def query(
+        self, url: str = None, since: float = None, until: float = None
+    ) -> Iterator[dict]:
+        """
+        Yield the snapshots (of url, or of every URL) in chronological order, optionally limited to a time range
+        """
+        if self.table_name not in db:
+            return
+        table = db[self.table_name].table
+        stmt = select(table)
+        if url is not None:
+            stmt = stmt.where(table.c.url == url)
+        if since is not None:
+            stmt = stmt.where(table.c.time >= since)
+        if until is not None:
+            stmt = stmt.where(table.c.time < until)
+        for row in db.query(stmt.order_by(table.c.time), _step=1000):
+            yield row
+
+    def prune(self, retention: float, now: float = None):
+        """
+        Delete snapshots older than retention seconds (except the latest of each URL, which is still what the page looks like) and the pages no snapshot uses anymore
+        Pages are only deleted once they haven't been saved for retention seconds either, so pages whose snapshots haven't been written yet are kept
+        """
+        if now is None:
+            now = time.time()
+        cutoff = now - retention
+        deleted = 0
+        if self.table_name in db:
+            table = db[self.table_name].table
+            latest = select(func.max(table.c.id)).group_by(table.c.url)
+            with db:
+                # Selected first since MySQL can't delete from a table it's selecting from
+                stale = [
+                    row["id"]
+                    for row in db.query(
+                        select(table.c.id).where(
+                            table.c.time < cutoff, table.c.id.not_in(latest)
+                        )
+                    )
+                ]
+                deleted = delete_ids(table, stale)
+            used = {row["hash"] for row in db.query(select(table.c.hash).distinct())}
+        else:
+            used = set()
+        removed = 0
+        for directory, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(directory, name)
+                if name.split(".")[0] in used:
+                    continue
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                        removed += 1
+                except OSError as e:
+                    logger.debug(f"Failed to prune {path}: {e}")
+        if deleted or removed:
+            logger.info(
+                f"Pruned snapshots; deleted {deleted} snapshot(s) and {removed} page(s)"
+            )
+
+    def start_pruning(self, retention: float, every: float = 3600):
+        """
+        Run prune() now and then every `every` seconds in the background
+        """
+        if not (self.enabled and retention):
+            return
+        self._start_periodically(
+            lambda: self.prune(retention), every, "snapshot-pruning"
+        )
+
+    def stop_pruning(self):
+        """
+        Stop pruning in the background
+        """
+        self._stop_periodically()
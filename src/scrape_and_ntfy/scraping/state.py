@@ -0,0 +1,172 @@
+import threading
+from typing import Dict, Optional, Set
+
+from sqlalchemy import bindparam
+
+from scrape_and_ntfy.scraping.history import HistoryStore
+from scrape_and_ntfy.scraping.snapshots import SnapshotStore
+from scrape_and_ntfy.utils.db import db
+from scrape_and_ntfy.utils.logging import logger
+from scrape_and_ntfy.utils.metrics import metrics
+
+
+class ScraperState:
+    """
+    In-memory copy of the scrapers table that is the source of truth while running
+    Changes are written back to the database in batches (write-behind) instead of one round trip per scrape:
+    every flush_interval seconds, as soon as flush_threshold rows are dirty, and when close() is called.
+    Only the columns that changed are written, so a scrape with unchanged data only updates last_scrape.
+    With write_through, every change is written immediately instead, so nothing is lost if the process crashes.
+    If history (or snapshots) is set, its buffered entries are written in the same transaction.
+    """
+
+    def __init__(
+        self,
+        table_name: str = "scrapers",
+        flush_interval: float = 5.0,
+        flush_threshold: int = 100,
+        write_through: bool = False,
+        history: HistoryStore = None,
+        snapshots: SnapshotStore = None,
+    ):
+        self.table_name = table_name
+        self.history = history
+        self.snapshots = snapshots
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self.write_through = write_through
+        self._rows: Dict[int, dict] = {}
+        # Map of ID to the columns that have changed since the last flush
+        self._dirty: Dict[int, Set[str]] = {}
+        self._lock = threading.Lock()
+        # Only one flush at a time so rows are written in the order they changed
+        self._flush_lock = threading.Lock()
+        self._flush_now = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: threading.Thread = None
+        self.flushes = 0
+        self.rows_written = 0
+
+    def add(self, row: dict):
+        """
+        Start tracking a row that is already in the database
+        """
+        with self._lock:
+            self._rows[row["id"]] = dict(row)
+
+    def remove(self, id: int):
+        """
+        Stop tracking a row, discarding any unflushed changes
+        """
+        with self._lock:
+            self._rows.pop(id, None)
+            self._dirty.pop(id, None)
+
+    def get(self, id: int) -> Optional[dict]:
+        """
+        Get a copy of a row, or None if it isn't tracked
+        """
+        with self._lock:
+            row = self._rows.get(id)
+            return dict(row) if row is not None else None
+
+    def update(self, id: int, **fields):
+        """
+        Update columns of a row in memory and mark the ones that changed as dirty
+        """
+        with self._lock:
+            row = self._rows[id]
+            changed = {k for k, v in fields.items() if row.get(k) != v}
+            if not changed:
+                return
+            row.update(fields)
+            self._dirty.setdefault(id, set()).update(changed)
+            dirty_count = len(self._dirty)
+        if self.write_through:
+            self.flush()
+        elif dirty_count >= self.flush_threshold:
+            # Let the flusher thread do the writing so scraping isn't held up
+            self._flush_now.set()
+
+    def flush(self):
+        """
+        Write every dirty row to the database in one transaction
+        Rows that changed the same columns are written with a single executemany
+        """
+        with self._flush_lock:
+            with self._lock:
+                dirty, self._dirty = self._dirty, {}
+                groups: Dict[frozenset, list] = {}
+                for id, columns in dirty.items():
+                    row = self._rows.get(id)
+                    if row is None:
+                        continue
+                    groups.setdefault(frozenset(columns), []).append(
+                        {"_id": id, **{f"_{c}": row[c] for c in columns}}
+                    )
+            history = self.history.take_pending() if self.history else []
+            snapshots = self.snapshots.take_pending() if self.snapshots else []
+            if not groups and not history and not snapshots:
+                return
+            table = db[self.table_name].table
+            try:
+                with metrics.time("stage_seconds", stage="flush"), db:
+                    if history:
+                        self.history.write(history)
+                    if snapshots:
+                        self.snapshots.write(snapshots)
+                    for columns, params in groups.items():
+                        # bindparam names can't be the same as column names in an UPDATE, thus the underscores
+                        stmt = (
+                            table.update()
+                            .where(table.c.id == bindparam("_id"))
+                            .values({c: bindparam(f"_{c}") for c in columns})
+                        )
+                        db.executable.execute(stmt, params)
+            except Exception:
+                # Mark the rows as dirty again so they're written by the next flush
+                with self._lock:
+                    for id, columns in dirty.items():
+                        self._dirty.setdefault(id, set()).update(columns)
+                if history:
+                    self.history.restore_pending(history)
+                if snapshots:
+                    self.snapshots.restore_pending(snapshots)
+                raise
+            self.flushes += 1
+            self.rows_written += sum(len(params) for params in groups.values())
+            logger.debug(
+                f"Flushed {sum(len(params) for params in groups.values())} scraper(s) to the database"
+            )
+
+    def _flush_periodically(self):
+        while not self._stopped.is_set():
+            self._flush_now.wait(self.flush_interval)
+            self._flush_now.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Failed to write scraper state to the database")
+
+    def start(self):
+        """
+        Start flushing in the background
+        """
+        if self.write_through or self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._flush_periodically, name="state-flusher", daemon=True
+        )
+        self._thread.start()
+
+    def close(self):
+        """
+        Stop the background flushing and write any remaining changes
+        """
+        self._stopped.set()
+        self._flush_now.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
@@ -0,0 +1,75 @@
+import re
+from dataclasses import dataclass, field
+from typing import Optional
+
+# Languages that write numbers like 1.299,00 (a comma as the decimal separator)
+DECIMAL_COMMA_LANGUAGES = set(
+    "bg cs da de el es et fi fr hr hu id it lt lv nb nl nn no pl pt ro ru sk sl sr sv tr uk vi".split()
+)
+# Regions that use a point even though their language usually uses a comma
+DECIMAL_POINT_LOCALES = {"de_CH", "de_LI", "it_CH", "es_MX", "es_US", "es_PR"}
+# A number, optionally signed, whose digits may be broken up by separators (e.g. 1,299.00 or 1 299,00)
+# Only single separators between digits count, so "10, 20" is two numbers rather than 1020
+NUMBER = re.compile(r"[-+\u2212]?\d+(?:[.,'\u2019 \u00a0\u202f]\d+)*")
+
+
+def decimal_for_locale(locale: str) -> str:
+    """
+    Get the decimal separator for a locale such as "de_DE" or "en-US"
+    """
+    locale = locale.replace("-", "_")
+    if locale in DECIMAL_POINT_LOCALES:
+        return "."
+    return "," if locale.split("_")[0].lower() in DECIMAL_COMMA_LANGUAGES else "."
+
+
+@dataclass(slots=True)
+class ValueParser:
+    """
+    Parses the number out of scraped text, compiled once per scraper
+    If pattern is set, the number is taken from its first match (or its first group, if it has any)
+    The decimal separator is "." unless set by decimal or locale; every other separator is treated as grouping digits
+    Text with more than one decimal separator, or one before a grouping separator, isn't a number (e.g. "1.299,00" with the default separator)
+    """
+
+    decimal: str = None
+    locale: str = None
+    pattern: str = None
+    _pattern: re.Pattern = field(init=False, repr=False)
+
+    def __post_init__(self):
+        if self.decimal is None:
+            self.decimal = decimal_for_locale(self.locale) if self.locale else "."
+        if self.decimal not in (".", ","):
+            raise ValueError(
+                f'Invalid decimal separator: {self.decimal} (use "." or ",")'
+            )
+        try:
+            self._pattern = re.compile(self.pattern) if self.pattern else None
+        except re.error as e:
+            raise ValueError(f"Invalid pattern {self.pattern}: {e}")
+
+    def parse(self, text: Optional[str]) -> Optional[float]:
+        """
+        Get the number in text, or None if there isn't one
+        """
+        if not text:
+            return None
+        if self._pattern is not None:
+            match = self._pattern.search(text)
+            if match is None:
+                return None
+            text = match.group(1 if self._pattern.groups else 0) or ""
+        match = NUMBER.search(text)
+        if match is None:
+            return None
+        number = match.group(0)
+        negative = number[0] in "-\u2212"
+        number = number.lstrip("+-\u2212")
+        integer, separator, fraction = number.rpartition(self.decimal)
+        if not separator:
+            integer, fraction = number, ""
+        if self.decimal in integer or (fraction and not fraction.isdigit()):
+            return None
+        value = float(f"{''.join(c for c in integer if c.isdigit())}.{fraction or 0}")
+        return -value if negative else value
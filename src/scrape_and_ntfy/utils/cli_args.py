@@ -1,16 +1,22 @@
 import argparse
 import os
+import socket
 import sys
+from datetime import datetime
 from pathlib import Path
 
 from scrape_and_ntfy.utils.logging import logger
 
 import dotenv
 
+# Set by set_argparse(); nothing is parsed on import
+args: argparse.Namespace = None
 
-def set_argparse() -> None:
+
+def set_argparse(argv: list[str] = None) -> argparse.Namespace:
     """
-    Set up the argument parser and parse the arguments to args
+    Set up the argument parser and parse the arguments (sys.argv if argv is None) to args
+    Also loads .env, since the defaults of the arguments are read from the environment
     """
     global args
 
@@ -29,6 +35,19 @@ def set_argparse() -> None:
         if os.getenv("PATH_TO_TOML")
         else "config.toml",
     )
+    argparser.add_argument(
+        "--reload-interval",
+        help="The number of seconds between checks for changes to the TOML file, which is reloaded without restarting when it changes (or on SIGHUP). Set to 0 to only reload on SIGHUP.",
+        default=float(os.getenv("RELOAD_INTERVAL"))
+        if os.getenv("RELOAD_INTERVAL")
+        else 5,
+        type=float,
+    )
+    argparser.add_argument(
+        "--check-config",
+        help="Check that the TOML file is valid (including the notify_on values of the notifiers) and exit without connecting to the database or starting a browser",
+        action="store_true",
+    )
     database = argparser.add_argument_group("Database options")
     database.add_argument(
         "--db-url",
@@ -49,6 +68,104 @@ def set_argparse() -> None:
         )
         else False,
     )
+    database.add_argument(
+        "--flush-interval",
+        help="The number of seconds between writes of scraper state (last scrape time and data) to the database. State that hasn't been written is lost if the process crashes.",
+        default=float(os.getenv("FLUSH_INTERVAL"))
+        if os.getenv("FLUSH_INTERVAL")
+        else 5,
+        type=float,
+    )
+    database.add_argument(
+        "--flush-threshold",
+        help="Write scraper state to the database early once this many scrapers have unwritten changes",
+        default=int(os.getenv("FLUSH_THRESHOLD"))
+        if os.getenv("FLUSH_THRESHOLD")
+        else 100,
+        type=int,
+    )
+    database.add_argument(
+        "--write-through",
+        help="Write scraper state to the database after every scrape instead of in batches. Slower, but nothing is lost if the process crashes.",
+        action="store_true",
+        default=True
+        if (
+            os.getenv("WRITE_THROUGH")
+            and os.getenv("WRITE_THROUGH").lower() == "true"
+            and os.getenv("WRITE_THROUGH").lower() != "false"
+        )
+        else False,
+    )
+
+    workers = argparser.add_argument_group(
+        "Worker options",
+        "Run several processes against the same database to split the scrapers between them",
+    )
+    workers.add_argument(
+        "--role",
+        help="standalone scrapes every scraper. coordinator and worker split the scrapers between every process with either role using leases in the database. Only the coordinator cleans the database and compacts the history, so run exactly one.",
+        default=os.getenv("ROLE") if os.getenv("ROLE") else "standalone",
+        choices=["standalone", "coordinator", "worker"],
+    )
+    workers.add_argument(
+        "--worker-id",
+        help="A unique name for this process. Defaults to the hostname and process ID.",
+        default=os.getenv("WORKER_ID")
+        if os.getenv("WORKER_ID")
+        else f"{socket.gethostname()}-{os.getpid()}",
+        type=str,
+    )
+    workers.add_argument(
+        "--lease-ttl",
+        help="The number of seconds a lease lasts without being renewed. The scrapers of a process that stops are taken over after this long.",
+        default=float(os.getenv("LEASE_TTL")) if os.getenv("LEASE_TTL") else 30,
+        type=float,
+    )
+
+    history = argparser.add_argument_group("History options")
+    history.add_argument(
+        "--history-retention",
+        help="The number of days to keep the value history for. 0 keeps it forever.",
+        default=float(os.getenv("HISTORY_RETENTION"))
+        if os.getenv("HISTORY_RETENTION")
+        else 0,
+        type=float,
+    )
+    history.add_argument(
+        "--history-downsample-after",
+        help="The number of days after which the value history is downsampled to one entry per --history-downsample-bucket. 0 disables downsampling.",
+        default=float(os.getenv("HISTORY_DOWNSAMPLE_AFTER"))
+        if os.getenv("HISTORY_DOWNSAMPLE_AFTER")
+        else 0,
+        type=float,
+    )
+    history.add_argument(
+        "--history-downsample-bucket",
+        help="When downsampling, only the last value in each bucket of this many hours is kept",
+        default=float(os.getenv("HISTORY_DOWNSAMPLE_BUCKET"))
+        if os.getenv("HISTORY_DOWNSAMPLE_BUCKET")
+        else 1,
+        type=float,
+    )
+
+    snapshots = argparser.add_argument_group(
+        "Snapshot options",
+        "Save the pages the scrapers see so they can be looked at or replayed later",
+    )
+    snapshots.add_argument(
+        "--snapshot-dir",
+        help="The directory to save compressed snapshots of the scraped pages to. Each distinct page is only saved once. Snapshots are off if this isn't set.",
+        default=os.getenv("SNAPSHOT_DIR") if os.getenv("SNAPSHOT_DIR") else "",
+        type=str,
+    )
+    snapshots.add_argument(
+        "--snapshot-retention",
+        help="The number of days to keep snapshots for (the latest snapshot of each page is always kept). 0 keeps them forever.",
+        default=float(os.getenv("SNAPSHOT_RETENTION"))
+        if os.getenv("SNAPSHOT_RETENTION")
+        else 7,
+        type=float,
+    )
 
     scraping = argparser.add_argument_group("Scraping options")
     scraping.add_argument(
@@ -69,6 +186,26 @@ def set_argparse() -> None:
         default=os.getenv("BROWSER") if os.getenv("BROWSER") else "chrome",
         choices=["chrome", "firefox", "edge", "safari"],
     )
+    scraping.add_argument(
+        "--pool-size",
+        help="The number of browser sessions to run in parallel. Each session scrapes one URL at a time.",
+        default=int(os.getenv("POOL_SIZE")) if os.getenv("POOL_SIZE") else 1,
+        type=int,
+    )
+    scraping.add_argument(
+        "--recycle-after",
+        help="Restart each browser session after this many page loads to keep its memory use down. 0 never restarts them.",
+        default=int(os.getenv("RECYCLE_AFTER")) if os.getenv("RECYCLE_AFTER") else 100,
+        type=int,
+    )
+    scraping.add_argument(
+        "--max-browser-memory",
+        help="Restart a browser session once it uses more than this many megabytes of memory. 0 disables the limit. Only supported on Linux.",
+        default=float(os.getenv("MAX_BROWSER_MEMORY"))
+        if os.getenv("MAX_BROWSER_MEMORY")
+        else 0,
+        type=float,
+    )
     scraping.add_argument(
         "--browser-path",
         help="The path to the browser binary",
@@ -88,6 +225,55 @@ def set_argparse() -> None:
         )
         else False,
     )
+    scraping.add_argument(
+        "--lean",
+        help="Don't load images, fonts, or media, turn off unneeded browser features, and stop waiting for pages once the DOM is ready. Scrapers can override this with `lean` in the TOML file.",
+        action="store_true",
+        default=True
+        if (
+            os.getenv("LEAN")
+            and os.getenv("LEAN").lower() == "true"
+            and os.getenv("LEAN").lower() != "false"
+        )
+        else False,
+    )
+    scraping.add_argument(
+        "--block-hosts",
+        help="A comma-separated list of hosts (including their subdomains) or URL patterns to block in lean browser sessions, such as ad and tracking domains. Only supported in Chrome and Edge.",
+        default=os.getenv("BLOCK_HOSTS") if os.getenv("BLOCK_HOSTS") else "",
+        type=str,
+    )
+    notifications = argparser.add_argument_group("Notification options")
+    notifications.add_argument(
+        "--notify-queue-size",
+        help="The maximum number of notifications waiting to be sent",
+        default=int(os.getenv("NOTIFY_QUEUE_SIZE"))
+        if os.getenv("NOTIFY_QUEUE_SIZE")
+        else 1000,
+        type=int,
+    )
+    notifications.add_argument(
+        "--notify-overflow",
+        help="What to do when the notification queue is full: drop the new notification, drop the oldest queued notification, or block scraping until there is space",
+        default=os.getenv("NOTIFY_OVERFLOW")
+        if os.getenv("NOTIFY_OVERFLOW")
+        else "drop_oldest",
+        choices=["drop_newest", "drop_oldest", "block"],
+    )
+    notifications.add_argument(
+        "--notify-retries",
+        help="The number of times to retry a notification that failed to send. Retries back off exponentially.",
+        default=int(os.getenv("NOTIFY_RETRIES")) if os.getenv("NOTIFY_RETRIES") else 3,
+        type=int,
+    )
+    notifications.add_argument(
+        "--notify-drain-timeout",
+        help="The number of seconds to wait for queued notifications to be sent when exiting",
+        default=float(os.getenv("NOTIFY_DRAIN_TIMEOUT"))
+        if os.getenv("NOTIFY_DRAIN_TIMEOUT")
+        else 10,
+        type=float,
+    )
     debug = argparser.add_argument_group("Debugging options")
     debug.add_argument(
         "--log-level",
@@ -95,7 +281,88 @@ def set_argparse() -> None:
         default=os.getenv("LOG_LEVEL") if os.getenv("LOG_LEVEL") else "INFO",
         choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
     )
-    args = argparser.parse_args()
+
+    debug.add_argument(
+        "--metrics-port",
+        help="Serve metrics (including how long each stage of scraping takes) in the Prometheus text format on this port. 0 disables the endpoint.",
+        default=int(os.getenv("METRICS_PORT")) if os.getenv("METRICS_PORT") else 0,
+        type=int,
+    )
+    debug.add_argument(
+        "--metrics-host",
+        help="The address to serve metrics on. Use 0.0.0.0 to make them reachable from other hosts (e.g. outside of a container).",
+        default=os.getenv("METRICS_HOST") if os.getenv("METRICS_HOST") else "127.0.0.1",
+        type=str,
+    )
+
+    commands = argparser.add_subparsers(
+        dest="command",
+        title="Commands",
+        description="Run without a command to start scraping",
+    )
+    history_command = commands.add_parser(
+        "history", help="Query or export the value history of a scraper"
+    )
+    history_command.add_argument(
+        "scraper",
+        help="The ID or name of the scraper. If omitted, the scrapers and the number of entries in their history are listed.",
+        nargs="?",
+    )
+    history_command.add_argument(
+        "--since",
+        help="Only include entries at or after this date/time (ISO 8601)",
+        type=datetime.fromisoformat,
+    )
+    history_command.add_argument(
+        "--until",
+        help="Only include entries before this date/time (ISO 8601)",
+        type=datetime.fromisoformat,
+    )
+    history_command.add_argument(
+        "--limit", help="The maximum number of entries to include", type=int
+    )
+    history_command.add_argument(
+        "--format", help="The output format", default="csv", choices=["csv", "json"]
+    )
+    history_command.add_argument(
+        "--output",
+        help="The file to write to. Defaults to stdout.",
+        default="-",
+    )
+    replay_command = commands.add_parser(
+        "replay",
+        help="Run the scrapers in the config against the snapshots in --snapshot-dir without a browser or network, printing what they found and would have notified",
+    )
+    replay_command.add_argument(
+        "scraper",
+        help="The name or URL of the scraper to replay. If omitted, every scraper is replayed.",
+        nargs="?",
+    )
+    replay_command.add_argument(
+        "--since",
+        help="Only replay snapshots taken at or after this date/time (ISO 8601)",
+        type=datetime.fromisoformat,
+    )
+    replay_command.add_argument(
+        "--until",
+        help="Only replay snapshots taken before this date/time (ISO 8601)",
+        type=datetime.fromisoformat,
+    )
+    replay_command.add_argument(
+        "--changes-only",
+        help="Leave out snapshots where nothing changed",
+        action="store_true",
+    )
+    replay_command.add_argument(
+        "--format", help="The output format", default="csv", choices=["csv", "json"]
+    )
+    replay_command.add_argument(
+        "--output",
+        help="The file to write to. Defaults to stdout.",
+        default="-",
+    )
+    args = argparser.parse_args(argv)
+    return args
 
 
 # def validate_path_to_file(path: str) -> str:
@@ -119,6 +386,3 @@ def check_required_args(required_args: list[str], argparser: argparse.ArgumentPa
             # raise ValueError(f"{arg} is required")
             logger.critical(f"{arg} is required")
             sys.exit(1)
-
-
-set_argparse()
@@ -1,13 +1,67 @@
-import dataset
-from scrape_and_ntfy.utils.cli_args import args
+from typing import List
+
 from scrape_and_ntfy.utils.logging import logger
 
+# The number of rows looked up or deleted per statement, which keeps each under the database's limit on parameters
+BATCH_SIZE = 500
+
+
+class Database:
+    """
+    Stands in for the dataset.Database so modules can import db before connect_to_db() is called (which imports dataset and connects)
+    Everything is passed through to the connected database
+    """
+
+    def __init__(self):
+        self._db = None
+
+    def _connected(self):
+        if self._db is None:
+            raise RuntimeError(
+                "Not connected to a database; call connect_to_db() first"
+            )
+        return self._db
+
+    def __getattr__(self, name: str):
+        return getattr(self._connected(), name)
+
+    def __getitem__(self, table_name: str):
+        return self._connected()[table_name]
+
+    def __contains__(self, table_name: str) -> bool:
+        return table_name in self._connected()
+
+    def __enter__(self):
+        return self._connected().__enter__()
+
+    def __exit__(self, *exc_info):
+        return self._connected().__exit__(*exc_info)
+
+
+db = Database()
+
 
 def connect_to_db(db_url: str):
-    global db
+    import dataset
+
     logger.info(f"Connecting to database at {db_url}")
-    db = dataset.connect(args.db_url)
+    engine_kwargs = {}
+    if db_url.startswith("sqlite"):
+        # Connections are opened per thread (scraping workers, the state flusher, etc.) but may be closed by another
+        engine_kwargs["connect_args"] = {"check_same_thread": False}
+    db._db = dataset.connect(db_url, engine_kwargs=engine_kwargs)
     logger.info("Connected to database")
 
 
-connect_to_db(args.db_url)
+def delete_ids(table, ids: List[int]) -> int:
+    """
+    Delete the rows of table (a SQLAlchemy table) with IDs ids, BATCH_SIZE at a time, and return the number deleted
+    Used instead of a DELETE with a subquery on the same table, which MySQL doesn't allow
+    """
+    deleted = 0
+    for i in range(0, len(ids), BATCH_SIZE):
+        result = db.executable.execute(
+            table.delete().where(table.c.id.in_(ids[i : i + BATCH_SIZE]))
+        )
+        deleted += result.rowcount
+    return deleted
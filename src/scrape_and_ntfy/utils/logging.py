@@ -2,8 +2,6 @@ from sys import stderr
 
 from loguru import logger
 
-from scrape_and_ntfy.utils.cli_args import args
-
 
 logging_file = stderr
 
@@ -15,6 +13,3 @@ def set_primary_logger(log_level):
     logger_format = "<green>{time:YYYY-MM-DD HH:mm:ss}</green> |<level>{level: ^10}</level>| <level>{message}</level>"
     sink = stderr
     logger.add(sink=sink, format=logger_format, colorize=True, level=log_level)
-
-
-set_primary_logger(args.log_level)
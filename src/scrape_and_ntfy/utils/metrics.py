@@ -0,0 +1,225 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Tuple
+
+from scrape_and_ntfy.utils.logging import logger
+
+# Upper bounds (in seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    120,
+    300,
+)
+PREFIX = "scrape_and_ntfy_"
+# The type and help text of every metric, in the order they are exported
+METRICS = {
+    "stage_seconds": (
+        "histogram",
+        "Time spent in each stage of scraping (load, wait, find, poll, fetch, parse, probe, acquire, snapshot, process, notify, schedule, flush)",
+    ),
+    "scrape_seconds": ("histogram", "Time taken to scrape each scraper"),
+    "schedule_lag_seconds": (
+        "histogram",
+        "How long after its interval was up each scraper was scraped",
+    ),
+    "scrapes_total": ("counter", "Scrapes by scraper and result"),
+    "scrape_errors_total": ("counter", "Scrapes that raised an error by scraper"),
+    "notify_seconds": ("histogram", "Time taken to send each notification by host"),
+    "notifications_total": ("counter", "Notifications by event type"),
+    "notification_failures_total": (
+        "counter",
+        "Failed attempts to send a notification by host",
+    ),
+    "notification_queue_depth": ("gauge", "Notifications waiting to be sent"),
+    "notifications_dropped_total": ("counter", "Notifications dropped"),
+    "host_wait_seconds": (
+        "histogram",
+        "How long scrapers were held back by the limits of their host",
+    ),
+    "host_throttled_total": (
+        "counter",
+        "Times a page fetch was held back by the limits of its host",
+    ),
+    "host_queue_depth": ("gauge", "Scrapers held back by the limits of their host"),
+    "host_active_fetches": ("gauge", "Page fetches in progress by host"),
+    "browser_restarts_total": ("counter", "Browser sessions restarted"),
+    "browser_recycles_total": ("counter", "Browser sessions recycled"),
+    "watched_tabs": ("gauge", "Tabs kept open on watched pages"),
+    "state_flushes_total": ("counter", "Writes of scraper state to the database"),
+}
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+class Metrics:
+    """
+    In-process counters, gauges, and histograms exported in the Prometheus text format
+    Recording a value only takes a lock and a dict lookup (plus a binary search for histograms), so it is always on
+    Gauges that are read from elsewhere (e.g. the length of a queue) and counters that are counted elsewhere (e.g. by the dispatcher) are set by collectors right before exporting
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # Map of (name, labels) to the value of a counter or gauge
+        self._values: Dict[Tuple[str, tuple], float] = {}
+        # Map of (name, labels) to [count per bucket (plus one for +Inf), sum]
+        self._histograms: Dict[Tuple[str, tuple], list] = {}
+        self._collectors: List[Callable[["Metrics"], None]] = []
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        """
+        Increment a counter
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, name: str, value: float, **labels):
+        """
+        Set a gauge, or a counter to a total counted elsewhere
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = value
+
+    def observe(self, name: str, value: float, **labels):
+        """
+        Record a value in a histogram
+        """
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = [[0] * (len(self.buckets) + 1), 0.0]
+                self._histograms[key] = histogram
+            histogram[0][index] += 1
+            histogram[1] += value
+
+    def remove(self, **labels):
+        """
+        Drop every counter, gauge, and histogram with all of labels (e.g. those of a scraper that was removed) so they stop being exported
+        """
+        items = set(labels.items())
+
+        def matches(key):
+            return items.issubset(key[1])
+
+        with self._lock:
+            for key in [key for key in self._values if matches(key)]:
+                del self._values[key]
+            for key in [key for key in self._histograms if matches(key)]:
+                del self._histograms[key]
+
+    @contextmanager
+    def time(self, name: str, **labels):
+        """
+        Record how long the block takes in a histogram (even if it raises)
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def add_collector(self, collector: Callable[["Metrics"], None]):
+        """
+        Call collector with this object before exporting, so it can set gauges
+        """
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        """
+        Export every metric in the Prometheus text format
+        """
+        for collector in self._collectors:
+            try:
+                collector(self)
+            except Exception as e:
+                logger.debug(f"Failed to collect metrics: {e}")
+        with self._lock:
+            values = dict(self._values)
+            histograms = {
+                key: (list(counts), total)
+                for key, (counts, total) in self._histograms.items()
+            }
+        lines = []
+        for name, (kind, help) in METRICS.items():
+            full_name = PREFIX + name
+            lines.append(f"# HELP {full_name} {help}")
+            lines.append(f"# TYPE {full_name} {kind}")
+            if kind == "histogram":
+                for (metric, labels), (counts, total) in histograms.items():
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(self.buckets + ("+Inf",), counts):
+                        cumulative += count
+                        bucket_labels = labels + (("le", str(bound)),)
+                        lines.append(
+                            f"{full_name}_bucket{_format_labels(bucket_labels)} {cumulative}"
+                        )
+                    lines.append(f"{full_name}_sum{_format_labels(labels)} {total}")
+                    lines.append(
+                        f"{full_name}_count{_format_labels(labels)} {cumulative}"
+                    )
+            else:
+                for (metric, labels), value in values.items():
+                    if metric == name:
+                        lines.append(f"{full_name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f"Metrics request: {format % args}")
+
+
+def serve(host: str = "127.0.0.1", port: int = 9464) -> ThreadingHTTPServer:
+    """
+    Serve the metrics at http://host:port/metrics in a background thread
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"Serving metrics at http://{host}:{port}/metrics")
+    return server